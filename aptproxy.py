@@ -0,0 +1,369 @@
+try:
+    import sys
+    import os
+    import argparse
+    import email.utils
+    import hashlib
+    import http.client
+    import http.server
+    import json
+    import queue
+    import shutil
+    import threading
+    import urllib.parse
+except ImportError as e:
+    print(f"[X] Failed to load required module, likely not installed: {e}")
+    try:
+        sys.exit(1)
+    except:
+        exit(1)
+
+
+# Small caching HTTP proxy for apt and debootstrap.
+#
+# Clients either use it as a regular HTTP proxy (http_proxy=http://host:port/,
+# requests carry the absolute URL) or as a mirror, in which case the request
+# path is appended to the upstream URL given on start. Files are kept in an
+# on-disk store that is evicted least recently used first. Package files are
+# immutable and served from the store as they are, index files are revalidated
+# with the upstream unless the proxy is offline.
+
+CHUNK_SIZE = 1024 * 1024
+IMMUTABLE_SUFFIXES = (".deb", ".udeb", ".ddeb", ".dsc", ".tar.gz", ".tar.xz", ".tar.bz2", ".tar.zst", ".diff.gz")
+
+
+def is_immutable(path):
+    return path.endswith(IMMUTABLE_SUFFIXES) or "/by-hash/" in path
+
+
+class ConnectionPool:
+    """Keep-alive upstream connections, pooled per scheme, host and port."""
+
+    def __init__(self, size=8, timeout=60):
+        self.size = size
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.pools = {}
+
+    def _pool(self, key):
+        with self.lock:
+            if key not in self.pools:
+                self.pools[key] = queue.LifoQueue(self.size)
+            return self.pools[key]
+
+    def get(self, scheme, host, port):
+        try:
+            return self._pool((scheme, host, port)).get_nowait()
+        except queue.Empty:
+            if scheme == "https":
+                return http.client.HTTPSConnection(host, port, timeout=self.timeout)
+            return http.client.HTTPConnection(host, port, timeout=self.timeout)
+
+    def put(self, scheme, host, port, conn):
+        try:
+            self._pool((scheme, host, port)).put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+
+class Store:
+    """On-disk file store with least recently used eviction."""
+
+    def __init__(self, root, max_size):
+        self.root = root
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        os.makedirs(root, exist_ok=True)
+        self.size = sum(size for _, size, _ in self.entries())
+
+    def path(self, url):
+        parsed = urllib.parse.urlsplit(url)
+        parts = [p for p in parsed.path.split("/") if p not in ("", ".", "..")]
+        return os.path.join(self.root, parsed.netloc.replace(":", "_"), *parts)
+
+    def key_lock(self, path):
+        with self.lock:
+            if path not in self.key_locks:
+                self.key_locks[path] = threading.Lock()
+            return self.key_locks[path]
+
+    def meta(self, path):
+        try:
+            with open(path + ".meta") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def touch(self, path):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def commit(self, tmp, path, meta):
+        with open(path + ".meta.tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(path + ".meta.tmp", path + ".meta")
+
+        with self.lock:
+            # A refreshed index replaces the file it was revalidated against
+            replaced = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(tmp, path)
+            self.size += os.path.getsize(path) - replaced
+        if self.size > self.max_size:
+            self.evict()
+
+    def entries(self):
+        entries = []
+        for root, dirs, files in os.walk(self.root):
+            for file in files:
+                if file.endswith((".meta", ".tmp")):
+                    continue
+                path = os.path.join(root, file)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def evict(self):
+        with self.lock:
+            # Other builds may share the store, so recount instead of trusting self.size
+            entries = sorted(self.entries())
+            total = sum(size for _, size, _ in entries)
+
+            for _, size, path in entries:
+                if total <= self.max_size:
+                    break
+                for victim in (path, path + ".meta"):
+                    try:
+                        os.remove(victim)
+                    except OSError:
+                        pass
+                total -= size
+
+            self.size = total
+
+
+class ProxyHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def upstream_url(self):
+        if self.path.startswith(("http://", "https://")):
+            return self.path
+        if not self.server.upstream:
+            return None
+        return urllib.parse.urljoin(self.server.upstream, self.path.lstrip("/"))
+
+    def send_response(self, *args, **kwargs):
+        self.response_started = True
+        super().send_response(*args, **kwargs)
+
+    def do_HEAD(self):
+        self.handle_request(head=True)
+
+    def do_GET(self):
+        self.handle_request(head=False)
+
+    def handle_request(self, head):
+        url = self.upstream_url()
+        if not url:
+            self.send_error(400, "No upstream for relative request")
+            return
+
+        self.response_started = False
+        store = self.server.store
+        path = store.path(url)
+        immutable = is_immutable(urllib.parse.urlsplit(url).path)
+
+        with store.key_lock(path):
+            if os.path.exists(path) and (immutable or self.server.offline):
+                store.touch(path)
+                self.send_file(path, store.meta(path), head)
+                return
+
+            if self.server.offline:
+                self.send_error(404, "Not in offline store")
+                return
+
+            try:
+                self.fetch(url, path, head)
+            except (OSError, http.client.HTTPException) as e:
+                if self.response_started:
+                    # Part of the response is already out, the client has to retry on a new connection
+                    self.close_connection = True
+                elif os.path.exists(path):
+                    # Upstream is unreachable, a stale index is better than none
+                    self.send_file(path, store.meta(path), head)
+                else:
+                    self.send_error(502, f"Upstream failed: {e}")
+
+    def fetch(self, url, path, head):
+        store = self.server.store
+        parsed = urllib.parse.urlsplit(url)
+        port = parsed.port or (443 if parsed.scheme == "https" else 80)
+        target = parsed.path + ("?" + parsed.query if parsed.query else "")
+
+        headers = {"User-Agent": "PassKill-Build apt proxy", "Connection": "keep-alive"}
+        meta = store.meta(path)
+        if os.path.exists(path) and meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+        response = None
+        for attempt in range(2):
+            conn = self.server.pool.get(parsed.scheme, parsed.hostname, port)
+            try:
+                conn.request("GET", target, headers=headers)
+                response = conn.getresponse()
+                break
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                # A pooled connection may have been closed by the upstream
+                if attempt:
+                    raise
+
+        try:
+            if response.status == 304:
+                response.read()
+                store.touch(path)
+                self.send_file(path, meta, head)
+                return
+
+            if response.status != 200:
+                body = response.read()
+                self.send_response(response.status)
+                self.send_header("Content-Type", response.getheader("Content-Type", "text/plain"))
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if not head:
+                    self.wfile.write(body)
+                return
+
+            meta = {
+                "url": url,
+                "content_type": response.getheader("Content-Type", "application/octet-stream"),
+                "last_modified": response.getheader("Last-Modified"),
+            }
+            length = response.getheader("Content-Length")
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{threading.get_ident()}.tmp"
+            try:
+                with open(tmp, "wb") as f:
+                    if length is None:
+                        # No length to announce, store the whole file before serving it
+                        shutil.copyfileobj(response, f, CHUNK_SIZE)
+                    else:
+                        self.send_headers(int(length), meta)
+                        received = 0
+                        while True:
+                            chunk = response.read(CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            received += len(chunk)
+                            f.write(chunk)
+                            if not head:
+                                self.wfile.write(chunk)
+                        if received != int(length):
+                            # http.client returns a short body when the upstream hangs up early
+                            raise http.client.IncompleteRead(b"", int(length) - received)
+
+                store.commit(tmp, path, meta)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+
+            if length is None:
+                self.send_file(path, meta, head)
+        finally:
+            # Only hand the connection back once the response was read completely
+            if response.will_close or not response.isclosed():
+                conn.close()
+            else:
+                self.server.pool.put(parsed.scheme, parsed.hostname, port, conn)
+
+    def send_headers(self, length, meta):
+        self.send_response(200)
+        self.send_header("Content-Type", meta.get("content_type") or "application/octet-stream")
+        self.send_header("Content-Length", str(length))
+        if meta.get("last_modified"):
+            self.send_header("Last-Modified", meta["last_modified"])
+        self.end_headers()
+
+    def send_file(self, path, meta, head):
+        since = self.headers.get("If-Modified-Since")
+        if since and meta.get("last_modified"):
+            try:
+                if email.utils.parsedate_to_datetime(meta["last_modified"]) <= email.utils.parsedate_to_datetime(since):
+                    self.send_response(304)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+            except (TypeError, ValueError):
+                pass
+
+        with open(path, "rb") as f:
+            self.send_headers(os.fstat(f.fileno()).st_size, meta)
+            if not head:
+                shutil.copyfileobj(f, self.wfile, CHUNK_SIZE)
+
+
+class AptProxy(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, store_dir, max_size, upstream=None, offline=False, verbose=False):
+        super().__init__(address, ProxyHandler)
+        self.store = Store(store_dir, max_size)
+        self.pool = ConnectionPool()
+        self.upstream = upstream
+        self.offline = offline
+        self.verbose = verbose
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self):
+        """Serve in a background thread until stop() is called."""
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.thread:
+            self.thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Caching HTTP proxy for apt.")
+    parser.add_argument("--store", default=os.path.join(os.getcwd(), ".apt-proxy"), help="Directory to store cached files in.")
+    parser.add_argument("--bind", default="127.0.0.1", help="Address to listen on.")
+    parser.add_argument("--port", type=int, default=3142, help="Port to listen on.")
+    parser.add_argument("--max-size", type=int, default=32 * 1024 * 1024 * 1024, help="Maximum store size in bytes.")
+    parser.add_argument("--upstream", help="Mirror URL for requests that are not absolute, for example a local directory served with python3 -m http.server.")
+    parser.add_argument("--offline", action="store_true", help="Only serve files that are already in the store.")
+    parser.add_argument("--verbose", action="store_true", help="Log every request.")
+    args = parser.parse_args()
+
+    proxy = AptProxy((args.bind, args.port), args.store, args.max_size, args.upstream, args.offline, args.verbose)
+    print(f"[*] Serving apt proxy on {proxy.url} (store: {args.store})")
+    try:
+        proxy.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        proxy.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+try:
+    import sys
+    import os
+    import argparse
+    import hashlib
+    import json
+    import shutil
+    import subprocess
+    import tempfile
+    import threading
+    import urllib.request
+except ImportError as e:
+    print(f"[X] Failed to load required module, likely not installed: {e}")
+    try:
+        sys.exit(1)
+    except:
+        exit(1)
+
+
+# Store for the files the build downloads besides packages.
+#
+# Every entry of chroot.DOWNLOADS is kept in the store under its name:
+#   file  a pinned URL, checked against its SHA-256 every time it is used
+#   git   a mirror of the repository, updated with git fetch
+#   pip   a wheelhouse of the packages and their dependencies
+# Files without a hash in DOWNLOADS are pinned to the hash of their first
+# download, in PINS inside the store. OpenPGP keys from a keyserver change
+# whenever signatures are added, so they are checked against the fingerprint
+# in DOWNLOADS instead. With offline set nothing is downloaded
+# and everything has to be in the store already.
+
+PINS = "sha256sums.json"
+CHUNK_SIZE = 1024 * 1024
+
+pins_lock = threading.Lock()
+
+
+def remove_path(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_pins(store):
+    try:
+        with open(os.path.join(store, PINS)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def pin(store, name, digest):
+    with pins_lock:
+        pins = load_pins(store)
+        pins[name] = digest
+        path = os.path.join(store, PINS)
+        with open(path + ".tmp", "w") as f:
+            json.dump(pins, f, indent=1, sort_keys=True)
+        os.replace(path + ".tmp", path)
+
+
+def key_fingerprints(path):
+    """Return the fingerprints of the primary keys in the OpenPGP key file at path."""
+    with tempfile.TemporaryDirectory() as home:
+        result = subprocess.run(["gpg", "--homedir", home, "--batch", "--with-colons", "--show-keys", path],
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    fingerprints = []
+    primary = False
+    for line in result.stdout.splitlines():
+        fields = line.split(":")
+        if fields[0] == "pub":
+            primary = True
+        elif fields[0] == "fpr" and primary:
+            fingerprints.append(fields[9].upper())
+            primary = False
+    return fingerprints
+
+
+def check_fingerprint(path, name, fingerprint):
+    fingerprints = key_fingerprints(path)
+    if fingerprints != [fingerprint.upper()]:
+        raise ValueError(f"{name} holds the keys {', '.join(fingerprints) or 'none'}, expected only {fingerprint}")
+
+
+def fetch_file(store, name, url, sha256=None, offline=False, refresh=False, fingerprint=None):
+    """Make store/name the file at url and return its SHA-256.
+
+    A stored file that matches its hash is used as it is, unless refresh is
+    set. A download that does not match is thrown away. With fingerprint the
+    file has to be an OpenPGP key with that fingerprint and is not pinned.
+    """
+    path = os.path.join(store, name)
+    expected = sha256 or (None if fingerprint else load_pins(store).get(name))
+
+    if fingerprint and os.path.exists(path) and not (refresh and not offline):
+        try:
+            check_fingerprint(path, name, fingerprint)
+            return sha256_file(path)
+        except ValueError as e:
+            if offline:
+                raise
+            print(f"[X] {e}, downloading it again...")
+    elif os.path.exists(path) and not (refresh and not offline):
+        digest = sha256_file(path)
+        if expected is None:
+            pin(store, name, digest)
+        if expected is None or digest == expected:
+            return digest
+        if offline:
+            raise ValueError(f"{name} in the download store has SHA-256 {digest}, expected {expected}")
+        print(f"[X] {name} does not match its pinned SHA-256, downloading it again...")
+
+    if offline:
+        raise FileNotFoundError(f"{name} is not in the download store, run a build without --offline first")
+
+    tmp = path + ".tmp"
+    digest = hashlib.sha256()
+    try:
+        with urllib.request.urlopen(url) as response, open(tmp, "wb") as f:
+            while chunk := response.read(CHUNK_SIZE):
+                digest.update(chunk)
+                f.write(chunk)
+
+        if expected and digest.hexdigest() != expected:
+            raise ValueError(f"{url} has SHA-256 {digest.hexdigest()}, expected {expected}")
+        if fingerprint:
+            check_fingerprint(tmp, url, fingerprint)
+        os.replace(tmp, path)
+    finally:
+        remove_path(tmp)
+
+    if not expected and not fingerprint:
+        print(f"[*] Pinned {name} to SHA-256 {digest.hexdigest()}, put it in DOWNLOADS in chroot.py to check it everywhere")
+        pin(store, name, digest.hexdigest())
+    return digest.hexdigest()
+
+
+def update_mirror(store, name, url, offline=False):
+    """Make store/name a mirror of the git repository at url and return the commit of its HEAD.
+
+    An existing mirror only fetches what changed.
+    """
+    path = os.path.join(store, name)
+
+    if os.path.isdir(path):
+        if not offline:
+            subprocess.run(["git", "-C", path, "fetch", "--prune", "--quiet", "origin"], check=True)
+    elif offline:
+        raise FileNotFoundError(f"{name} is not in the download store, run a build without --offline first")
+    else:
+        tmp = path + ".tmp"
+        remove_path(tmp)
+        try:
+            subprocess.run(["git", "clone", "--mirror", "--quiet", url, tmp], check=True)
+            os.replace(tmp, path)
+        finally:
+            remove_path(tmp)
+
+    return subprocess.run(["git", "-C", path, "rev-parse", "HEAD"], check=True, stdout=subprocess.PIPE, text=True).stdout.strip()
+
+
+def update_wheelhouse(store, name, packages, offline=False):
+    """Put wheels of packages and their dependencies into store/name, returns the wheel file names.
+
+    The wheels are built with the pip of the host, which is fine for pure
+    Python packages like the ones the image installs.
+    """
+    path = os.path.join(store, name)
+    os.makedirs(path, exist_ok=True)
+
+    if not offline:
+        result = subprocess.run([sys.executable, "-m", "pip", "wheel", "--quiet", "--wheel-dir", path, "--find-links", path] + list(packages))
+        if result.returncode != 0:
+            raise RuntimeError(f"pip wheel failed for {', '.join(packages)}, is pip installed for {sys.executable}?")
+
+    wheels = sorted(file for file in os.listdir(path) if file.endswith(".whl"))
+    if not wheels:
+        raise FileNotFoundError(f"{name} has no wheels in the download store, run a build without --offline first")
+    return wheels
+
+
+def fetch(store, name, entry, offline=False, refresh=False):
+    """Bring one DOWNLOADS entry up to date in the store, returns its hash, commit or wheel names."""
+    os.makedirs(store, exist_ok=True)
+    if entry["kind"] == "file":
+        return fetch_file(store, name, entry["url"], entry.get("sha256"), offline, refresh, entry.get("fingerprint"))
+    if entry["kind"] == "git":
+        return update_mirror(store, name, entry["url"], offline)
+    if entry["kind"] == "pip":
+        return update_wheelhouse(store, name, entry["packages"], offline)
+    raise ValueError(f"Unknown download kind {entry['kind']} of {name}")
+
+
+def reference(store, name, entry, offline=False):
+    """Return what a DOWNLOADS entry is keyed by, without fetching it.
+
+    A git repository is keyed by the commit of the remote HEAD, or of the
+    mirror HEAD when offline. Files are keyed by their entry, the URL with its
+    hash or fingerprint, and wheelhouses by their packages, since a download
+    that does not match its entry never gets into the store.
+    """
+    if entry["kind"] != "git":
+        return {key: value for key, value in entry.items() if key != "kind"}
+
+    if not offline:
+        result = subprocess.run(["git", "ls-remote", entry["url"], "HEAD"], check=True, stdout=subprocess.PIPE, text=True)
+        if result.stdout.split():
+            return result.stdout.split()[0]
+
+    path = os.path.join(store, name)
+    if not os.path.isdir(path):
+        raise FileNotFoundError(f"{name} is not in the download store, run a build without --offline first")
+    return subprocess.run(["git", "-C", path, "rev-parse", "HEAD"], check=True, stdout=subprocess.PIPE, text=True).stdout.strip()
+
+
+def prune(store, names):
+    """Remove everything in the store that is not one of names, returns the removed names."""
+    removed = []
+    if not os.path.isdir(store):
+        return removed
+
+    for entry in sorted(os.listdir(store)):
+        if entry not in names and entry != PINS:
+            remove_path(os.path.join(store, entry))
+            removed.append(entry)
+    return removed
+
+
+def main():
+    import chroot
+
+    parser = argparse.ArgumentParser(description="Fill the download store, so later builds can run with --offline.")
+    parser.add_argument("names", nargs="*", help="Entries of DOWNLOADS in chroot.py to fetch, all of them by default.")
+    parser.add_argument("--store", default=os.path.join(os.getcwd(), ".downloads"), help="Location of the download store.")
+    parser.add_argument("--refresh", action="store_true", help="Download pinned files again even when they are stored.")
+    args = parser.parse_args()
+
+    failed = False
+    for name in args.names or chroot.DOWNLOADS:
+        if name not in chroot.DOWNLOADS:
+            print(f"[X] Unknown download {name}, downloads: {', '.join(chroot.DOWNLOADS)}")
+            sys.exit(1)
+        try:
+            result = fetch(args.store, name, chroot.DOWNLOADS[name], refresh=args.refresh)
+            print(f"[✓] {name}: {', '.join(result) if isinstance(result, list) else result}")
+        except (OSError, ValueError, RuntimeError, subprocess.CalledProcessError) as e:
+            print(f"[X] {name}: {e}")
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
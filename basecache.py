@@ -0,0 +1,98 @@
+try:
+    import sys
+    import os
+    import glob
+    import hashlib
+    import json
+    import subprocess
+except ImportError as e:
+    print(f"[X] Failed to load required module, likely not installed: {e}")
+    try:
+        sys.exit(1)
+    except:
+        exit(1)
+
+
+# Cache of debootstrap base root filesystems.
+#
+# Every entry is a zstd compressed tarball named after a fingerprint of the
+# inputs that decide what debootstrap produces. Restoring an entry is a lot
+# cheaper than bootstrapping from the mirror again.
+
+
+def fingerprint(release, mirror, arch, include):
+    """Return the cache key for a debootstrap run with the given inputs.
+
+    The package lists are left out on purpose, they are only filled in by a
+    later phase and the phases after the base bring the packages up to date.
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps({
+        "release": release,
+        "mirror": mirror,
+        "arch": arch,
+        "include": sorted(include),
+    }, sort_keys=True).encode())
+    return digest.hexdigest()[:32]
+
+
+def entry_path(cache_dir, key):
+    return os.path.join(cache_dir, f"{key}.tar.zst")
+
+
+def restore(cache_dir, key, dest):
+    """Extract the cached base for key into dest, returns False on a miss."""
+    path = entry_path(cache_dir, key)
+    if not os.path.exists(path):
+        return False
+
+    subprocess.run(["tar",
+                        "--numeric-owner", "--xattrs", "--xattrs-include=*", "--acls",
+                        "-I", "zstd -T0",
+                        "-xpf", path,
+                        "-C", dest],
+                    check=True)
+
+    # Bump the mtime so eviction drops the least recently used entries first
+    os.utime(path)
+    return True
+
+
+def store(cache_dir, key, src):
+    """Pack src into the cache under key."""
+    os.makedirs(cache_dir, exist_ok=True)
+    path = entry_path(cache_dir, key)
+    tmp = path + ".tmp"
+
+    try:
+        subprocess.run(["tar",
+                            "--numeric-owner", "--xattrs", "--xattrs-include=*", "--acls",
+                            "-I", "zstd -T0 -3",
+                            "-cpf", tmp,
+                            "-C", src,
+                            "."],
+                        check=True)
+        os.rename(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def evict(cache_dir, max_size):
+    """Remove the least recently used entries until the cache fits in max_size bytes."""
+    entries = []
+    for path in glob.glob(os.path.join(cache_dir, "*.tar.zst")):
+        st = os.stat(path)
+        entries.append((st.st_mtime, st.st_size, path))
+
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+
+    removed = []
+    while entries and total > max_size:
+        _, size, path = entries.pop(0)
+        os.remove(path)
+        total -= size
+        removed.append(path)
+
+    return removed
@@ -0,0 +1,221 @@
+try:
+    import sys
+    import os
+    import argparse
+    import glob
+    import json
+    import re
+    import select
+    import shutil
+    import subprocess
+    import tempfile
+    import time
+except ImportError as e:
+    print(f"[X] Failed to load required module, likely not installed: {e}")
+    try:
+        sys.exit(1)
+    except:
+        exit(1)
+
+
+# Headless boot time benchmark for the built ISO.
+#
+# Boots every casper entry of the ISO's grub.cfg under QEMU with software
+# emulation, so no KVM is needed. The kernel and initrd are taken out of the
+# ISO and started directly with the cmdline of the entry, without quiet and
+# splash and with the serial console added, while the ISO itself is attached
+# as the CD-ROM casper boots from. Timestamps of the boot milestones are taken
+# from the serial console, relative to the start of QEMU, and written to JSON
+# so ISO builds can be compared over time.
+
+# Kernel parameter that makes the profile script of the image log LAUNCH_MARKER to the
+# kernel log at critical priority, which the console prints whatever kernel.printk is
+BOOT_MARK_PARAMETER = "passkill.bootmark"
+LAUNCH_MARKER = "PASSKILL-BOOT-MARK launch"
+
+# First match of each milestone on the serial console, default-target takes the
+# last target reached before the launch
+MILESTONES = {
+    "kernel": re.compile(r"Linux version \d"),
+    "squashfs": re.compile(r"loop\d+: detected capacity change|squashfs: version"),
+    "default-target": re.compile(r"Reached target .*(Multi-User System|Graphical Interface)"),
+    "passkill": re.compile(re.escape(LAUNCH_MARKER)),
+}
+DROPPED_PARAMETERS = ["quiet", "splash"]
+MENUENTRY = re.compile(r'menuentry\s+(["\'])(?P<title>.*?)\1\s*\{(?P<body>.*?)\n\s*\}', re.S)
+
+
+def newest_iso(directory):
+    isos = sorted(glob.glob(os.path.join(directory, "PassKill-*.iso")), key=os.path.getmtime)
+    return isos[-1] if isos else None
+
+
+def extract(iso, paths, dest):
+    """Copy paths out of the ISO into dest, returns their local paths."""
+    command = ["xorriso", "-osirrox", "on", "-indev", iso]
+    local = []
+    for path in paths:
+        local.append(os.path.join(dest, os.path.basename(path)))
+        command += ["-extract", path, local[-1]]
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return local
+
+
+def casper_entries(grub_cfg):
+    """Return [(title, kernel, initrd, parameters)] for every menu entry that boots casper."""
+    entries = []
+    for match in MENUENTRY.finditer(grub_cfg):
+        kernel = initrd = None
+        parameters = []
+        for line in match["body"].splitlines():
+            words = line.split()
+            if words[:1] == ["linux"] and len(words) > 1:
+                kernel, parameters = words[1], words[2:]
+            elif words[:1] == ["initrd"] and len(words) > 1:
+                initrd = words[1]
+        if kernel and initrd and "boot=casper" in parameters:
+            entries.append((match["title"], kernel, initrd, parameters))
+    return entries
+
+
+def patch_cmdline(parameters):
+    """Drop quiet and splash and add the serial console and the boot mark, before --- when there is one."""
+    parameters = [parameter for parameter in parameters if parameter not in DROPPED_PARAMETERS]
+    added = ["console=tty0", "console=ttyS0,115200", BOOT_MARK_PARAMETER]
+    index = parameters.index("---") if "---" in parameters else len(parameters)
+    return " ".join(parameters[:index] + added + parameters[index:])
+
+
+def boot(iso, kernel, initrd, cmdline, memory, cpus, timeout, log):
+    """Boot once, returns ({milestone: seconds}, timed out)."""
+    command = ["qemu-system-x86_64", "-accel", "tcg", "-m", str(memory), "-smp", str(cpus),
+               "-display", "none", "-monitor", "none", "-serial", "stdio", "-no-reboot",
+               "-cdrom", iso, "-kernel", kernel, "-initrd", initrd, "-append", cmdline]
+
+    found = {}
+    start = time.time()
+    process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    buffer = b""
+    try:
+        while "passkill" not in found and time.time() - start < timeout and process.poll() is None:
+            ready, _, _ = select.select([process.stdout], [], [], 1.0)
+            if not ready:
+                continue
+            chunk = os.read(process.stdout.fileno(), 65536)
+            if not chunk:
+                break
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            now = round(time.time() - start, 3)
+            for line in lines:
+                text = line.decode(errors="replace").rstrip("\r")
+                log.write(f"{now:>10.3f} {text}\n")
+                for name, pattern in MILESTONES.items():
+                    if pattern.search(text) and (name not in found or name == "default-target"):
+                        found[name] = now
+    finally:
+        process.kill()
+        process.wait()
+
+    return found, "passkill" not in found
+
+
+def run(args):
+    iso = args.iso or newest_iso(os.path.join(os.getcwd(), "build"))
+    if not iso or not os.path.exists(iso):
+        print("[X] No ISO to boot, build one or pass its path.")
+        sys.exit(1)
+
+    for dep in ["qemu-system-x86_64", "xorriso"]:
+        if not shutil.which(dep):
+            print(f"[X] {dep} is not installed. Please install it to continue.")
+            sys.exit(1)
+
+    output = args.output or os.path.splitext(iso)[0] + ".boot.json"
+    work = tempfile.mkdtemp(prefix="bootbench-")
+    results = {}
+    try:
+        grub_cfg, = extract(iso, ["/isolinux/grub.cfg"], work)
+        with open(grub_cfg) as f:
+            entries = casper_entries(f.read())
+        if args.entry:
+            entries = [entry for entry in entries if entry[0] in args.entry]
+        if not entries:
+            print("[X] No casper menu entries to boot.")
+            sys.exit(1)
+
+        for title, kernel_path, initrd_path, parameters in entries:
+            directory = os.path.join(work, str(len(results)))
+            os.makedirs(directory)
+            kernel, initrd = extract(iso, [kernel_path, initrd_path], directory)
+            cmdline = patch_cmdline(parameters)
+
+            print(f"[*] Booting \"{title}\" with {cmdline}...")
+            log_path = os.path.splitext(output)[0] + f".{len(results)}.log"
+            with open(log_path, "w") as log:
+                milestones, timed_out = boot(iso, kernel, initrd, cmdline, args.memory, args.cpus, args.timeout, log)
+
+            results[title] = {"cmdline": cmdline, "milestones": milestones, "timed_out": timed_out, "log": log_path}
+            for name in MILESTONES:
+                print(f"    {name:<16} {milestones[name]:>9.1f}s" if name in milestones else f"    {name:<16} {'-':>10}")
+            if timed_out:
+                print(f"[X] PassKill did not start within {args.timeout}s, see {log_path}")
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    with open(output, "w") as f:
+        json.dump({
+            "iso": os.path.abspath(iso),
+            "iso_size": os.path.getsize(iso),
+            "iso_mtime": os.path.getmtime(iso),
+            "created": time.time(),
+            "accel": "tcg",
+            "memory": args.memory,
+            "cpus": args.cpus,
+            "entries": results,
+        }, f, indent=1)
+    print(f"[✓] Wrote boot times to {output}")
+    sys.exit(1 if any(result["timed_out"] for result in results.values()) else 0)
+
+
+def compare(args):
+    with open(args.old) as f:
+        old = json.load(f)["entries"]
+    with open(args.new) as f:
+        new = json.load(f)["entries"]
+
+    print(f"{'entry/milestone':<56} {'old':>10} {'new':>10} {'change':>10}")
+    for title, result in new.items():
+        for name in MILESTONES:
+            before = old.get(title, {}).get("milestones", {}).get(name)
+            after = result["milestones"].get(name)
+            if before is None or after is None:
+                continue
+            print(f"{title + '/' + name:<56} {before:>9.1f}s {after:>9.1f}s {after - before:>+9.1f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Boot the PassKill ISO under QEMU and record how long each boot milestone takes.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Boot every casper entry of an ISO and write the boot times to JSON.")
+    run_parser.add_argument("iso", nargs="?", help="ISO to boot, defaults to the newest one in build.")
+    run_parser.add_argument("--entry", action="append", default=[], help="Title of a menu entry to boot, can be given more than once, all casper entries by default.")
+    run_parser.add_argument("--memory", type=int, default=6144, help="Memory of the virtual machine in MiB, the RAM entries copy the squashfs into it.")
+    run_parser.add_argument("--cpus", type=int, default=2, help="Number of virtual CPUs.")
+    run_parser.add_argument("--timeout", type=int, default=1800, help="Seconds to wait for PassKill to start.")
+    run_parser.add_argument("--output", default=None, help="Where to write the JSON, defaults to next to the ISO.")
+
+    compare_parser = commands.add_parser("compare", help="Compare the boot times of two runs.")
+    compare_parser.add_argument("old", help="Boot times of the reference ISO.")
+    compare_parser.add_argument("new", help="Boot times of the ISO to check.")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    else:
+        compare(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,304 @@
+try:
+    import sys
+    import os
+    import argparse
+    import ctypes
+    import fnmatch
+    import hashlib
+    import json
+    import mmap
+    import stat
+    import subprocess
+    import tempfile
+    import manifest
+except ImportError as e:
+    print(f"[X] Failed to load required module, likely not installed: {e}")
+    try:
+        sys.exit(1)
+    except:
+        exit(1)
+
+
+# Boot order layout for filesystem.squashfs.
+#
+# mksquashfs stores files with a higher -sort priority first, so giving the
+# files read during boot a high priority packs them together at the front of
+# the image instead of scattering them in directory order. The files come from
+# a boot access list recorded on a booted ISO, or from the dpkg file lists of
+# the packages that are known to run early. The measure command mounts an image
+# with a cold cache, reads the boot files and reports how contiguous the parts
+# of the image it had to read were.
+
+# Priorities of the package groups the heuristic puts first, mksquashfs allows -32768 to 32767
+BOOT_PACKAGES = [
+    (30000, ["linux-modules-*", "kmod", "libkmod2", "udev", "libudev1", "systemd", "systemd-sysv", "libsystemd*",
+             "libc6", "libselinux1", "libmount1", "libblkid1", "libcap2", "libcrypt1", "dbus*", "libdbus-1-3", "casper", "plymouth*"]),
+    (20000, ["python3*", "libpython3*", "libffi8", "libssl3*", "zlib1g", "libexpat1", "network-manager", "libnm0", "sudo"]),
+    (10000, ["gnome-shell*", "mutter*", "libmutter-*", "gjs", "libgjs*", "libglib2.0-*", "libgtk-3-*", "libgtk-4-*",
+             "libmozjs-*", "libgl1*", "libegl*", "libgbm1", "libdrm*", "mesa-*", "libwayland-*", "fonts-cantarell", "adwaita-icon-theme"]),
+]
+# Paths that do not belong to a package, relative to the root
+BOOT_PATHS = [(20000, "passkill"), (20000, "etc")]
+ACCESS_PRIORITY = 32000
+
+MAX_SYMLINKS = 40
+PROT_READ = 1
+MAP_SHARED = 1
+
+
+def resolve(root, path):
+    """Resolve path inside root like a chroot would, returns it relative to root or None."""
+    parts = [p for p in path.split("/") if p not in ("", ".")]
+    resolved = []
+    hops = 0
+
+    while parts:
+        part = parts.pop(0)
+        if part == "..":
+            if resolved:
+                resolved.pop()
+            continue
+
+        current = os.path.join(root, *resolved, part)
+        try:
+            st = os.lstat(current)
+        except OSError:
+            return None
+
+        if stat.S_ISLNK(st.st_mode):
+            hops += 1
+            if hops > MAX_SYMLINKS:
+                return None
+            target = os.readlink(current)
+            if target.startswith("/"):
+                resolved = []
+            parts = [p for p in target.split("/") if p not in ("", ".")] + parts
+        else:
+            resolved.append(part)
+
+    return "/".join(resolved)
+
+
+def package_lists(root):
+    """Return {package name: path of its dpkg file list}."""
+    info = os.path.join(root, "var", "lib", "dpkg", "info")
+    lists = {}
+    for name in os.listdir(info):
+        if name.endswith(".list"):
+            lists[name[:-5].split(":")[0]] = os.path.join(info, name)
+    return lists
+
+
+def heuristic(root):
+    """Return {path: priority} for the files of boot critical packages and paths."""
+    priorities = {}
+    lists = package_lists(root)
+
+    for priority, patterns in BOOT_PACKAGES:
+        for package, list_path in lists.items():
+            if not any(fnmatch.fnmatchcase(package, pattern) for pattern in patterns):
+                continue
+            with open(list_path, errors="replace") as f:
+                for line in f:
+                    path = resolve(root, line.strip())
+                    if path and priorities.get(path, -1) < priority:
+                        priorities[path] = priority
+
+    for priority, top in BOOT_PATHS:
+        for dirpath, dirs, files in os.walk(os.path.join(root, top)):
+            for file in files:
+                path = os.path.relpath(os.path.join(dirpath, file), root)
+                if priorities.get(path, -1) < priority:
+                    priorities[path] = priority
+
+    return priorities
+
+
+def read_access_list(path):
+    """Return the paths of a recorded boot access list or sort file, in order."""
+    paths = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            # Sort files carry a priority after the path
+            parts = line.rsplit(" ", 1)
+            if len(parts) == 2 and parts[1].lstrip("-").isdigit():
+                line = parts[0]
+            paths.append(line)
+    return paths
+
+
+def generate(root, output, access_list=None, excludes=()):
+    """Write a mksquashfs sort file for root, returns (number of files, digest of the sort file)."""
+    priorities = heuristic(root)
+
+    if access_list:
+        # Recorded files go before everything else, in the order they were read
+        recorded = read_access_list(access_list)
+        for index, path in enumerate(recorded):
+            path = resolve(root, path)
+            if path:
+                priorities[path] = max(ACCESS_PRIORITY - index, ACCESS_PRIORITY - 1000)
+
+    lines = []
+    for path, priority in sorted(priorities.items(), key=lambda item: (-item[1], item[0])):
+        if manifest.excluded(path, excludes) or any(c.isspace() or c == "\\" for c in path):
+            continue
+        try:
+            if not stat.S_ISREG(os.lstat(os.path.join(root, path)).st_mode):
+                continue
+        except OSError:
+            continue
+        lines.append(f"{path} {priority}\n")
+
+    data = "".join(lines)
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        f.write(data)
+    return len(lines), hashlib.sha256(data.encode()).hexdigest()
+
+
+def residency(path):
+    """Return a list with one entry per page of path, truthy when the page is in the page cache."""
+    size = os.path.getsize(path)
+    if not size:
+        return []
+
+    libc = ctypes.CDLL(None, use_errno=True)
+    libc.mmap.restype = ctypes.c_void_p
+    libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_long]
+    libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+    libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p]
+
+    pages = (size + mmap.PAGESIZE - 1) // mmap.PAGESIZE
+    vector = (ctypes.c_ubyte * pages)()
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        address = libc.mmap(None, size, PROT_READ, MAP_SHARED, fd, 0)
+        if address in (None, ctypes.c_void_p(-1).value):
+            raise OSError(ctypes.get_errno(), f"mmap failed for {path}")
+        try:
+            if libc.mincore(address, size, vector) != 0:
+                raise OSError(ctypes.get_errno(), f"mincore failed for {path}")
+        finally:
+            libc.munmap(address, size)
+    finally:
+        os.close(fd)
+
+    return [page & 1 for page in vector]
+
+
+def record(root, output):
+    """Write every file under root that has pages in the page cache, run it on a booted ISO."""
+    count = 0
+    with open(output, "w") as f:
+        stack = [""]
+        while stack:
+            rel = stack.pop()
+            try:
+                it = os.scandir(os.path.join(root, rel) if rel else root)
+            except OSError:
+                continue
+            with it:
+                for entry in sorted(it, key=lambda entry: entry.name):
+                    path = f"{rel}/{entry.name}" if rel else entry.name
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(path)
+                        elif entry.is_file(follow_symlinks=False) and any(residency(entry.path)):
+                            f.write(path + "\n")
+                            count += 1
+                    except OSError:
+                        continue
+    return count
+
+
+def drop_caches():
+    os.sync()
+    with open("/proc/sys/vm/drop_caches", "w") as f:
+        f.write("3")
+
+
+def measure(image, paths):
+    """Read paths from image with a cold cache and describe the image pages that were read."""
+    mountpoint = tempfile.mkdtemp(prefix="bootsort-")
+    drop_caches()
+    subprocess.run(["mount", "-t", "squashfs", "-o", "loop,ro", image, mountpoint], check=True)
+    try:
+        # Reading the superblock and tables on mount is not part of the boot path
+        baseline = residency(image)
+
+        read = 0
+        for path in paths:
+            try:
+                with open(os.path.join(mountpoint, path), "rb") as f:
+                    while chunk := f.read(1024 * 1024):
+                        read += len(chunk)
+            except OSError:
+                continue
+
+        after = residency(image)
+    finally:
+        subprocess.run(["umount", mountpoint])
+        os.rmdir(mountpoint)
+
+    pages = [index for index, (before, now) in enumerate(zip(baseline, after)) if now and not before]
+    if not pages:
+        return {"files": len(paths), "bytes": read, "pages": 0, "extents": 0, "span": 0, "density": 0.0, "front": 0.0}
+
+    extents = 1 + sum(1 for a, b in zip(pages, pages[1:]) if b != a + 1)
+    span = pages[-1] - pages[0] + 1
+    return {
+        "files": len(paths),
+        "bytes": read,
+        "pages": len(pages),
+        "extents": extents,
+        "span": span * mmap.PAGESIZE,
+        "density": len(pages) / span,
+        # How far into the image the boot path starts, 0 is the very front
+        "front": pages[0] / len(after),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Boot order layout for the PassKill squashfs.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    generate_parser = commands.add_parser("generate", help="Write a mksquashfs sort file for a root tree.")
+    generate_parser.add_argument("root", help="Root tree the squashfs is built from.")
+    generate_parser.add_argument("output", help="Sort file to write.")
+    generate_parser.add_argument("--access-list", help="Boot access list recorded with the record command.")
+    generate_parser.add_argument("--exclude", action="append", default=[], help="mksquashfs wildcard to leave out, can be given more than once.")
+
+    record_parser = commands.add_parser("record", help="Record the files read during boot, run right after booting the ISO.")
+    record_parser.add_argument("output", help="Boot access list to write.")
+    record_parser.add_argument("--root", default="/rofs", help="Mount point of the squashfs on the booted system.")
+
+    measure_parser = commands.add_parser("measure", help="Measure how contiguous the boot files are in an image, needs root.")
+    measure_parser.add_argument("image", help="filesystem.squashfs to measure.")
+    measure_parser.add_argument("paths", help="Sort file or boot access list with the boot files.")
+    measure_parser.add_argument("--json", action="store_true", help="Print the result as JSON.")
+
+    args = parser.parse_args()
+
+    if args.command == "generate":
+        count, _ = generate(args.root, args.output, args.access_list, args.exclude)
+        print(f"[✓] Wrote {count} boot files to {args.output}")
+    elif args.command == "record":
+        count = record(args.root, args.output)
+        print(f"[✓] Recorded {count} files read since boot to {args.output}")
+    else:
+        result = measure(args.image, read_access_list(args.paths))
+        if args.json:
+            print(json.dumps(result, indent=1))
+        else:
+            print(f"[*] {result['files']} files, {result['bytes'] / 1048576:.1f} MiB read")
+            print(f"[*] {result['pages'] * mmap.PAGESIZE / 1048576:.1f} MiB of the image in {result['extents']} extents over {result['span'] / 1048576:.1f} MiB")
+            print(f"[*] Density {result['density'] * 100:.1f}%, starting {result['front'] * 100:.1f}% into the image")
+
+
+if __name__ == "__main__":
+    main()
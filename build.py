@@ -6,6 +6,31 @@ try:
     import traceback
     import time
     import datetime
+    import argparse
+    import errno
+    import threading
+    import json
+    import functools
+    import concurrent.futures
+    import hashlib
+    import glob
+    import tempfile
+    import basecache
+    import aptproxy
+    import buildtrace
+    import manifest
+    import bootsort
+    import squashlayers
+    import plymouthatlas
+    import plymouthbackground
+    import packagesizes
+    import imagehash
+    import layers
+    import chrootsession
+    import membudget
+    import stepgraph
+    import artifacts
+    import chroot
 except ImportError as e:
     print(f"[X] Failed to load required module, likely not installed: {e}")
     try:
@@ -13,12 +38,22 @@ except ImportError as e:
     except:
         exit(1)
 
+parser = argparse.ArgumentParser(description="Build the PassKill live ISO.")
+parser.add_argument("--no-cache", action="store_true", help="Rebuild the base and every phase instead of reusing cached layers.")
+parser.add_argument("--relock", action="store_true", help="Resolve the package plans again and rewrite their lock files, implies --no-cache.")
+parser.add_argument("--offline", action="store_true", help="Build from the download store and the apt proxy store only, without the network.")
+args = parser.parse_args()
+# Cached layers were installed from the old plans
+args.no_cache = args.no_cache or args.relock
+
+
 if os.geteuid() != 0:
     print("[X] This script must be run as root.")
     sys.exit(1)
 
 
 delta = time.time()
+trace = buildtrace.Trace()
 
 DATE = datetime.datetime.now().strftime("%Y.%m.%d")
 RELEASE_CODE_NAME="plucky"
@@ -27,9 +62,57 @@ CHROOT_DIR=os.path.join(os.getcwd(), "chroot")
 IMAGE_DIR=os.path.join(os.getcwd(), "image")
 APT_CACHE=os.path.join(os.getcwd(), ".apt-cache")
 APT_LISTS=os.path.join(os.getcwd(), ".apt-lists")
+APT_LISTS_STATE=os.path.join(os.getcwd(), ".apt-lists-state")
+APT_LISTS_TTL=6 * 60 * 60
+APT_DEB_SRC=False
+BASE_CACHE=os.path.join(os.getcwd(), ".base-cache")
+BASE_CACHE_SIZE=8 * 1024 * 1024 * 1024
+LAYER_DIR=os.path.join(os.getcwd(), ".layers")
+DOWNLOAD_DIR=os.path.join(os.getcwd(), ".downloads")
+PACKAGE_LOCK_DIR=os.path.join(os.getcwd(), "package-locks")
+NTFS_PLUGIN_CACHE=os.path.join(os.getcwd(), ".ntfs-plugin-cache")
+STEP_WORKERS=4
+STEP_LIMITS={"network": 4, "apt-lists": 1, "dpkg": 1}
+RAM_BUILD="auto"
+RAM_DIR=os.path.join(os.getcwd(), ".ram")
+RAM_RESERVE=2 * 1024 * 1024 * 1024
+RAM_HEADROOM=1.25
+FAST_INSTALL=True
+FAST_INSTALL_TIMINGS=os.path.join(os.getcwd(), ".fast-install-timings.json")
+APT_PROXY=True
+APT_PROXY_PORT=3142
+APT_PROXY_STORE=os.path.join(os.getcwd(), ".apt-proxy")
+APT_PROXY_SIZE=32 * 1024 * 1024 * 1024
+APT_PROXY_OFFLINE=False
+ARCH="amd64"
+DEBOOTSTRAP_INCLUDE=["python3", "python3-requests"]
 ISO_VOLID=f"PassKill-{DATE}"
 OUTPUT=os.path.join(os.getcwd(), "build", f"PassKill-{DATE}.iso")
 MD5_OUTPUT=os.path.join(os.getcwd(), "build", f"PassKill-{DATE}.iso.md5")
+SHA256_OUTPUT=os.path.join(os.getcwd(), "build", f"PassKill-{DATE}.iso.sha256")
+BLAKE2_OUTPUT=os.path.join(os.getcwd(), "build", f"PassKill-{DATE}.iso.b2")
+ISO_BLAKE2=False
+ISO_STREAM_HASH=True
+SQUASHFS_CACHE=os.path.join(os.getcwd(), ".squashfs-cache")
+SQUASHFS_OPTIONS=["-comp", "zstd", "-b", "1M"]
+SQUASHFS_PROFILE=None
+SQUASHFS_EXCLUDES=["image", "var/cache/apt/archives/*", "root/*", "root/.*", "tmp/*", "tmp/.*", "swapfile"]
+LAYERED_SQUASHFS=False
+TORAM_MEDIA_SPEED=20
+INITRAMFS_MODULES="most"
+INITRAMFS_COMPRESS="zstd"
+INITRAMFS_COMPRESS_LEVEL=None
+INITRAMFS_PROFILE=None
+PLYMOUTH_ATLAS=True
+PLYMOUTH_BACKGROUND_SIZES=["1366x768", "1920x1080", "2560x1440", "3840x2160"]
+PACKAGE_SIZES=True
+PACKAGE_SIZE_BUDGETS={}
+BOOT_SORT=True
+BOOT_ACCESS_LIST=os.path.join(os.getcwd(), "boot-access.txt")
+IMAGE_SHA256=False
+HASH_WORKERS=os.cpu_count()
+VARIANTS=["full"]
+TRACE_OUTPUT=os.path.join(os.getcwd(), "build", f"PassKill-{DATE}.trace.json")
 
 
 try:
@@ -38,172 +121,766 @@ except:
     pass
 
 
+# Offline builds get packages from the apt proxy store and everything else from the download store
+if args.offline:
+    APT_PROXY_OFFLINE = True
+
+# Part of the layer keys, chroot.py gets them through PASSKILL_FAST_INSTALL and PASSKILL_LAYERED_SQUASHFS
+chroot.FAST_INSTALL = bool(FAST_INSTALL)
+chroot.LAYERED_SQUASHFS = bool(LAYERED_SQUASHFS)
+
+
+ISO_CHECKSUMS={"md5": MD5_OUTPUT, "sha256": SHA256_OUTPUT}
+if ISO_BLAKE2:
+    ISO_CHECKSUMS["blake2b"] = BLAKE2_OUTPUT
+ISO_ALGORITHMS=tuple(ISO_CHECKSUMS)
+
+
+# Options recommended by squashbench.py win over SQUASHFS_OPTIONS once SQUASHFS_PROFILE points at them
+if SQUASHFS_PROFILE:
+    try:
+        with open(SQUASHFS_PROFILE) as f:
+            SQUASHFS_OPTIONS = json.load(f)["options"]
+        print(f"[*] Using squashfs options from {SQUASHFS_PROFILE}: {' '.join(SQUASHFS_OPTIONS)}")
+    except (OSError, ValueError, KeyError) as e:
+        print(f"[X] Ignoring squashfs profile {SQUASHFS_PROFILE}: {e}")
+
+
+# The profile recommended by initramfsbench.py wins over the INITRAMFS_ settings once INITRAMFS_PROFILE points at it
+if INITRAMFS_PROFILE:
+    try:
+        with open(INITRAMFS_PROFILE) as f:
+            profile = json.load(f)
+        INITRAMFS_MODULES, INITRAMFS_COMPRESS, INITRAMFS_COMPRESS_LEVEL = profile["modules"], profile["compress"], profile["level"]
+        print(f"[*] Using initramfs profile from {INITRAMFS_PROFILE}: MODULES={INITRAMFS_MODULES} {INITRAMFS_COMPRESS}" + (f":{INITRAMFS_COMPRESS_LEVEL}" if INITRAMFS_COMPRESS_LEVEL is not None else ""))
+    except (OSError, ValueError, KeyError) as e:
+        print(f"[X] Ignoring initramfs profile {INITRAMFS_PROFILE}: {e}")
+
+# Part of the layer keys, chroot.py gets it through PASSKILL_INITRAMFS_PROFILE
+chroot.INITRAMFS_PROFILE = {"modules": INITRAMFS_MODULES, "compress": INITRAMFS_COMPRESS, "level": INITRAMFS_COMPRESS_LEVEL}
+
+
 print(f'[*] Beginning build for {ISO_VOLID}...')
 
 
 os.makedirs(APT_CACHE, exist_ok=True)
 os.makedirs(APT_LISTS, exist_ok=True)
+os.makedirs(APT_LISTS_STATE, exist_ok=True)
+os.makedirs(LAYER_DIR, exist_ok=True)
+os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+os.makedirs(PACKAGE_LOCK_DIR, exist_ok=True)
 
 
-if os.path.exists(OUTPUT):
-    if input(f"Output file \"{OUTPUT}\" already exists, continue? [Y/n]: ").lower() == "y":
-        os.remove(OUTPUT)
-    else:
-        print("[*] Exiting...")
-        sys.exit(0)
+class Variant:
+    """The paths and names of one image variant.
 
+    The first variant in VARIANTS keeps the plain names, the others get their
+    name appended so every variant has its own root, image tree and ISO.
+    """
 
-print("[*] Checking dependencies...")
-dependencies = ["debootstrap", "mksquashfs", "xorriso"]
+    CHECKSUM_SUFFIXES = {"md5": ".md5", "sha256": ".sha256", "blake2b": ".b2"}
 
-for dep in dependencies:
-    if not shutil.which(dep):
-        print(f"[X] {dep} is not installed. Please install it to continue.")
+    def __init__(self, name, primary):
+        suffix = "" if primary else f"-{name}"
+        self.name = name
+        self.root = CHROOT_DIR + suffix
+        self.image_dir = IMAGE_DIR + suffix
+        self.volid = (ISO_VOLID + suffix)[:32]
+        self.squashfs_cache = SQUASHFS_CACHE if primary else os.path.join(SQUASHFS_CACHE, name)
+        self.apt_cache = APT_CACHE + suffix
+        self.ntfs_plugin = os.path.join(NTFS_PLUGIN_CACHE, "variants", name)
+        if primary:
+            self.output = OUTPUT
+            self.checksums = dict(ISO_CHECKSUMS)
+        else:
+            self.output = os.path.splitext(OUTPUT)[0] + suffix + ".iso"
+            self.checksums = {algorithm: self.output + self.CHECKSUM_SUFFIXES[algorithm] for algorithm in ISO_CHECKSUMS}
+        self.package_sizes = os.path.splitext(self.output)[0] + ".sizes.json"
+        self.tag = "" if primary else f"[{name}] "
+        self.prefix = "" if primary else f"{name}/"
+
+    def label(self, name):
+        """Name of a trace span of this variant."""
+        return self.prefix + name
+
+
+for name in VARIANTS:
+    if name not in chroot.VARIANTS:
+        print(f"[X] Unknown variant {name}, variants: {', '.join(chroot.VARIANTS)}")
         sys.exit(1)
 
-try:
-    print("[*] Creating chroot environment...")
+variants = [Variant(name, index == 0) for index, name in enumerate(VARIANTS)]
+for variant in variants:
+    os.makedirs(variant.apt_cache, exist_ok=True)
+    os.makedirs(variant.ntfs_plugin, exist_ok=True)
+
+
+for variant in variants:
+    if os.path.exists(variant.output):
+        if input(f"Output file \"{variant.output}\" already exists, continue? [Y/n]: ").lower() == "y":
+            os.remove(variant.output)
+        else:
+            print("[*] Exiting...")
+            sys.exit(0)
+
+
+def prepare_root(root, variant):
+    # deb-src only when asked for, nothing is built from source and every update would fetch their indexes too
+    types = ["deb", "deb-src"] if APT_DEB_SRC else ["deb"]
+    with open(os.path.join(root, "etc", "apt", "sources.list"), "w") as f:
+        f.write("\n\n".join("\n".join(f"{kind} {MIRROR} {suite} main restricted universe multiverse" for kind in types)
+                             for suite in (RELEASE_CODE_NAME, f"{RELEASE_CODE_NAME}-security", f"{RELEASE_CODE_NAME}-updates")))
+
+    os.makedirs(os.path.join(root, "usr", "share", "plymouth", "themes"), exist_ok=True)
+    subprocess.run(["cp", "-r", os.path.join(os.getcwd(), "plymouth"), os.path.join(root, "usr", "share", "plymouth", "themes", "passkill")], check=True)
+    # The spinner frames go into the initramfs with the theme, one atlas loads faster than a file per frame
+    if PLYMOUTH_ATLAS:
+        with trace.span("plymouth-atlas") as span:
+            report = plymouthatlas.build(os.path.join(root, "usr", "share", "plymouth", "themes", "passkill"))
+            if report:
+                span.update(report)
+                plymouthatlas.print_report(report)
+    # Plymouth scales the background on every boot unless a copy already has the size of the screen
+    if PLYMOUTH_BACKGROUND_SIZES:
+        with trace.span("plymouth-backgrounds") as span:
+            report = plymouthbackground.build(os.path.join(root, "usr", "share", "plymouth", "themes", "passkill"), PLYMOUTH_BACKGROUND_SIZES, TORAM_MEDIA_SPEED)
+            if report:
+                span.update(report)
+                plymouthbackground.print_report(report)
+    os.makedirs(os.path.join(root, 'usr', 'share', 'icons'), exist_ok=True)
+    subprocess.run(["cp", os.path.join(os.getcwd(), 'exit_gnome.png'), os.path.join(root, 'usr', 'share', 'icons', 'exit_gnome.png')], check=True)
+    subprocess.run(["chown", "-R", "root:root", os.path.join(root, "usr", "share", "plymouth", "themes", "passkill")], check=True)
+
+
+def stamp_release(root, variant):
+    with open(os.path.join(root, "release"), "w") as f:
+        f.write(variant.volid)
+
+
+def chroot_binds(variant=None):
+    """Return the host directories bind mounted into the root jail.
+
+    apt locks its archives directory, so variants other than the first get
+    their own, downloads are still shared through the apt proxy.
+    """
+    archives = variant.apt_cache if variant else APT_CACHE
+    binds = [(archives, "/var/cache/apt/archives"), (APT_LISTS, "/var/lib/apt/lists"), (APT_LISTS_STATE, chroot.APT_LISTS_STATE), (DOWNLOAD_DIR, chroot.DOWNLOAD_DIR), (PACKAGE_LOCK_DIR, chroot.PACKAGE_LOCK_DIR)]
+    if variant:
+        binds.append((variant.ntfs_plugin, chroot.NTFS_PLUGIN_DIR))
+    return binds
+
+
+def host_path(path, variant=None):
+    """Return where a path in the root jail that is bind mounted from the host is on the host."""
+    for source, target in chroot_binds(variant):
+        if path == target or path.startswith(target + "/"):
+            return os.path.join(source, os.path.relpath(path, target))
+    raise ValueError(f"{path} is not bind mounted from the host")
+
+
+def fetch(name):
+    """Bring chroot.DOWNLOADS[name] up to date in the download store and return its hash, commit or wheel names.
+
+    Pinned files are downloaded again with --no-cache.
+    """
+    entry = chroot.DOWNLOADS[name]
+    print(f"[*] {'Checking' if args.offline else 'Updating'} download {name}...")
     try:
-        os.makedirs(CHROOT_DIR, exist_ok=False)
+        with trace.span("fetch-" + name, "download", kind=entry["kind"], offline=args.offline) as span:
+            result = artifacts.fetch(DOWNLOAD_DIR, name, entry, offline=args.offline, refresh=args.no_cache)
+            span["result"] = result
     except Exception as e:
         traceback.print_exc()
-        print("[X] Failed to create chroot folder, might already exist.")
+        print(f"[X] Failed to fetch {name}: {e}")
         sys.exit(1)
+    return result
+
 
+def download_reference(name):
     try:
-        subprocess.run(["debootstrap", 
-                            "--arch=amd64", 
-                            "--variant=minbase", 
-                            "--cache-dir="+APT_CACHE,
-                            "--include=python3,python3-requests",
-                            RELEASE_CODE_NAME, 
-                            CHROOT_DIR, 
-                            MIRROR],
-                        check=True)
+        return artifacts.reference(DOWNLOAD_DIR, name, chroot.DOWNLOADS[name], offline=args.offline)
     except Exception as e:
         traceback.print_exc()
-        print(f"[X] Failed to create chroot environment")
+        print(f"[X] Failed to look up download {name}: {e}")
         sys.exit(1)
-    
-    print("[*] Preparing chroot...")
+
+
+def download_references():
+    """Return {name: what the layer keys of the phases reading it use}, see artifacts.reference.
+
+    Only the remote HEAD of each repository is looked up here, the downloads
+    themselves are build steps that run alongside the apt phases.
+    """
+    names = list(chroot.DOWNLOADS)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(names)) as pool:
+        return dict(zip(names, pool.map(download_reference, names)))
+
+
+def download_inputs(name):
+    """Return the names of the downloads phase name reads, directly or through a file built from one."""
+    found = []
+    for path in PHASE_SPECS[name]["inputs"]:
+        if os.path.dirname(path) == chroot.DOWNLOAD_DIR and os.path.basename(path) in chroot.DOWNLOADS:
+            found.append(os.path.basename(path))
+        elif path in BUILT_INPUTS:
+            found.append(BUILT_INPUTS[path])
+    return found
+
+
+def run_chroot_phase(root, name, variant=None):
+    for script in CHROOT_SCRIPTS:
+        subprocess.run(["cp", script, os.path.join(root, script)], check=True)
     try:
-        with open(os.path.join(CHROOT_DIR, "release"), "w") as f:
-            f.write(ISO_VOLID)
-
-        with open(os.path.join(CHROOT_DIR, "etc", "apt", "sources.list"), "w") as f:
-            f.write(f"""
-deb {MIRROR} {RELEASE_CODE_NAME} main restricted universe multiverse
-deb-src {MIRROR} {RELEASE_CODE_NAME} main restricted universe multiverse
-
-deb {MIRROR} {RELEASE_CODE_NAME}-security main restricted universe multiverse
-deb-src {MIRROR} {RELEASE_CODE_NAME}-security main restricted universe multiverse
-
-deb {MIRROR} {RELEASE_CODE_NAME}-updates main restricted universe multiverse
-deb-src {MIRROR} {RELEASE_CODE_NAME}-updates main restricted universe multiverse
-""".strip())
-        
-        subprocess.run(["cp", "chroot.py", os.path.join(CHROOT_DIR, "chroot.py")], check=True)
-        os.makedirs(os.path.join(CHROOT_DIR, "usr", "share", "plymouth", "themes"), exist_ok=True)
-        subprocess.run(["cp", "-r", os.path.join(os.getcwd(), "plymouth"), os.path.join(CHROOT_DIR, "usr", "share", "plymouth", "themes", "passkill")], check=True)
-        os.makedirs(os.path.join(CHROOT_DIR, 'usr', 'share', 'icons'), exist_ok=True)
-        subprocess.run(["cp", os.path.join(os.getcwd(), 'exit_gnome.png'), os.path.join(CHROOT_DIR, 'usr', 'share', 'icons', 'exit_gnome.png')], check=True)
-        subprocess.run(["chown", "-R", "root:root", os.path.join(CHROOT_DIR, "usr", "share", "plymouth", "themes", "passkill")], check=True)
-
-        DEV_DIR = os.path.join(CHROOT_DIR, "dev")
-
-        # mount a private /dev
-        subprocess.run(["mount", "-t", "tmpfs", "tmpfs", DEV_DIR], check=True)
-
-        # make essential device nodes
-        subprocess.run(["mknod", "-m", "666", os.path.join(DEV_DIR, "null"), "c", "1", "3"], check=True)
-        subprocess.run(["mknod", "-m", "666", os.path.join(DEV_DIR, "zero"), "c", "1", "5"], check=True)
-        subprocess.run(["mknod", "-m", "666", os.path.join(DEV_DIR, "random"), "c", "1", "8"], check=True)
-        subprocess.run(["mknod", "-m", "666", os.path.join(DEV_DIR, "urandom"), "c", "1", "9"], check=True)
-        subprocess.run(["mknod", "-m", "666", os.path.join(DEV_DIR, "tty"), "c", "5", "0"], check=True)
-        subprocess.run(["mknod", "-m", "600", os.path.join(DEV_DIR, "console"), "c", "5", "1"], check=True)
-        subprocess.run(["mknod", "-m", "666", os.path.join(DEV_DIR, "full"), "c", "1", "7"], check=True)
-        subprocess.run(["mknod", "-m", "666", os.path.join(DEV_DIR, "ptmx"), "c", "5", "2"], check=True)
-
-        # symlink fd -> /proc/self/fd
-        subprocess.run(["ln", "-s", "/proc/self/fd", os.path.join(DEV_DIR, "fd")], check=True)
-
-        subprocess.run(["mount", "-t", "tmpfs", "tmpfs", os.path.join(CHROOT_DIR, "run")], check=True)
-        subprocess.run(["mount", "--bind", APT_CACHE, os.path.join(CHROOT_DIR, "var", "cache", "apt", "archives")], check=True)
-        subprocess.run(["mount", "--bind", APT_LISTS, os.path.join(CHROOT_DIR, "var", "lib", "apt", "lists")], check=True)
-
-
-        print("[*] Entering chroot...")
+        environ = dict(os.environ, PASSKILL_FAST_INSTALL="1" if FAST_INSTALL else "0", PASSKILL_RELOCK="1" if args.relock else "0",
+                       PASSKILL_APT_LISTS_TTL=str(APT_LISTS_TTL), PASSKILL_INITRAMFS_PROFILE=json.dumps(chroot.INITRAMFS_PROFILE),
+                       PASSKILL_LAYERED_SQUASHFS="1" if LAYERED_SQUASHFS else "0")
+        if variant:
+            environ["PASSKILL_VARIANT"] = variant.name
+
+        # The jail's mounts live in a private mount namespace and vanish when chroot.py exits
+        with chrootsession.ChrootSession(root, chroot_binds(variant)) as session:
+            session.run(["/usr/bin/env", "python3", "chroot.py", name], check=True, env=environ)
+    finally:
+        for script in CHROOT_SCRIPTS:
+            os.remove(os.path.join(root, script))
+
+
+def plan_ram_build(chain):
+    """Mount a tmpfs on RAM_DIR when the rest of the build fits in memory, returns whether it did."""
+    if not RAM_BUILD:
+        return False
+
+    lowers = [layers.layer_root(LAYER_DIR, k) for k in chain]
+    root = os.path.join(CHROOT_DIR, "ram-plan")
+    base_size = membudget.disk_usage(lowers)
+
+    previous_root = previous_squashfs = install = None
+    cached_manifest = os.path.join(SQUASHFS_CACHE, "manifest.json")
+    cached = manifest.load(cached_manifest) if os.path.exists(cached_manifest) else None
+    cached_images = [os.path.join(SQUASHFS_CACHE, image) for image in cached.get("images", ["filesystem.squashfs"])] if cached else []
+    if cached and all(os.path.exists(image) for image in cached_images):
+        previous_root = cached["size"]
+        previous_squashfs = sum(os.path.getsize(image) for image in cached_images)
+    else:
+        os.makedirs(root, exist_ok=True)
+        layers.mount(root, lowers)
+        try:
+            install = membudget.install_size(root, chroot_binds(), chroot.PACKAGES)
+        except (OSError, subprocess.SubprocessError):
+            pass
+        finally:
+            layers.umount(root)
+            os.rmdir(root)
+
+    peak = membudget.estimate(base_size, install, previous_root, previous_squashfs)
+    free = membudget.available() - RAM_RESERVE
+
+    if peak is None:
+        if RAM_BUILD != True:
+            print("[*] No estimate of the build size yet, building on disk...")
+            return False
+        size = free
+    else:
+        # Variants build at the same time, each with its own phase layers and image tree
+        size = int(peak * RAM_HEADROOM * len(variants))
+        if size > free:
+            print(f"[*] The build needs about {size / 1073741824:.1f} GiB but only {free / 1073741824:.1f} GiB of memory is free, building on disk...")
+            return False
+
+    print(f"[*] Building in RAM with a {size / 1073741824:.1f} GiB tmpfs on {RAM_DIR}...")
+    membudget.mount(RAM_DIR, size)
+    return True
+
+
+def ram_scratch(chain):
+    """Plan the RAM build the first time it is needed, returns the scratch directory or None."""
+    global ram
+    with ram_lock:
+        if ram is None:
+            with trace.span("ram-plan") as span:
+                ram = span["ram"] = plan_ram_build(chain)
+    return RAM_DIR if ram else None
+
+
+def phase_specs(phases):
+    """Return ({name: spec}, {name: every phase it runs after}) for phases in build order.
+
+    The specs are filled in from chroot.PHASE_GRAPH. after only keeps the
+    phases a phase needs directly, so a run of phases that each need the one
+    before them keeps the layer keys it had when every phase ran in order.
+    """
+    names = [name for name, _, _ in phases]
+    specs = {}
+    ancestors = {}
+    for index, name in enumerate(names):
+        entry = chroot.PHASE_GRAPH.get(name, {})
+        after = entry.get("after", names[:index])
+        for dependency in after:
+            if dependency not in names[:index]:
+                raise ValueError(f"Phase {name} runs after {dependency}, which is not a phase before it")
+
+        indirect = set().union(*(ancestors[dependency] for dependency in after))
+        specs[name] = {
+            "after": [dependency for dependency in names[:index] if dependency in after and dependency not in indirect],
+            "inputs": list(entry.get("inputs", [])),
+            "outputs": list(entry.get("outputs", ["/"])),
+            "resources": list(entry.get("resources", [])),
+        }
+        ancestors[name] = set(after) | indirect
+    return specs, ancestors
+
+
+def phase_keys(phases, keys, variant=None):
+    """Add the layer key of every phase to keys, which holds the keys of the phases they run after."""
+    for name, func, kind in phases:
+        parent = ",".join(keys[dependency] for dependency in PHASE_SPECS[name]["after"]) or base_layer
+        # Variant phases carry the variant in their key, shared phases do not
+        key_name = f"{name}@{variant.name}" if variant else name
+        # The downloads a phase reads are part of its key, so a new commit or pinned file reruns it
+        values = [(download, downloads[download]) for download in download_inputs(name)]
+        if kind == "host":
+            keys[name] = layers.phase_key(parent, key_name, func, globals(), HOST_PHASE_INPUTS, values)
+        else:
+            inputs = CHROOT_PHASE_INPUTS + ([LISTS_GENERATION] if name == LISTS_PHASE and os.path.exists(LISTS_GENERATION) else [])
+            keys[name] = layers.phase_key(parent, key_name, func, vars(chroot), inputs, values)
+    return keys
+
+
+def phase_chain(keys, name=None):
+    """Return the layers below phase name bottom first, or every layer when name is None."""
+    return [base_layer] + [keys[other] for other, _, _ in PHASES if name is None or other in PHASE_ANCESTORS[name]]
+
+
+def run_phase(name, func, kind, keys, variant=None):
+    """Run one phase in its own layer on top of the phases it runs after, or reuse its finished layer."""
+    key = keys[name]
+    tag = variant.tag if variant else ""
+    label = variant.label(name) if variant else name
+    chain = phase_chain(keys, name)
+
+    if not args.no_cache and layers.is_complete(LAYER_DIR, key):
+        print(f"[*] {tag}Reusing layer for {name} ({key})")
+        with trace.span(label, "phase", kind=kind, key=key, cached=True):
+            return
+
+    scratch = ram_scratch(chain)
+    # Phases that run at the same time each get their own mount of the root
+    root = os.path.join(variant.root if variant else CHROOT_DIR, name)
+    os.makedirs(root, exist_ok=True)
+
+    print(f"[*] {tag}Running {name} ({key})...")
+    with trace.span(label, "phase", kind=kind, key=key, cached=False, fast_install=bool(FAST_INSTALL)):
         try:
-            subprocess.run(["chroot", CHROOT_DIR, "/usr/bin/env", "python3", "chroot.py"], check=True)
+            upper, work = layers.begin(LAYER_DIR, key, scratch)
+            layers.mount(root, [layers.layer_root(LAYER_DIR, k) for k in chain], upper, work)
+            try:
+                if kind == "host":
+                    func(root, variant)
+                else:
+                    run_chroot_phase(root, name, variant)
+            finally:
+                layers.umount(root)
+
+            layers.commit(LAYER_DIR, key, name, scratch)
         except Exception as e:
             traceback.print_exc()
-            print("[X] Failed to enter chroot")
+            layers.discard(LAYER_DIR, key)
+            if scratch:
+                layers.discard(scratch, key)
+            print(f"[X] {tag}Failed to run {name}, finished phases are kept and the next build resumes here.")
             sys.exit(1)
-        
+
+    if not os.path.ismount(root):
+        os.rmdir(root)
+
+
+def ntfs_plugin_key(root, variant):
+    """Return (key, commit, versions) of the ntfs-3g plugin that would be built in root.
+
+    The key covers the source commit, the ntfs-3g-dev and gcc versions apt
+    installs in root and the build task of chroot.py.
+    """
+    source = host_path(os.path.join(chroot.DOWNLOAD_DIR, "ntfs-3g-system-compression.git"), variant)
+    commit = subprocess.run(["git", "-C", source, "rev-parse", "HEAD"], check=True, stdout=subprocess.PIPE, text=True).stdout.strip()
+
+    with chrootsession.ChrootSession(root, chroot_binds(variant)) as session:
+        result = session.run(["apt-cache", "show", "--no-all-versions"] + NTFS_PLUGIN_VERSIONS,
+                             check=True, stdout=subprocess.PIPE, text=True, env=dict(os.environ, LC_ALL="C"))
+
+    versions = {}
+    package = None
+    for line in result.stdout.splitlines():
+        if line.startswith("Package: "):
+            package = line.split(": ", 1)[1]
+        elif line.startswith("Version: ") and package:
+            versions[package] = line.split(": ", 1)[1]
+
+    task = layers.phase_key("", NTFS_PLUGIN_TASK, chroot.TASKS[NTFS_PLUGIN_TASK], vars(chroot))
+    digest = hashlib.sha256()
+    for part in [commit, task] + [f"{package}={versions.get(package)}" for package in NTFS_PLUGIN_VERSIONS]:
+        digest.update(part.encode() + b"\n")
+    return digest.hexdigest()[:16], commit, versions
+
+
+def ntfs_plugin(variant, keys):
+    """Put the ntfs-3g system compression plugin where the install phase of variant reads it.
+
+    A cached build is reused while its key matches. Otherwise the plugin is
+    built in a throwaway overlay on top of the layers the install phase runs
+    on, so its build dependencies never touch a layer.
+    """
+    chain = phase_chain(keys, NTFS_PLUGIN_PHASE)
+    target = os.path.join(variant.ntfs_plugin, chroot.NTFS_PLUGIN)
+    root = os.path.join(variant.root, "ntfs-plugin")
+    scratch = tempfile.mkdtemp(prefix=".build-", dir=ram_scratch(chain) or NTFS_PLUGIN_CACHE)
+
+    try:
+        with trace.span(variant.label("ntfs-plugin")) as span:
+            upper = os.path.join(scratch, "root")
+            work = os.path.join(scratch, "work")
+            os.makedirs(upper)
+            os.makedirs(work)
+            os.makedirs(root, exist_ok=True)
+
+            layers.mount(root, [layers.layer_root(LAYER_DIR, k) for k in chain], upper, work)
+            try:
+                key, commit, versions = ntfs_plugin_key(root, variant)
+                cached = os.path.join(NTFS_PLUGIN_CACHE, key, chroot.NTFS_PLUGIN)
+                span["key"] = key
+                span["hit"] = not args.no_cache and os.path.exists(cached)
+
+                if span["hit"]:
+                    print(f"[*] {variant.tag}Reusing ntfs-3g-system-compression plugin ({key})")
+                else:
+                    print(f"[*] {variant.tag}Building ntfs-3g-system-compression {commit[:12]} with " + ", ".join(f"{package} {version}" for package, version in sorted(versions.items())) + f" ({key})...")
+                    run_chroot_phase(root, NTFS_PLUGIN_TASK, variant)
+            finally:
+                layers.umount(root)
+
+            if span["hit"]:
+                shutil.copy(cached, target)
+            else:
+                os.makedirs(os.path.dirname(cached), exist_ok=True)
+                shutil.copy(target, cached + ".tmp")
+                os.replace(cached + ".tmp", cached)
     except Exception as e:
         traceback.print_exc()
-        print("[X] Failed to prepare chroot")
+        print(f"[X] {variant.tag}Failed to build the ntfs-3g-system-compression plugin")
         sys.exit(1)
     finally:
-        print("[*] Unbinding chroot mounts...")
-        subprocess.run(["umount", "-l", os.path.join(CHROOT_DIR, "dev", "pts")], check=False)
-        subprocess.run(["umount", "-l", os.path.join(CHROOT_DIR, "proc")], check=False)
-        subprocess.run(["umount", "-l", os.path.join(CHROOT_DIR, "sys")], check=False)
-        subprocess.run(["umount", "-l", os.path.join(CHROOT_DIR, "dev")], check=False)
-        subprocess.run(["umount", "-l", os.path.join(CHROOT_DIR, "run")], check=False)
-        subprocess.run(["umount", "-l", os.path.join(CHROOT_DIR, "var", "cache", "apt", "archives")], check=False)
-        subprocess.run(["umount", "-l", os.path.join(CHROOT_DIR, "var", "lib", "apt", "lists")], check=False)
-        os.remove(os.path.join(CHROOT_DIR, "chroot.py"))
-    
-    
-    print("[*] Creating squashfs...")
+        shutil.rmtree(scratch, ignore_errors=True)
+        if os.path.isdir(root) and not os.path.ismount(root):
+            os.rmdir(root)
+
+
+def release_digest():
+    """Hash of the Release files in APT_LISTS, which change whenever any index does."""
+    digest = hashlib.sha256()
+    for path in sorted(glob.glob(os.path.join(APT_LISTS, "*Release"))):
+        digest.update(os.path.basename(path).encode())
+        with open(path, "rb") as f:
+            digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()
+
+
+def refresh_lists(keys):
+    """Update package lists older than APT_LISTS_TTL when the list update phase would be reused, returns whether they changed.
+
+    The update runs the phase in a throwaway overlay on top of its layers,
+    apt only downloads what changed since the last update. When the phase has
+    to run anyway it updates the lists itself.
+    """
     try:
-        os.rename(os.path.join(CHROOT_DIR, "image"), IMAGE_DIR)
-
-        subprocess.run(["mksquashfs", CHROOT_DIR, os.path.join(IMAGE_DIR, "casper", "filesystem.squashfs"), 
-                        "-noappend", "-no-duplicates", "-no-recovery", 
-                        "-wildcards", 
-                        "-comp", "zstd", "-b", "1M",
-                        "-e", "var/cache/apt/archives/*",
-                        "-e", "root/*",
-                        "-e", "root/.*",
-                        "-e", "tmp/*",
-                        "-e", "tmp/.*",
-                        "-e", "swapfile"])
-
-        size = subprocess.check_output(
-            ["du", "-sx", "--block-size=1", CHROOT_DIR],
-            text=True
-        ).split()[0]
-
-        print(size)
-
-        open(os.path.join(IMAGE_DIR, "casper", "filesystem.size"), "w").write(size)
+        with open(os.path.join(APT_LISTS_STATE, chroot.APT_LISTS_STAMP)) as f:
+            age = time.time() - json.load(f)["updated"]
+    except (OSError, ValueError, KeyError):
+        age = None
+
+    chain = phase_chain(keys, LISTS_PHASE) + [keys[LISTS_PHASE]]
+    if args.no_cache or not all(layers.is_complete(LAYER_DIR, key) for key in chain):
+        return False
+    if age is not None and age < APT_LISTS_TTL:
+        print(f"[*] Package lists are {age / 60:.0f} minutes old, skipping update...")
+        return False
+    if args.offline:
+        print("[*] Package lists are stale, but the build is offline...")
+        return False
+
+    print("[*] Package lists are stale, refreshing them...")
+    before = release_digest()
+    root = os.path.join(CHROOT_DIR, "refresh-lists")
+    scratch = tempfile.mkdtemp(prefix=".refresh-", dir=LAYER_DIR)
+    try:
+        with trace.span("refresh-lists", "apt") as span:
+            upper = os.path.join(scratch, "root")
+            work = os.path.join(scratch, "work")
+            os.makedirs(upper)
+            os.makedirs(work)
+            os.makedirs(root, exist_ok=True)
+
+            layers.mount(root, [layers.layer_root(LAYER_DIR, k) for k in chain[:-1]], upper, work)
+            try:
+                run_chroot_phase(root, LISTS_PHASE)
+            finally:
+                layers.umount(root)
+
+            span["changed"] = release_digest() != before
     except Exception as e:
         traceback.print_exc()
-        print("[X] Failed to create squashfs")
+        print("[X] Failed to refresh the package lists, building with the ones there are")
+        return False
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+        if os.path.isdir(root) and not os.path.ismount(root):
+            os.rmdir(root)
+
+    if span["changed"]:
+        print("[*] Package lists changed, running the phases from the list update on again...")
+        with open(LISTS_GENERATION, "w") as f:
+            f.write(release_digest())
+    return span["changed"]
+
+
+def link_or_copy(source, destination):
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy(source, destination)
+
+
+def mksquashfs_command(root, image, sort_file=None):
+    return (["mksquashfs", root, image,
+             "-noappend", "-no-duplicates", "-no-recovery",
+             "-wildcards"]
+            + SQUASHFS_OPTIONS
+            + [arg for pattern in SQUASHFS_EXCLUDES for arg in ("-e", pattern)]
+            + (["-sort", sort_file] if sort_file else []))
+
+
+def make_layers(variant, root, sort_file=None):
+    """Squash root into one image per layer of chroot.SQUASHFS_LAYERS in casper/, returns the names of the images.
+
+    A layer nothing belongs to gets no image.
+    """
+    with trace.span(variant.label("squashfs-split")) as span:
+        excludes, sizes = squashlayers.split(root, list(chroot.SQUASHFS_LAYERS.items()), SQUASHFS_EXCLUDES)
+        span["sizes"] = sizes
+
+    images = []
+    for name, layer_excludes in excludes.items():
+        if layer_excludes is None:
+            print(f"[*] {variant.tag}Nothing belongs to the {name} layer, skipping it...")
+            continue
+
+        print(f"[*] {variant.tag}Squashing the {name} layer ({sizes[name] / 1048576:.1f} MiB)...")
+        image = f"{name}.squashfs"
+        exclude_file = os.path.join(variant.root, f"{name}.exclude")
+        squashlayers.write_excludes(exclude_file, layer_excludes)
+        try:
+            with trace.span(variant.label(f"mksquashfs-{name}"), excluded=len(layer_excludes)):
+                subprocess.run(mksquashfs_command(root, os.path.join(variant.image_dir, "casper", image), sort_file) + ["-ef", exclude_file], check=True)
+        finally:
+            os.remove(exclude_file)
+        images.append(image)
+    return images
+
+
+def report_layers(variant, images):
+    """Print the size of every layer and of what each RAM entry copies, with the copy time at TORAM_MEDIA_SPEED."""
+    casper = os.path.join(variant.image_dir, "casper")
+    speed = TORAM_MEDIA_SPEED * 1048576
+    sizes = {name: os.path.getsize(os.path.join(casper, f"{name}.squashfs")) if f"{name}.squashfs" in images else 0 for name in chroot.SQUASHFS_LAYERS}
+
+    with trace.span(variant.label("squashfs-layers")) as span:
+        span["sizes"] = sizes
+        span["media_speed"] = TORAM_MEDIA_SPEED
+        print(f"[*] {variant.tag}Squashfs layers, copy times to RAM at {TORAM_MEDIA_SPEED} MiB/s:")
+        for name, size in sizes.items():
+            print(f"    {name:<40} {size / 1048576:>9.1f} MiB {size / speed:>8.1f}s")
+        entries = [(f"to RAM ({title} only)", names) for title, _, names in chroot.squashfs_ram_layers()] + [("to RAM", list(sizes))]
+        for title, names in entries:
+            size = sum(sizes[name] for name in names)
+            print(f"    {title:<40} {size / 1048576:>9.1f} MiB {size / speed:>8.1f}s")
+
+
+def check_package_sizes(variant, root, current):
+    """Write the package size report of root next to the ISO and exit when a group is over its PACKAGE_SIZE_BUDGETS.
+
+    The report is kept in the squashfs cache and reused while the manifest of
+    root and the package groups are the same.
+    """
+    groups = chroot.VARIANT_PACKAGE_GROUPS[variant.name]
+    digest = hashlib.sha256(json.dumps([current, groups], sort_keys=True).encode()).hexdigest()
+    cached_report = os.path.join(variant.squashfs_cache, "sizes.json")
+    report = manifest.load(cached_report) if not args.no_cache and os.path.exists(cached_report) else None
+
+    if report and report.get("manifest") == digest:
+        print(f"[*] {variant.tag}Root filesystem is unchanged, reusing the previous package size report...")
+    else:
+        with trace.span(variant.label("package-sizes")) as span:
+            report = packagesizes.analyze(root, groups, SQUASHFS_OPTIONS, SQUASHFS_EXCLUDES, HASH_WORKERS)
+            report["manifest"] = digest
+            span.update(installed=report["installed"], compressed=report["compressed"], estimator=report["estimator"])
+        manifest.save(cached_report, report)
+
+    packagesizes.print_groups(report, PACKAGE_SIZE_BUDGETS, variant.tag)
+    if PACKAGE_SIZES:
+        table = packagesizes.write(report, variant.package_sizes, PACKAGE_SIZE_BUDGETS)
+        print(f"[*] {variant.tag}Wrote the package size report to {variant.package_sizes} and {table}")
+
+    over = packagesizes.over_budget(report, PACKAGE_SIZE_BUDGETS)
+    for group, size, budget in over:
+        print(f"[X] {variant.tag}The {group} packages are about {size / 1048576:.1f} MiB compressed, over their budget of {budget / 1048576:.1f} MiB")
+    if over:
         sys.exit(1)
-    
 
-    print("[*] Creating ISO...")
+
+def squashfs_images():
+    """Names of the images make_squashfs can put in casper/, one per layer with LAYERED_SQUASHFS."""
+    if LAYERED_SQUASHFS:
+        return [f"{name}.squashfs" for name in chroot.SQUASHFS_LAYERS]
+    return ["filesystem.squashfs"]
+
+
+def make_squashfs(variant, keys):
+    chain = phase_chain(keys)
+    # The image tree goes on the tmpfs as well when building in RAM
+    if ram_scratch(chain):
+        variant.image_dir = os.path.join(RAM_DIR, os.path.basename(variant.image_dir))
+    root = os.path.join(variant.root, "squashfs")
+    layer_spec = chroot.SQUASHFS_LAYERS if LAYERED_SQUASHFS else None
+
+    print(f"[*] {variant.tag}Creating squashfs...")
     try:
-        os.makedirs(os.path.dirname(OUTPUT), exist_ok=True)
+        casper = os.path.join(variant.image_dir, "casper")
+        cached_manifest = os.path.join(variant.squashfs_cache, "manifest.json")
+        os.makedirs(variant.squashfs_cache, exist_ok=True)
+
+        previous = None
+        if not args.no_cache and os.path.exists(cached_manifest):
+            previous = manifest.load(cached_manifest)
+            # Manifests from before the layered squashfs describe a single filesystem.squashfs
+            if (previous.get("options") != SQUASHFS_OPTIONS or previous.get("excludes") != SQUASHFS_EXCLUDES or previous.get("layers") != layer_spec
+                    or not all(os.path.exists(os.path.join(variant.squashfs_cache, image)) for image in previous.get("images", ["filesystem.squashfs"]))):
+                previous = None
+
+        os.makedirs(root, exist_ok=True)
+        layers.mount(root, [layers.layer_root(LAYER_DIR, k) for k in chain])
+        try:
+            shutil.copytree(os.path.join(root, "image"), variant.image_dir, symlinks=True)
+            shutil.copy(os.path.join(root, "usr", "lib", "grub", "i386-pc", "boot_hybrid.img"), os.path.join(variant.image_dir, "isolinux", "boot_hybrid.img"))
+
+            sort_file = os.path.join(variant.squashfs_cache, "boot.sort")
+            sort_digest = None
+            if BOOT_SORT:
+                with trace.span(variant.label("boot-sort")) as span:
+                    access_list = BOOT_ACCESS_LIST if BOOT_ACCESS_LIST and os.path.exists(BOOT_ACCESS_LIST) else None
+                    span["files"], sort_digest = bootsort.generate(root, sort_file, access_list, SQUASHFS_EXCLUDES)
+                    span["recorded"] = access_list is not None
+
+            # A new boot order changes the layout even when the files are the same
+            if previous and previous.get("boot_sort") != sort_digest:
+                previous = None
+
+            with trace.span(variant.label("manifest")):
+                current = manifest.walk(root, SQUASHFS_EXCLUDES)
+                current["options"] = SQUASHFS_OPTIONS
+                current["excludes"] = SQUASHFS_EXCLUDES
+                current["boot_sort"] = sort_digest
+                current["layers"] = layer_spec
+
+            if PACKAGE_SIZES or PACKAGE_SIZE_BUDGETS:
+                check_package_sizes(variant, root, current)
+
+            added, removed, changed = manifest.diff(previous, current) if previous else (None, None, None)
+
+            # Entries added at the top level can be appended to a single image, anything else needs a full rebuild
+            new_tops = [path for path in added if "/" not in path] if previous else []
+            appendable = previous and not layer_spec and new_tops and not removed and not changed and all(path.split("/")[0] in new_tops for path in added)
+
+            if previous and not added and not removed and not changed:
+                print(f"[*] {variant.tag}Root filesystem is unchanged, reusing the previous squashfs...")
+                images = previous.get("images", ["filesystem.squashfs"])
+                with trace.span(variant.label("mksquashfs"), reused=True):
+                    for image in images:
+                        link_or_copy(os.path.join(variant.squashfs_cache, image), os.path.join(casper, image))
+            elif appendable:
+                print(f"[*] {variant.tag}Appending {', '.join(new_tops)} to the previous squashfs...")
+                images = ["filesystem.squashfs"]
+                with trace.span(variant.label("mksquashfs"), appended=len(added)):
+                    shutil.copy(os.path.join(variant.squashfs_cache, images[0]), os.path.join(casper, images[0]))
+                    # A single source directory would otherwise be merged into the image root instead of added as itself
+                    subprocess.run(["mksquashfs"] + [os.path.join(root, path) for path in new_tops] + [os.path.join(casper, images[0]), "-no-recovery", "-keep-as-directory"], check=True)
+            else:
+                if previous:
+                    print(f"[*] {variant.tag}Root filesystem changed ({len(added)} added, {len(removed)} removed, {len(changed)} changed), rebuilding squashfs...")
+                if layer_spec:
+                    images = make_layers(variant, root, sort_file if BOOT_SORT else None)
+                else:
+                    images = ["filesystem.squashfs"]
+                    with trace.span(variant.label("mksquashfs")):
+                        subprocess.run(mksquashfs_command(root, os.path.join(casper, images[0]), sort_file if BOOT_SORT else None), check=True)
+        finally:
+            layers.umount(root)
+            if not os.path.ismount(root):
+                os.rmdir(root)
+
+        size = str(current["size"])
+        print(f"[*] {variant.tag}Root filesystem size: {size}")
+
+        open(os.path.join(casper, "filesystem.size"), "w").write(size)
+
+        # casper stacks every image of its live media directory, the RAM entries
+        # get a directory with only their layers
+        if layer_spec:
+            for _, directory, names in chroot.squashfs_ram_layers():
+                os.makedirs(os.path.join(variant.image_dir, directory.lstrip("/")), exist_ok=True)
+                for image in [f"{name}.squashfs" for name in names if f"{name}.squashfs" in images]:
+                    link_or_copy(os.path.join(casper, image), os.path.join(variant.image_dir, directory.lstrip("/"), image))
+            report_layers(variant, images)
+
+        for file in os.listdir(variant.squashfs_cache):
+            if file.endswith(".squashfs") and os.path.isfile(os.path.join(variant.squashfs_cache, file)):
+                os.remove(os.path.join(variant.squashfs_cache, file))
+        for image in images:
+            link_or_copy(os.path.join(casper, image), os.path.join(variant.squashfs_cache, image))
+        current["images"] = images
+        manifest.save(cached_manifest, current)
+    except Exception as e:
+        traceback.print_exc()
+        print(f"[X] {variant.tag}Failed to create squashfs")
+        sys.exit(1)
 
-        subprocess.run([
+
+def make_iso(variant):
+    print(f"[*] {variant.tag}Creating image checksums...")
+    try:
+        with trace.span(variant.label("image-checksums")) as span:
+            span["bytes"] = imagehash.write_lists_process(variant.image_dir, IMAGE_SHA256, HASH_WORKERS)
+    except Exception as e:
+        traceback.print_exc()
+        print(f"[X] {variant.tag}Failed to create image checksums")
+        sys.exit(1)
+
+    print(f"[*] {variant.tag}Creating ISO...")
+    try:
+        os.makedirs(os.path.dirname(variant.output), exist_ok=True)
+
+        command = [
             "xorriso",
                 "-as", "mkisofs",
                 "-iso-level", "3",
                 "-full-iso9660-filenames",
                 "-J", "-J", "-joliet-long",
-                "-volid", ISO_VOLID,
-                "-output", OUTPUT,
+                "-volid", variant.volid,
+                "-output", "-" if ISO_STREAM_HASH else variant.output,
                 "-eltorito-boot", "isolinux/bios.img",
                     "-no-emul-boot",
                     "-boot-load-size", "4",
                     "-boot-info-table",
                     "--eltorito-catalog", "boot.catalog",
                     "--grub2-boot-info",
-                    "--grub2-mbr", "../chroot/usr/lib/grub/i386-pc/boot_hybrid.img",
+                    "--grub2-mbr", "isolinux/boot_hybrid.img",
                     "-partition_offset", "16",
                     "--mbr-force-bootable",
                 "-eltorito-alt-boot",
@@ -224,21 +901,306 @@ deb-src {MIRROR} {RELEASE_CODE_NAME}-updates main restricted universe multiverse
                     "/isolinux/bios.img=isolinux/bios.img",
                     "/isolinux/efiboot.img=isolinux/efiboot.img",
                     "."
-        ], check=True, cwd=IMAGE_DIR)
+        ]
+
+        with trace.span(variant.label("xorriso"), streamed=ISO_STREAM_HASH):
+            if ISO_STREAM_HASH:
+                # xorriso writes to stdout and the ISO is hashed on its way to disk
+                # The ISO only gets its name once xorriso exited cleanly, a failed run leaves nothing behind
+                tmp = variant.output + ".tmp"
+                process = subprocess.Popen(command, stdout=subprocess.PIPE, cwd=variant.image_dir)
+                try:
+                    with process.stdout:
+                        digests = imagehash.stream(process.stdout, tmp, ISO_ALGORITHMS)
+                    if process.wait() != 0:
+                        raise subprocess.CalledProcessError(process.returncode, command)
+                    os.replace(tmp, variant.output)
+                except BaseException:
+                    process.kill()
+                    process.wait()
+                    if os.path.exists(tmp):
+                        os.remove(tmp)
+                    raise
+            else:
+                subprocess.run(command, check=True, cwd=variant.image_dir)
     except:
         traceback.print_exc()
-        print("[X] Failed to create ISO")
+        print(f"[X] {variant.tag}Failed to create ISO")
         sys.exit(1)
 
-    
-    print("[*] Creating md5 hash file...")
+    print(f"[*] {variant.tag}Creating hash files...")
     try:
-        subprocess.run(["md5sum", OUTPUT], check=True, stdout=open(MD5_OUTPUT, "w"))
+        with trace.span(variant.label("iso-checksums"), streamed=ISO_STREAM_HASH):
+            if not ISO_STREAM_HASH:
+                digests = imagehash.hash_file(variant.output, ISO_ALGORITHMS)
+            for algorithm, path in variant.checksums.items():
+                if algorithm in digests:
+                    imagehash.write_checksum(path, digests[algorithm], variant.output)
     except:
         traceback.print_exc()
-        print("[X] Failed to create md5 hash file, skipping...")
-        # MD5 is not needed
-        
+        print(f"[X] {variant.tag}Failed to create hash files, skipping...")
+        # Hash files are not needed
+
+
+# Every phase is (name, function, kind). Host phases are called with the path of
+# the mounted root and the variant, chroot phases are run by chroot.py inside the
+# root jail.
+PHASES = [("prepare-root", prepare_root, "host")]
+PHASES += [(name, func, "chroot") for name, func in chroot.PHASES]
+PHASES += [("stamp-release", stamp_release, "host")]
+
+# Phases up to the branch are shared by all variants, the rest run once per variant
+BRANCH = [name for name, _, _ in PHASES].index(chroot.VARIANT_BRANCH)
+SHARED_PHASES = PHASES[:BRANCH]
+VARIANT_PHASES = PHASES[BRANCH:]
+SHARED_NAMES = set(name for name, _, _ in SHARED_PHASES)
+
+try:
+    PHASE_SPECS, PHASE_ANCESTORS = phase_specs(PHASES)
+except ValueError as e:
+    print(f"[X] {e}")
+    sys.exit(1)
+
+# Scripts copied into the root jail next to chroot.py for every chroot phase
+CHROOT_SCRIPTS = ["chroot.py", "prefetch.py", "packageplan.py"]
+
+# The phase that installs the ntfs-3g plugin, the task that builds it and the packages its cache key follows
+NTFS_PLUGIN_PHASE = "install-ntfs-3g-system-compression"
+NTFS_PLUGIN_TASK = "build-ntfs-3g-system-compression"
+NTFS_PLUGIN_VERSIONS = ["ntfs-3g-dev", "gcc"]
+
+# The phase that updates the package lists, and a file that changes whenever a
+# refresh of stale lists changed them, so the phase and the ones after it rerun
+LISTS_PHASE = "update-package-list"
+LISTS_GENERATION = os.path.join(APT_LISTS_STATE, "generation")
+
+# Phase inputs the build makes from a download, keyed like the download itself
+BUILT_INPUTS = {os.path.join(chroot.NTFS_PLUGIN_DIR, chroot.NTFS_PLUGIN): "ntfs-3g-system-compression.git"}
+
+
+HOST_PHASE_INPUTS = [os.path.join(os.getcwd(), "plymouth"), os.path.join(os.getcwd(), "exit_gnome.png"), os.path.join(os.getcwd(), "plymouthatlas.py"), os.path.join(os.getcwd(), "plymouthbackground.py")]
+# The modules chroot phases import and the session they run in, chroot.py itself is covered by the phase functions
+CHROOT_PHASE_INPUTS = [os.path.join(os.getcwd(), script) for script in CHROOT_SCRIPTS if script != "chroot.py"] + [os.path.join(os.getcwd(), "chrootsession.py")]
+
+
+def make_base():
+    try:
+        if not args.no_cache and layers.is_complete(LAYER_DIR, base_layer):
+            print(f"[*] Reusing base layer ({base_key})")
+        else:
+            base_root, _ = layers.begin(LAYER_DIR, base_layer)
+
+            with trace.span("base-restore") as span:
+                span["hit"] = bool(use_cache and basecache.restore(BASE_CACHE, base_key, base_root))
+
+            if span["hit"]:
+                print(f"[*] Restored base from cache ({base_key})")
+            else:
+                with trace.span("debootstrap"):
+                    subprocess.run(["debootstrap", 
+                                        "--arch="+ARCH, 
+                                        "--variant=minbase", 
+                                        "--cache-dir="+APT_CACHE,
+                                        "--include="+",".join(DEBOOTSTRAP_INCLUDE),
+                                        RELEASE_CODE_NAME, 
+                                        base_root, 
+                                        MIRROR],
+                                    check=True)
+
+                if use_cache:
+                    print(f"[*] Storing base in cache ({base_key})...")
+                    with trace.span("base-store"):
+                        basecache.store(BASE_CACHE, base_key, base_root)
+                    for path in basecache.evict(BASE_CACHE, BASE_CACHE_SIZE):
+                        print(f"[*] Evicted {os.path.basename(path)} from base cache")
+
+            layers.commit(LAYER_DIR, base_layer, "debootstrap")
+    except Exception as e:
+        traceback.print_exc()
+        print(f"[X] Failed to create chroot environment")
+        sys.exit(1)
+
+
+def phase_step(name, func, kind, keys, variant=None):
+    """Return the build step of a phase, its paths are on the host and its resources qualified by root."""
+    spec = PHASE_SPECS[name]
+    root = variant.root if variant else CHROOT_DIR
+    return stepgraph.Step(step_name(name, variant),
+                          functools.partial(run_phase, name, func, kind, keys, variant),
+                          after=[step_name(dependency, variant) for dependency in spec["after"]] or ["base"],
+                          inputs=[host_path(path, variant) for path in spec["inputs"]],
+                          outputs=[os.path.join(root, path.lstrip("/")) for path in spec["outputs"]],
+                          resources=[f"{resource}:{root}" if resource == "dpkg" else resource for resource in spec["resources"]])
+
+
+def step_name(name, variant=None):
+    """Name of the build step of phase name, phases after the branch run once per variant."""
+    if variant and name not in SHARED_NAMES:
+        return variant.label(name)
+    return name
+
+
+def build_graph():
+    """Return the graph of every build step: the base, the downloads, the phases and the images of every variant."""
+    graph = stepgraph.Graph()
+    graph.add(stepgraph.Step("base", make_base, resources=["network"]))
+    # Steps with work to do, the others only reuse their layer
+    busy = []
+
+    for name, func, kind in SHARED_PHASES:
+        step = graph.add(phase_step(name, func, kind, shared_keys))
+        if args.no_cache or not layers.is_complete(LAYER_DIR, shared_keys[name]):
+            busy.append(step)
+
+    for variant in variants:
+        keys = variant_keys[variant.name]
+        for name, func, kind in VARIANT_PHASES:
+            step = graph.add(phase_step(name, func, kind, keys, variant))
+            if args.no_cache or not layers.is_complete(LAYER_DIR, keys[name]):
+                busy.append(step)
+
+        # The plugin is only needed when its install phase has to run
+        if args.no_cache or not layers.is_complete(LAYER_DIR, keys[NTFS_PLUGIN_PHASE]):
+            busy.append(graph.add(stepgraph.Step(variant.label("ntfs-plugin"), functools.partial(ntfs_plugin, variant, keys),
+                                                 after=[step_name(dependency, variant) for dependency in PHASE_SPECS[NTFS_PLUGIN_PHASE]["after"]],
+                                                 inputs=[host_path(os.path.join(chroot.DOWNLOAD_DIR, "ntfs-3g-system-compression.git"), variant)],
+                                                 outputs=[os.path.join(variant.ntfs_plugin, chroot.NTFS_PLUGIN)],
+                                                 resources=["network"])))
+
+        graph.add(stepgraph.Step(variant.label("squashfs"), functools.partial(make_squashfs, variant, keys),
+                                 after=[step_name(name, variant) for name, _, _ in PHASES],
+                                 outputs=[variant.image_dir] + [os.path.join(variant.squashfs_cache, file) for file in squashfs_images() + ["manifest.json", "boot.sort"]]))
+        graph.add(stepgraph.Step(variant.label("iso"), functools.partial(make_iso, variant),
+                                 after=[variant.label("squashfs")],
+                                 outputs=[variant.image_dir, variant.output] + list(variant.checksums.values())))
+
+    # Downloads only run when a step that reads them has work to do, the layer keys already carry what they will be
+    for name in chroot.DOWNLOADS:
+        path = host_path(os.path.join(chroot.DOWNLOAD_DIR, name))
+        if any(path in step.inputs for step in busy):
+            graph.add(stepgraph.Step("fetch-" + name, functools.partial(fetch, name), outputs=[path], resources=["network"]))
+
+    graph.validate()
+    return graph
+
+
+def report_critical_path(scheduler):
+    """Print the chain of steps the build waited on, returns their names."""
+    path, seconds = scheduler.critical_path()
+    if not path:
+        return path
+
+    busy = sum(end - start for start, end in scheduler.timings.values())
+    print(f"[*] Critical path, {seconds:.1f}s of {busy:.1f}s of step time:")
+    for name in path:
+        start, end = scheduler.timings[name]
+        print(f"    {name:<48} {end - start:>8.1f}s")
+    return path
+
+
+def report_fast_install():
+    """Print the wall time fast install mode saved in each phase that ran, returns {phase: seconds}.
+
+    Every phase that ran is recorded in FAST_INSTALL_TIMINGS under its mode and
+    compared with its last run in the other mode.
+    """
+    try:
+        with open(FAST_INSTALL_TIMINGS) as f:
+            timings = json.load(f)
+    except (OSError, ValueError):
+        timings = {}
+
+    ran = {event["name"]: event["args"]["wall"] for event in trace.events
+           if event["cat"] == "phase" and not event["args"].get("cached") and event["args"].get("status") == 0}
+    if not ran:
+        return {}
+
+    timings.setdefault("fast" if FAST_INSTALL else "safe", {}).update(ran)
+    with open(FAST_INSTALL_TIMINGS + ".tmp", "w") as f:
+        json.dump(timings, f, indent=1, sort_keys=True)
+    os.replace(FAST_INSTALL_TIMINGS + ".tmp", FAST_INSTALL_TIMINGS)
+
+    fast = timings.get("fast", {})
+    safe = timings.get("safe", {})
+    saved = {name: round(safe[name] - fast[name], 3) for name in ran if name in fast and name in safe}
+    if not saved:
+        return saved
+
+    print(f"[*] Wall time saved by fast install mode, against the last run of each phase {'without' if FAST_INSTALL else 'with'} it:")
+    for name in sorted(saved, key=saved.get, reverse=True):
+        print(f"    {name:<48} {safe[name]:>8.1f}s -> {fast[name]:>8.1f}s {saved[name]:>+9.1f}s")
+    print(f"    {'total':<48} {sum(saved.values()):>+30.1f}s")
+    return saved
+
+
+print("[*] Checking dependencies...")
+dependencies = ["debootstrap", "mksquashfs", "xorriso", "git", "gpg"]
+
+for dep in dependencies:
+    if not shutil.which(dep):
+        print(f"[X] {dep} is not installed. Please install it to continue.")
+        sys.exit(1)
+
+proxy = None
+scheduler = None
+critical_path = []
+fast_install_saved = {}
+ram = None
+ram_lock = threading.Lock()
+
+try:
+    if APT_PROXY:
+        print("[*] Starting apt proxy...")
+        try:
+            proxy = aptproxy.AptProxy(("127.0.0.1", APT_PROXY_PORT), APT_PROXY_STORE, APT_PROXY_SIZE, MIRROR, APT_PROXY_OFFLINE).start()
+        except OSError as e:
+            if e.errno != errno.EADDRINUSE:
+                traceback.print_exc()
+                print("[X] Failed to start apt proxy")
+                sys.exit(1)
+            print(f"[*] Port {APT_PROXY_PORT} is in use, sharing the apt proxy that is already running there...")
+
+        # debootstrap and apt inside the chroot both pick the proxy up from the environment,
+        # so sources.list keeps pointing at MIRROR and nothing proxy specific ends up in the image
+        os.environ["http_proxy"] = f"http://127.0.0.1:{APT_PROXY_PORT}/"
+
+    print("[*] Creating chroot environment...")
+    try:
+        for variant in variants:
+            os.makedirs(variant.root, exist_ok=False)
+    except Exception as e:
+        traceback.print_exc()
+        print("[X] Failed to create chroot folder, might already exist.")
+        sys.exit(1)
+
+    try:
+        base_key = basecache.fingerprint(RELEASE_CODE_NAME, MIRROR, ARCH, DEBOOTSTRAP_INCLUDE)
+        base_layer = "base-" + base_key
+        use_cache = not args.no_cache and shutil.which("zstd")
+
+        if not args.no_cache and not use_cache:
+            print("[*] zstd is not installed, skipping base cache...")
+
+        downloads = download_references()
+        shared_keys = phase_keys(SHARED_PHASES, {})
+        if refresh_lists(shared_keys):
+            shared_keys = phase_keys(SHARED_PHASES, {})
+        variant_keys = {variant.name: phase_keys(VARIANT_PHASES, dict(shared_keys), variant) for variant in variants}
+        graph = build_graph()
+    except ValueError as e:
+        print(f"[X] Invalid build graph: {e}")
+        sys.exit(1)
+
+    print(f"[*] Running {len(graph.steps)} build steps, up to {STEP_WORKERS} at a time...")
+    scheduler = stepgraph.Scheduler(graph, STEP_WORKERS, STEP_LIMITS)
+    scheduler.run()
+
+    keep = set([base_layer]).union(*(keys.values() for keys in variant_keys.values()))
+    for key in layers.prune(LAYER_DIR, keep):
+        print(f"[*] Removed stale layer {key}")
+    for name in artifacts.prune(DOWNLOAD_DIR, chroot.DOWNLOADS):
+        print(f"[*] Removed stale download {name}")
+
 
 except Exception as e:
     traceback.print_exc()
@@ -246,27 +1208,31 @@ except Exception as e:
     sys.exit(1)
 finally:
     print("[*] Cleaning up...")
-    if os.path.exists(IMAGE_DIR):
-        shutil.rmtree(IMAGE_DIR)
+    if proxy:
+        proxy.stop()
+
+    if scheduler:
+        critical_path = report_critical_path(scheduler)
+        fast_install_saved = report_fast_install()
+
+    trace.write(TRACE_OUTPUT, volid=ISO_VOLID, variants=VARIANTS, critical_path=critical_path, fast_install=bool(FAST_INSTALL), fast_install_saved=fast_install_saved, total=time.time() - delta)
+    print(f"[*] Wrote build trace to {TRACE_OUTPUT}")
+
+    for variant in variants:
+        if os.path.exists(variant.image_dir):
+            shutil.rmtree(variant.image_dir)
+
+    if ram:
+        membudget.umount(RAM_DIR)
     
-    if os.path.exists(CHROOT_DIR):
-
-        if os.path.ismount(os.path.join(CHROOT_DIR, "proc")):
-            print("[X] Failed to unmount /proc, not cleaning up root jail.")
-        elif os.path.ismount(os.path.join(CHROOT_DIR, "sys")):
-            print("[X] Failed to unmount /sys, not cleaning up root jail.")
-        elif os.path.ismount(os.path.join(CHROOT_DIR, "dev", "pts")):
-            print("[X] Failed to unmount /dev/pts, not cleaning up root jail.")
-        elif os.path.ismount(os.path.join(CHROOT_DIR, "dev")):
-            print("[X] Failed to unmount /dev, not cleaning up root jail.")
-        elif os.path.ismount(os.path.join(CHROOT_DIR, "run")):
-            print("[X] Failed to unmount /run, not cleaning up root jail.")
-        elif os.path.ismount(os.path.join(CHROOT_DIR, "var", "cache", "apt", "archives")):
-            print("[X] Failed to unmount /var/cache/apt/archives, not cleaning up root jail.")
-        elif os.path.ismount(os.path.join(CHROOT_DIR, "var", "lib", "apt", "lists")):
-            print("[X] Failed to unmount /var/lib/apt/lists, not cleaning up root jail.")
+    for variant in variants:
+        if not os.path.exists(variant.root):
+            continue
+
+        if chrootsession.mounts_under(variant.root):
+            print(f"[X] Failed to unmount the root overlays below {variant.root} ({', '.join(chrootsession.mounts_under(variant.root))}), not cleaning up root jail.")
         else:
-            shutil.rmtree(CHROOT_DIR)
+            shutil.rmtree(variant.root)
 
-print(f"[✓] Build complete in {time.time() - delta:.2f} seconds! Output: {OUTPUT}")
-sys.exit(0)
\ No newline at end of file
+print(f"[✓] Build complete in {time.time() - delta:.2f} seconds! Output: {', '.join(variant.output for variant in variants)}")
+sys.exit(0)
@@ -0,0 +1,154 @@
+try:
+    import sys
+    import os
+    import argparse
+    import contextlib
+    import json
+    import resource
+    import subprocess
+    import threading
+    import time
+except ImportError as e:
+    print(f"[X] Failed to load required module, likely not installed: {e}")
+    try:
+        sys.exit(1)
+    except:
+        exit(1)
+
+
+# Build timing traces.
+#
+# Spans record wall time, the CPU time of the child processes they waited for
+# and their exit status. Child CPU time is only counted per process, so it is
+# left out of spans that overlapped a span on another thread. Traces are written in the Chrome trace event format,
+# so they open in chrome://tracing and Perfetto, and two traces can be compared
+# with: python3 buildtrace.py compare old.trace.json new.trace.json
+
+
+class Trace:
+    def __init__(self):
+        self.events = []
+        self.lock = threading.Lock()
+        self.origin = time.time()
+        self.open = []
+
+    def _child_cpu(self):
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return usage.ru_utime + usage.ru_stime
+
+    @contextlib.contextmanager
+    def span(self, name, category="step", **args):
+        """Time the body as one span, extra keyword arguments end up in the trace."""
+        start = time.time()
+        cpu = self._child_cpu()
+        status = 0
+        record = {"thread": threading.get_ident(), "overlapped": False}
+        with self.lock:
+            others = [other for other in self.open if other["thread"] != record["thread"]]
+            for other in others:
+                other["overlapped"] = True
+            record["overlapped"] = bool(others)
+            self.open.append(record)
+        try:
+            yield args
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 1
+            raise
+        except subprocess.CalledProcessError as e:
+            status = e.returncode
+            raise
+        except BaseException:
+            status = 1
+            raise
+        finally:
+            end = time.time()
+            cpu = self._child_cpu() - cpu
+            with self.lock:
+                self.open.remove(record)
+                args.update({
+                    "status": status,
+                    "wall": round(end - start, 3),
+                    "child_cpu": None if record["overlapped"] else round(cpu, 3),
+                })
+                self.events.append({
+                    "name": name,
+                    "cat": category,
+                    "ph": "X",
+                    "ts": int((start - self.origin) * 1000000),
+                    "dur": int((end - start) * 1000000),
+                    "pid": os.getpid(),
+                    "tid": threading.get_ident() % 100000,
+                    "args": args,
+                })
+
+    def write(self, path, **metadata):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump({
+                "traceEvents": self.events,
+                "displayTimeUnit": "ms",
+                "otherData": dict(metadata, start=self.origin),
+            }, f, indent=1)
+
+
+def load(path):
+    """Return {(category, name): args} for every span in a trace file."""
+    with open(path) as f:
+        data = json.load(f)
+
+    spans = {}
+    for event in data.get("traceEvents", []):
+        if event.get("ph") != "X":
+            continue
+        args = dict(event.get("args", {}))
+        args.setdefault("wall", event["dur"] / 1000000)
+        spans[(event.get("cat", ""), event["name"])] = args
+    return spans
+
+
+def compare(old, new, threshold=10.0, min_seconds=1.0):
+    """Return (category, name, old wall, new wall, change percent, regressed) for every span in both traces."""
+    rows = []
+    for key in new:
+        if key not in old:
+            continue
+        before = old[key]["wall"]
+        after = new[key]["wall"]
+        change = (after - before) / before * 100 if before else 0.0
+        regressed = change > threshold and after - before >= min_seconds
+        # A phase that was reused from a layer in one build says nothing about its speed
+        if old[key].get("cached") != new[key].get("cached"):
+            regressed = False
+        rows.append((key[0], key[1], before, after, change, regressed))
+
+    rows.sort(key=lambda row: row[3] - row[2], reverse=True)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Work with PassKill build traces.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    compare_parser = commands.add_parser("compare", help="Compare two traces and flag regressed spans.")
+    compare_parser.add_argument("old", help="Trace of the reference build.")
+    compare_parser.add_argument("new", help="Trace of the build to check.")
+    compare_parser.add_argument("--threshold", type=float, default=10.0, help="Percentage a span may slow down before it counts as a regression.")
+    compare_parser.add_argument("--min-seconds", type=float, default=1.0, help="Ignore regressions smaller than this many seconds.")
+
+    args = parser.parse_args()
+
+    rows = compare(load(args.old), load(args.new), args.threshold, args.min_seconds)
+    regressions = 0
+
+    print(f"{'span':<48} {'old':>10} {'new':>10} {'change':>9}")
+    for category, name, before, after, change, regressed in rows:
+        if regressed:
+            regressions += 1
+        print(f"{category + '/' + name:<48} {before:>9.2f}s {after:>9.2f}s {change:>+8.1f}%{'  [X] regressed' if regressed else ''}")
+
+    print(f"[*] {regressions} of {len(rows)} spans regressed past {args.threshold:.0f}%")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,9 +3,12 @@ try:
     import subprocess
     import os
     import traceback
-    import requests
     import shutil
     import configparser
+    import glob
+    import hashlib
+    import json
+    import time
 except ImportError as e:
     print(f"[X] Failed to load required module: {e}")
     try:
@@ -15,8 +18,14 @@ except ImportError as e:
 
 
 APT_OPTIONS = ['-y']
+PREFETCH_WORKERS = 8
+# Lock files of the package plans, see packageplan.py, build.py bind mounts
+# them from the host. PASSKILL_RELOCK makes every plan resolve again.
+PACKAGE_LOCK_DIR = '/run/package-locks'
+RELOCK = os.environ.get('PASSKILL_RELOCK') == '1'
 
 GENERIC_PACKAGES = ['ubuntu-standard', 'sudo', 'linux-image-6.14.0-27-generic', 'linux-modules-extra-6.14.0-27-generic', 'linux-firmware'] # The kernel is pinned to 6.14.0-27-generic because 6.14.0-28 and 6.14.0-29 have a bug that makes it so losetup fails when trying to create a loopdev for a squashfs file on a read only file system.
+SYSTEM_PACKAGES = ['libterm-readline-gnu-perl', 'systemd-sysv', 'dbus-bin', 'software-properties-common']
 HARDWARE = ['amd64-microcode', 'intel-microcode', 'firmware-sof-signed', 'thermald']
 LIVE_PACKAGES = ['casper', 'discover', 'laptop-detect', 'locales', 'mtools', 'binutils']
 NETWORK_PACKAGES = ['network-manager', 'net-tools', 'iw']
@@ -46,41 +55,160 @@ GRAPHICS = ["xserver-xorg-video-nouveau", "mesa-vulkan-drivers", "xserver-xorg-v
 
 PACKAGES = GENERIC_PACKAGES + LIVE_PACKAGES + NETWORK_PACKAGES + BOOTLOADER_PACKAGES + WINDOW_MANAGER + TOOLS + FILESYSTEMS + GRAPHICS + HARDWARE
 
+# The image variants build.py can make and the packages each one installs. Every
+# phase before VARIANT_BRANCH is shared by all variants, the rest run per variant.
+SLIM_WINDOW_MANAGER = ['plymouth', 'plymouth-label', 'plymouth-theme-ubuntu-text', 'gnome-shell', 'gnome-session', 'gdm3', 'ubuntu-settings', 'yaru-theme-gtk', 'yaru-theme-icon', 'nautilus', 'gnome-terminal', 'zenity', 'dconf-cli', 'ubuntu-gnome-wallpapers']
+SLIM_TOOLS = [package for package in TOOLS if package not in ['clonezilla', 'firefox']]
+VARIANTS = {
+    'full': PACKAGES,
+    'slim': GENERIC_PACKAGES + LIVE_PACKAGES + NETWORK_PACKAGES + BOOTLOADER_PACKAGES + SLIM_WINDOW_MANAGER + SLIM_TOOLS + FILESYSTEMS + GRAPHICS + HARDWARE,
+}
+VARIANT_BRANCH = 'install-packages'
+
+# Named package groups of each variant, packagesizes.py reports the size of
+# every group and of every package in it, with everything they depend on.
+PACKAGE_GROUPS = {
+    'generic': GENERIC_PACKAGES, 'system': SYSTEM_PACKAGES, 'hardware': HARDWARE, 'live': LIVE_PACKAGES, 'network': NETWORK_PACKAGES,
+    'bootloader': BOOTLOADER_PACKAGES, 'window-manager': WINDOW_MANAGER, 'tools': TOOLS, 'filesystems': FILESYSTEMS, 'graphics': GRAPHICS,
+}
+VARIANT_PACKAGE_GROUPS = {
+    'full': PACKAGE_GROUPS,
+    'slim': {**PACKAGE_GROUPS, 'window-manager': SLIM_WINDOW_MANAGER, 'tools': SLIM_TOOLS},
+}
+
+# Layers of the layered squashfs, see squashlayers.py. A package belongs to the
+# first layer that needs it, the essential packages and anything no layer needs
+# to the first layer, like files no package owns. Every
+# layer but the last gets a GRUB entry that copies it and the layers before it
+# to RAM, from a directory of the image that holds only those layers.
+HEAVY_FILESYSTEMS = ['glusterfs-client', 'ceph-common']
+SQUASHFS_LAYERS = {
+    'core': {'title': 'Console', 'packages': [package for package in GENERIC_PACKAGES if package != 'linux-firmware'] + SYSTEM_PACKAGES + LIVE_PACKAGES + NETWORK_PACKAGES + BOOTLOADER_PACKAGES
+                                             + [package for package in WINDOW_MANAGER if package.startswith('plymouth')] + [package for package in FILESYSTEMS if package not in HEAVY_FILESYSTEMS] + HARDWARE},
+    'desktop': {'title': 'Desktop', 'packages': WINDOW_MANAGER + SLIM_WINDOW_MANAGER + GRAPHICS},
+    'tools': {'title': 'Tools', 'packages': TOOLS + HEAVY_FILESYSTEMS + ['linux-firmware']},
+}
+LAYERED_SQUASHFS = os.environ.get('PASSKILL_LAYERED_SQUASHFS') == '1'
+
+
+def squashfs_ram_layers():
+    """Return [(title, directory on the image, [layers])] of the GRUB entries that copy only some layers to RAM."""
+    names = list(SQUASHFS_LAYERS)
+    return [(' and '.join(SQUASHFS_LAYERS[layer]['title'] for layer in names[:index + 1]), f'/casper-{name}', names[:index + 1])
+            for index, name in enumerate(names[:-1])]
+
+
+# Files build.py keeps in its download store on the host, see artifacts.py,
+# they are bind mounted into the root jail below DOWNLOAD_DIR. Files are
+# checked against sha256, a file without one is pinned by its first download.
+# Keys are checked against their fingerprint, keyserver exports change.
+DOWNLOAD_DIR = '/run/downloads'
+PIP_PACKAGES = ['whiptail-dialogs']
+DOWNLOADS = {
+    'PassKill.git': {'kind': 'git', 'url': 'https://github.com/RileyCampbell2007/PassKill.git'},
+    'ntfs-3g-system-compression.git': {'kind': 'git', 'url': 'https://github.com/ebiggers/ntfs-3g-system-compression.git'},
+    'memtest86.zip': {'kind': 'file', 'url': 'https://memtest.org/download/v7.00/mt86plus_7.00.binaries.zip', 'sha256': None},
+    'wheels': {'kind': 'pip', 'packages': PIP_PACKAGES},
+    'mozillateam.asc': {'kind': 'file', 'url': 'https://keyserver.ubuntu.com/pks/lookup?op=get&search=0x0AB215679C571D1C8325275B9BDB3D89CE49EC21', 'fingerprint': '0AB215679C571D1C8325275B9BDB3D89CE49EC21'},
+}
+
+# The Mozilla PPA is written as a source directly, so it is in place for the
+# first and only apt-get update. Plain http, ca-certificates is not installed
+# yet and the PPA is signed anyway.
+MOZILLA_PPA = 'http://ppa.launchpadcontent.net/mozillateam/ppa/ubuntu/'
+MOZILLA_PPA_KEY = '/etc/apt/keyrings/mozillateam.asc'
+
+# When the shared package lists were last updated and for which sources,
+# build.py bind mounts it from the host and passes the freshness TTL in
+# PASSKILL_APT_LISTS_TTL.
+APT_LISTS_STATE = '/run/apt-lists-state'
+APT_LISTS_STAMP = 'stamp.json'
+
+# The ntfs-3g system compression plugin is built by build.py in a throwaway root
+# with build_ntfs_system_compression and cached, the image only gets the plugin
+# from NTFS_PLUGIN_DIR.
+NTFS_PLUGIN = 'ntfs-plugin-80000017.so'
+NTFS_PLUGIN_DIR = '/run/ntfs-plugin'
+NTFS_PLUGIN_BUILD_DEPS = ['autoconf', 'automake', 'libtool', 'pkg-config', 'ntfs-3g-dev', 'libfuse-dev', 'build-essential']
+
+# Fast install mode for the throwaway build root, build.py turns it on or off.
+# dpkg skips fsync, apt runs triggers once at the end of every run, man-db
+# stops rebuilding its index and update-initramfs only records its calls, so
+# the update-initramfs phase builds each initramfs exactly once. Everything is
+# put back before the image is squashed.
+FAST_INSTALL = os.environ.get('PASSKILL_FAST_INSTALL', '1') != '0'
+FAST_INSTALL_DPKG = '/etc/dpkg/dpkg.cfg.d/99passkill-unsafe-io'
+FAST_INSTALL_APT = '/etc/apt/apt.conf.d/99passkill-deferred-triggers'
+MAN_DB_AUTO_UPDATE = '/var/lib/man-db/auto-update'
+UPDATE_INITRAMFS = '/usr/sbin/update-initramfs'
+UPDATE_INITRAMFS_CALLS = '/var/lib/passkill/update-initramfs-calls'
+
+# Initramfs profile, build.py passes its INITRAMFS_MODULES, INITRAMFS_COMPRESS
+# and INITRAMFS_COMPRESS_LEVEL in PASSKILL_INITRAMFS_PROFILE. The modules a
+# live boot from USB, NVMe, optical media or a VM needs are always listed, and
+# every initramfs is checked to have them, built in or as a module.
+INITRAMFS_PROFILE = json.loads(os.environ.get('PASSKILL_INITRAMFS_PROFILE', '{}'))
+INITRAMFS_CONF = 'conf.d/passkill.conf'
+INITRAMFS_REQUIRED_MODULES = ['squashfs', 'overlay', 'loop', 'isofs', 'cdrom', 'sr_mod', 'sd_mod', 'usb_storage', 'uas', 'xhci_pci', 'ehci_pci', 'ahci', 'nvme', 'virtio_blk', 'virtio_scsi']
+INITRAMFS_REQUIRED_FILES = ['scripts/casper']
+
 BLOCKED_PACKAGES = ['libreoffice*', 'thunderbird*', 'rhythmbox*', 'gnome-mahjongg', 'gnome-mines', 'gnome-sudoku', 'aisleriot', 'cheese', 'simple-scan', 'transmission*', 'remmina*', 'totem*', 'shotwell*', 'hexchat*', 'deja-dup*', 'ubuntu-docs', 'gnome-user-docs', 'snapd', 'plymouth-themes', 'plymouth-theme', 'plymouth-theme-spinner', 'gnome-snapshot', 'cryptsetup-initramfs']
 
 
-print('[CHROOT] Setting up chroot...')
-try:
-    os.makedirs('/proc', exist_ok=True)
-    os.makedirs('/sys', exist_ok=True)
-    os.makedirs('/dev/pts', exist_ok=True)
-    subprocess.run(['mount', 'none', '-t', 'proc', '/proc'], check=True)
-    subprocess.run(['mount', 'none', '-t', 'sysfs', '/sys'], check=True)
-    subprocess.run(['mount', 'none', '-t', 'devpts', '/dev/pts'], check=True)
-
-    os.environ['HOME'] = '/root'
-    os.environ['LC_ALL'] = 'C'
-    os.environ['DEBIAN_FRONTEND'] = 'noninteractive'
-    
+def prefetch_packages(apt_args):
+    try:
+        import prefetch
+        prefetch.report(prefetch.prefetch(apt_args, workers=PREFETCH_WORKERS))
+    except Exception as e:
+        traceback.print_exc()
+        print("[CHROOT] Prefetch failed, leaving the downloads to apt...")
+
 
+def install_plan(name, packages, upgrade=False, autoremove=False):
+    """Install packages, and every upgrade or the autoremovals, in one transaction from the plan in lock file name."""
+    import packageplan
+    lock = packageplan.plan(name, packages, upgrade, autoremove, relock=RELOCK)
+    prefetch_packages(packageplan.apt_args(lock))
+    packageplan.execute(lock, packages, APT_OPTIONS)
+
+
+def sources_digest():
+    digest = hashlib.sha256()
+    for path in sorted(glob.glob('/etc/apt/sources.list') + glob.glob('/etc/apt/sources.list.d/*')):
+        digest.update(path.encode() + b'\0')
+        digest.update(open(path, 'rb').read())
+    return digest.hexdigest()
+
+
+def lists_fresh(sources):
+    """Whether the package lists were updated for these sources less than PASSKILL_APT_LISTS_TTL seconds ago."""
+    ttl = float(os.environ.get('PASSKILL_APT_LISTS_TTL', '0'))
+    try:
+        stamp = json.load(open(os.path.join(APT_LISTS_STATE, APT_LISTS_STAMP)))
+    except (OSError, ValueError):
+        return False
+    return stamp.get('sources') == sources and time.time() - stamp.get('updated', 0) < ttl
+
+
+def update_package_list():
     print('[CHROOT] Updating package list...')
     try:
+        sources = sources_digest()
+        if lists_fresh(sources):
+            print('[CHROOT] Package lists are fresh, skipping update...')
+            return
+
+        # apt only downloads indexes whose InRelease changed, and the apt proxy revalidates them with the mirror
         subprocess.run(['apt-get', 'update'], check=True)
+        os.makedirs(APT_LISTS_STATE, exist_ok=True)
+        json.dump({'updated': time.time(), 'sources': sources}, open(os.path.join(APT_LISTS_STATE, APT_LISTS_STAMP), 'w'))
     except Exception as e:
         traceback.print_exc()
         print("[CHROOT X] Failed to update package list.")
         sys.exit(1)
 
-    
-    print('[CHROOT] Installing software-properties-common...')
-    try:
-        subprocess.run(['apt-get', 'install', 'software-properties-common']+APT_OPTIONS, check=True)
-    except Exception as e:
-        traceback.print_exc()
-        print("[CHROOT X] Failed to install software-properties-common.")
-        sys.exit(1)
 
-    
+def block_unwanted_packages():
     print('[CHROOT] Blocking unwanted packages...')
     try:
         os.makedirs('/etc/apt/preferences.d', exist_ok=True)
@@ -95,10 +223,22 @@ Pin-Priority: -1
         sys.exit(1)
 
 
+def setup_mozilla_repo():
     print('[CHROOT] Setting up Mozilla repo...')
     try:
         os.makedirs('/etc/apt/preferences.d', exist_ok=True)
-        subprocess.run(['add-apt-repository', 'ppa:mozillateam/ppa', '-y'], check=True)
+        os.makedirs(os.path.dirname(MOZILLA_PPA_KEY), exist_ok=True)
+        shutil.copy(os.path.join(DOWNLOAD_DIR, 'mozillateam.asc'), MOZILLA_PPA_KEY)
+
+        release = dict(line.strip().split('=', 1) for line in open('/etc/os-release') if '=' in line)
+        codename = release['VERSION_CODENAME'].strip('"')
+        open(f'/etc/apt/sources.list.d/mozillateam-ubuntu-ppa-{codename}.sources', 'w').write(f"""
+Types: deb
+URIs: {MOZILLA_PPA}
+Suites: {codename}
+Components: main
+Signed-By: {MOZILLA_PPA_KEY}
+""".lstrip())
         open('/etc/apt/preferences.d/mozilla-firefox', 'w').write("""
 Package: firefox*
 Pin: release o=LP-PPA-mozillateam
@@ -110,24 +250,17 @@ Pin-Priority: 501
         sys.exit(1)
 
 
-    print('[CHROOT] Updating package list...')
+def install_system():
+    print('[CHROOT] Installing systemd and upgrading packages...')
     try:
-        subprocess.run(['apt-get', 'update'], check=True)
+        install_plan('system', SYSTEM_PACKAGES, upgrade=True)
     except Exception as e:
         traceback.print_exc()
-        print("[CHROOT X] Failed to update package list.")
-        sys.exit(1)
-
-
-    print('[CHROOT] Installing systemd...')
-    try:
-        subprocess.run(['apt-get', 'install', 'libterm-readline-gnu-perl', 'systemd-sysv', 'dbus-bin']+APT_OPTIONS, check=True)
-    except Exception as e:
-        traceback.print_exc()
-        print("[CHROOT X] Failed to install systemd.")
+        print("[CHROOT X] Failed to install systemd and upgrade packages.")
         sys.exit(1)
 
 
+def setup_machine_id():
     print('[CHROOT] Setting up machine-id and divert...')
     try:
         dbusProc = subprocess.run(['dbus-uuidgen'], check=True, stdout=subprocess.PIPE, text=True)
@@ -135,169 +268,208 @@ Pin-Priority: 501
         subprocess.run(['ln', '-fs', '/etc/machine-id', '/var/lib/dbus/machine-id'], check=True)
         subprocess.run(['dpkg-divert', '--local', '--rename', '--add', '/sbin/initctl'], check=True)
         subprocess.run(['ln', '-s', '/bin/true', '/sbin/initctl'], check=True)
+    except Exception as e:
+        traceback.print_exc()
+        print("[CHROOT X] Failed to set up machine-id and divert.")
+        sys.exit(1)
 
 
-        print('[CHROOT] Updating packages...')
-        try:
-            subprocess.run(['apt-get', 'dist-upgrade']+APT_OPTIONS, check=True)
-        except Exception as e:
-            traceback.print_exc()
-            print("[CHROOT X] Failed to update packages.")
-            sys.exit(1)
+def enable_fast_install():
+    if not FAST_INSTALL:
+        print('[CHROOT] Fast install mode is off, skipping...')
+        return
 
+    print('[CHROOT] Enabling fast install mode...')
+    try:
+        open(FAST_INSTALL_DPKG, 'w').write("force-unsafe-io\n")
+        open(FAST_INSTALL_APT, 'w').write("""
+DPkg::NoTriggers "true";
+DPkg::ConfigurePending "true";
+DPkg::TriggersPending "true";
+""".lstrip())
+
+        subprocess.run(['debconf-set-selections'], input='man-db man-db/auto-update boolean false\n', text=True, check=True)
+        if os.path.exists(MAN_DB_AUTO_UPDATE):
+            os.remove(MAN_DB_AUTO_UPDATE)
+
+        os.makedirs(os.path.dirname(UPDATE_INITRAMFS_CALLS), exist_ok=True)
+        subprocess.run(['dpkg-divert', '--local', '--rename', '--add', UPDATE_INITRAMFS], check=True)
+        open(UPDATE_INITRAMFS, 'w').write(f"""#!/bin/sh
+# Fast install mode, the update-initramfs phase of chroot.py runs it once
+echo "$@" >> {UPDATE_INITRAMFS_CALLS}
+""")
+        os.chmod(UPDATE_INITRAMFS, 0o755)
+    except Exception as e:
+        traceback.print_exc()
+        print("[CHROOT X] Failed to enable fast install mode.")
+        sys.exit(1)
 
-        print('[CHROOT] Installing packages...')
-        try:
-            subprocess.run(['apt-get', 'install']+APT_OPTIONS+PACKAGES, check=True)
-        except Exception as e:
-            traceback.print_exc()
-            print("[CHROOT X] Failed to install packages.")
-            sys.exit(1)
 
+def install_packages():
+    variant = os.environ.get('PASSKILL_VARIANT', 'full')
+    print(f'[CHROOT] Installing packages for the {variant} variant...')
+    try:
+        # Takes what the packages no longer need along in the same transaction
+        install_plan(f'packages-{variant}', VARIANTS[variant], autoremove=True)
+    except Exception as e:
+        traceback.print_exc()
+        print("[CHROOT X] Failed to install packages.")
+        sys.exit(1)
 
-        print('[CHROOT] Cleaning up packages...')
-        try:
-            subprocess.run(['apt-get', 'autoremove', '-y', '--purge'], check=True)
-        except Exception as e:
-            traceback.print_exc()
-            print("[CHROOT X] Failed to clean up packages.")
-            sys.exit(1)
-        
-
-        print('[CHROOT] Unblocking unwanted packages...')
-        try:
-            if os.path.exists('/etc/apt/preferences.d/99-blacklist'):
-                os.remove('/etc/apt/preferences.d/99-blacklist')
-        except Exception as e:
-            traceback.print_exc()
-            print("[CHROOT X] Failed to unblock unwanted packages.")
-            sys.exit(1)
-
-        
-        print('[CHROOT] Configuring casper...')
-        try:
-            open('/etc/casper.conf', 'w').write("""
+
+def unblock_unwanted_packages():
+    print('[CHROOT] Unblocking unwanted packages...')
+    try:
+        if os.path.exists('/etc/apt/preferences.d/99-blacklist'):
+            os.remove('/etc/apt/preferences.d/99-blacklist')
+    except Exception as e:
+        traceback.print_exc()
+        print("[CHROOT X] Failed to unblock unwanted packages.")
+        sys.exit(1)
+
+
+def configure_casper():
+    print('[CHROOT] Configuring casper...')
+    try:
+        open('/etc/casper.conf', 'w').write("""
 export USERNAME="passkill"
 export USERFULLNAME="PassKill live session user"
 export HOST="passkill"
 export BUILD_SYSTEM="Ubuntu"
 export FLAVOUR="PassKill"
 """.strip())
-            with open('/usr/sbin/casper-stop','r+') as f:
-                data=f.read().replace('Please remove the installation medium', 'Please remove the PassKill medium')
-                f.seek(0)
-                f.write(data)
-                f.truncate()
-        except Exception as e:
-            traceback.print_exc()
-            print("[CHROOT X] Failed to configure casper.")
-            sys.exit(1)
-
-
-        print('[CHROOT] Pulling PassKill...')
-        try:
-            subprocess.run(['git', 'clone', 'https://github.com/RileyCampbell2007/PassKill.git', '/passkill'])
-            subprocess.run(['chown', '-R', '1000:1000', '/passkill'])
-            subprocess.run(['chmod', '-R', '755', '/passkill'])
-        except Exception as e:
-            traceback.print_exc()
-            print("[CHROOT X] Failed to pull PassKill.")
-            sys.exit(1)
-        
-
-        print('[CHROOT] Installing PassKill dependencies...')
-        try:
-            try:
-                subprocess.run(['pip', 'install', 'whiptail-dialogs', '--break-system-packages'], check=True)
-            except:
-                subprocess.run(['pip', 'install', 'whiptail-dialogs'], check=True)
-        except Exception as e:
-            traceback.print_exc()
-            print("[CHROOT X] Failed to install PassKill dependencies.")
-            sys.exit(1)
+        with open('/usr/sbin/casper-stop','r+') as f:
+            data=f.read().replace('Please remove the installation medium', 'Please remove the PassKill medium')
+            f.seek(0)
+            f.write(data)
+            f.truncate()
+    except Exception as e:
+        traceback.print_exc()
+        print("[CHROOT X] Failed to configure casper.")
+        sys.exit(1)
+
+
+def pull_passkill():
+    print('[CHROOT] Pulling PassKill...')
+    try:
+        subprocess.run(['git', 'clone', os.path.join(DOWNLOAD_DIR, 'PassKill.git'), '/passkill'])
+        subprocess.run(['git', '-C', '/passkill', 'remote', 'set-url', 'origin', DOWNLOADS['PassKill.git']['url']])
+        subprocess.run(['chown', '-R', '1000:1000', '/passkill'])
+        subprocess.run(['chmod', '-R', '755', '/passkill'])
+    except Exception as e:
+        traceback.print_exc()
+        print("[CHROOT X] Failed to pull PassKill.")
+        sys.exit(1)
 
 
-        print('[CHROOT] Building ntfs-3g-system-compression...')
+def install_passkill_dependencies():
+    print('[CHROOT] Installing PassKill dependencies...')
+    try:
+        wheels = ['--no-index', '--find-links', os.path.join(DOWNLOAD_DIR, 'wheels')]
         try:
-            BUILD_DEPS = ['autoconf', 'automake', 'libtool', 'pkg-config', 'ntfs-3g-dev', 'libfuse-dev', 'build-essential']
+            subprocess.run(['pip', 'install']+wheels+PIP_PACKAGES+['--break-system-packages'], check=True)
+        except:
+            subprocess.run(['pip', 'install']+wheels+PIP_PACKAGES, check=True)
+    except Exception as e:
+        traceback.print_exc()
+        print("[CHROOT X] Failed to install PassKill dependencies.")
+        sys.exit(1)
 
-            installed_packages = subprocess.run(['dpkg-query', '-W', '-f=${binary:Package}\n'], check=True, stdout=subprocess.PIPE, text=True).stdout.splitlines()
-            for package in installed_packages:
-                if package in BUILD_DEPS:
-                    BUILD_DEPS.remove(package)
 
-            subprocess.run(['apt-get', 'install']+BUILD_DEPS+APT_OPTIONS, check=True)
+def build_ntfs_system_compression():
+    print('[CHROOT] Building ntfs-3g-system-compression...')
+    # Runs in a throwaway root that build.py discards, so the build dependencies never need purging
+    try:
+        prefetch_packages(['install']+NTFS_PLUGIN_BUILD_DEPS)
+        subprocess.run(['apt-get', 'install']+NTFS_PLUGIN_BUILD_DEPS+APT_OPTIONS, check=True)
 
-            subprocess.run(['git', 'clone', 'https://github.com/ebiggers/ntfs-3g-system-compression.git', '/ntfs-3g-system-compression'], check=True)
-            subprocess.run(['autoreconf', '-i'], check=True, cwd='/ntfs-3g-system-compression')
-            subprocess.run(['chmod', '+x', '/ntfs-3g-system-compression/configure'], check=True)
-            subprocess.run(['/ntfs-3g-system-compression/configure'], check=True, cwd='/ntfs-3g-system-compression')
-            subprocess.run(['make'], check=True, cwd='/ntfs-3g-system-compression')
+        subprocess.run(['git', 'clone', os.path.join(DOWNLOAD_DIR, 'ntfs-3g-system-compression.git'), '/ntfs-3g-system-compression'], check=True)
+        subprocess.run(['autoreconf', '-i'], check=True, cwd='/ntfs-3g-system-compression')
+        subprocess.run(['chmod', '+x', '/ntfs-3g-system-compression/configure'], check=True)
+        subprocess.run(['/ntfs-3g-system-compression/configure'], check=True, cwd='/ntfs-3g-system-compression')
+        subprocess.run(['make'], check=True, cwd='/ntfs-3g-system-compression')
 
-            result = subprocess.run(["ntfs-3g", "-h"], capture_output=True, text=True)
+        plugin = None
+        for root, dirs, files in os.walk("/ntfs-3g-system-compression"):
+            for file in files:
+                if file == NTFS_PLUGIN:
+                    plugin = os.path.join(root, file)
 
-            plugin_path = None
-            for line in result.stderr.splitlines() + result.stdout.splitlines():
-                if line.startswith("Plugin path: "):
-                    plugin_path = line.split(":", 1)[1].strip()
-                    break
+        if not plugin:
+            raise Exception(f"The build did not produce {NTFS_PLUGIN}")
 
-            for root, dirs, files in os.walk("/ntfs-3g-system-compression"):
-                for file in files:
-                    if file == "ntfs-plugin-80000017.so":
-                        plugin = os.path.join(root, file)
+        subprocess.run(['cp', plugin, os.path.join(NTFS_PLUGIN_DIR, NTFS_PLUGIN)], check=True)
+    except Exception as e:
+        traceback.print_exc()
+        print("[CHROOT X] Failed to build ntfs-3g-system-compression.")
+        sys.exit(1)
 
-            os.makedirs(plugin_path, exist_ok=True)
-            subprocess.run(['cp', plugin, os.path.join(plugin_path, 'ntfs-plugin-80000017.so')], check=True)
 
-            subprocess.run(['apt-get', 'purge']+BUILD_DEPS+APT_OPTIONS, check=True)
-            subprocess.run(['apt-get', 'autoremove', '-y', '--purge'], check=True)
-            shutil.rmtree('/ntfs-3g-system-compression')
-        except Exception as e:
-            traceback.print_exc()
-            print("[CHROOT X] Failed to build ntfs-3g-system-compression.")
-            sys.exit(1)
+def install_ntfs_system_compression():
+    print('[CHROOT] Installing ntfs-3g-system-compression...')
+    try:
+        result = subprocess.run(["ntfs-3g", "-h"], capture_output=True, text=True)
 
+        plugin_path = None
+        for line in result.stderr.splitlines() + result.stdout.splitlines():
+            if line.startswith("Plugin path: "):
+                plugin_path = line.split(":", 1)[1].strip()
+                break
 
-        print('[CHROOT] Disabling GDM and enabling getty on tty1...')
-        try:
-            subprocess.run(['systemctl', 'disable', 'gdm.service'], check=True)
-            subprocess.run(['systemctl', 'unmask', 'getty@tty1.tty'], check=True)
-            subprocess.run(['systemctl', 'enable', 'getty@tty1.tty'], check=True)
-        except Exception as e:
-            traceback.print_exc()
-            print("[CHROOT X] Failed to disable GDM and enable getty on tty1.")
-            sys.exit(1)
+        if not plugin_path:
+            raise Exception("ntfs-3g does not report a plugin path")
 
+        os.makedirs(plugin_path, exist_ok=True)
+        subprocess.run(['cp', os.path.join(NTFS_PLUGIN_DIR, NTFS_PLUGIN), os.path.join(plugin_path, NTFS_PLUGIN)], check=True)
+    except Exception as e:
+        traceback.print_exc()
+        print("[CHROOT X] Failed to install ntfs-3g-system-compression.")
+        sys.exit(1)
 
-        print('[CHROOT] Creating systemd preset for getty@tty1...')
-        try:
-            os.makedirs('/etc/systemd/system-preset', exist_ok=True)
-            open('/etc/systemd/system-preset/00-force-getty.preset','w').write("""
+
+def disable_gdm():
+    print('[CHROOT] Disabling GDM and enabling getty on tty1...')
+    try:
+        subprocess.run(['systemctl', 'disable', 'gdm.service'], check=True)
+        subprocess.run(['systemctl', 'unmask', 'getty@tty1.tty'], check=True)
+        subprocess.run(['systemctl', 'enable', 'getty@tty1.tty'], check=True)
+    except Exception as e:
+        traceback.print_exc()
+        print("[CHROOT X] Failed to disable GDM and enable getty on tty1.")
+        sys.exit(1)
+
+
+def create_getty_preset():
+    print('[CHROOT] Creating systemd preset for getty@tty1...')
+    try:
+        os.makedirs('/etc/systemd/system-preset', exist_ok=True)
+        open('/etc/systemd/system-preset/00-force-getty.preset','w').write("""
 enable getty@tty1.service
 """.strip())
 
-        except Exception as e:
-            traceback.print_exc()
-            print("[CHROOT X] Failed to create systemd preset for getty@tty1.")
-            sys.exit(1)
-        
+    except Exception as e:
+        traceback.print_exc()
+        print("[CHROOT X] Failed to create systemd preset for getty@tty1.")
+        sys.exit(1)
 
-        print('[CHROOT] Force unmasking getty@tty1.service...')
-        try:
-            subprocess.run(['systemctl', 'disable', 'getty@tty1.service'], check=True)
-            subprocess.run(['ln', '-s', '/lib/systemd/system/getty@.service', '/etc/systemd/system/getty@tty1.service'], check=True)
-            subprocess.run(['ln', '-s', '/lib/systemd/system/getty@.service', '/lib/systemd/system/getty@tty1.service'], check=True)
-            subprocess.run(['systemctl', 'enable', 'getty@tty1.service'], check=True)
-        except Exception as e:
-            traceback.print_exc()
-            print("[CHROOT X] Failed to force unmask getty@tty1.service.")
-            sys.exit(1)
-        
-
-        print('[CHROOT] Creating systemd service to restart getty@tty1 after GDM stops...')
-        try:
-            open('/etc/systemd/system/wait-gdm-restart-getty.service', 'w').write("""
+
+def unmask_getty():
+    print('[CHROOT] Force unmasking getty@tty1.service...')
+    try:
+        subprocess.run(['systemctl', 'disable', 'getty@tty1.service'], check=True)
+        subprocess.run(['ln', '-s', '/lib/systemd/system/getty@.service', '/etc/systemd/system/getty@tty1.service'], check=True)
+        subprocess.run(['ln', '-s', '/lib/systemd/system/getty@.service', '/lib/systemd/system/getty@tty1.service'], check=True)
+        subprocess.run(['systemctl', 'enable', 'getty@tty1.service'], check=True)
+    except Exception as e:
+        traceback.print_exc()
+        print("[CHROOT X] Failed to force unmask getty@tty1.service.")
+        sys.exit(1)
+
+
+def create_getty_restart_service():
+    print('[CHROOT] Creating systemd service to restart getty@tty1 after GDM stops...')
+    try:
+        open('/etc/systemd/system/wait-gdm-restart-getty.service', 'w').write("""
 [Unit]
 Description=Restart getty@tty1 after GDM stops
 After=gdm.service
@@ -310,26 +482,28 @@ RemainAfterExit=true
 [Install]
 WantedBy=multi-user.target
 """.strip())
-            subprocess.run(['systemctl', 'enable', 'wait-gdm-restart-getty.service'], check=True)
-        except Exception as e:
-            traceback.print_exc()
-            print("[CHROOT X] Failed to create systemd service to restart getty@tty1 after GDM stops.")
-            sys.exit(1)
+        subprocess.run(['systemctl', 'enable', 'wait-gdm-restart-getty.service'], check=True)
+    except Exception as e:
+        traceback.print_exc()
+        print("[CHROOT X] Failed to create systemd service to restart getty@tty1 after GDM stops.")
+        sys.exit(1)
 
 
-        print('[CHROOT] Setting up getty autologin for UID 1000 user on all ttys...')
-        os.makedirs('/etc/systemd/system/getty@.service.d', exist_ok=True)
-        open('/etc/systemd/system/getty@.service.d/override.conf','w').write("""
+def setup_getty_autologin():
+    print('[CHROOT] Setting up getty autologin for UID 1000 user on all ttys...')
+    os.makedirs('/etc/systemd/system/getty@.service.d', exist_ok=True)
+    open('/etc/systemd/system/getty@.service.d/override.conf','w').write("""
 [Service]
 ExecStart=
 ExecStart=-/bin/bash -c "/sbin/agetty --autologin $(getent passwd 1000 | cut -d: -f1) --noclear %I $TERM"
 """.strip())
-        
 
-        print('[CHROOT] Setting up Exit Gnome shortcut...')
-        try:
-            os.makedirs('/etc/skel/Desktop', exist_ok=True)
-            open('/etc/skel/Desktop/Exit Gnome.desktop', 'w').write("""
+
+def setup_exit_gnome_shortcut():
+    print('[CHROOT] Setting up Exit Gnome shortcut...')
+    try:
+        os.makedirs('/etc/skel/Desktop', exist_ok=True)
+        open('/etc/skel/Desktop/Exit Gnome.desktop', 'w').write("""
 [Desktop Entry]
 Name=Exit Gnome
 Exec=/bin/bash -c 'zenity --question --title "Exit Gnome" --text "Exiting Gnome will also close any open windows.\\nAre you sure you want to exit Gnome?" && sudo systemctl stop gdm.service'
@@ -338,17 +512,18 @@ Terminal=false
 Icon=/usr/share/icons/exit_gnome.png
 Type=Application
 """.strip())
-            subprocess.run(['chmod', '+x', '/etc/skel/Desktop/Exit Gnome.desktop'], check=True)
-        except Exception as e:
-            traceback.print_exc()
-            print("[CHROOT X] Failed to set up Exit Gnome shortcut.")
-            sys.exit(1)
-        
-
-        print('[CHROOT] Registering profile script...')
-        try:
-            os.makedirs('/etc/profile.d', exist_ok=True)
-            open('/etc/profile.d/passkill.sh', 'w').write("""
+        subprocess.run(['chmod', '+x', '/etc/skel/Desktop/Exit Gnome.desktop'], check=True)
+    except Exception as e:
+        traceback.print_exc()
+        print("[CHROOT X] Failed to set up Exit Gnome shortcut.")
+        sys.exit(1)
+
+
+def register_profile_script():
+    print('[CHROOT] Registering profile script...')
+    try:
+        os.makedirs('/etc/profile.d', exist_ok=True)
+        open('/etc/profile.d/passkill.sh', 'w').write("""
 # Trust the Exit Gnome shortcut if it exists
 if [ -f "$HOME/Desktop/Exit Gnome.desktop" ]; then
   gio set "$HOME/Desktop/Exit Gnome.desktop" "metadata::trusted" true 2>/dev/null || true
@@ -358,53 +533,60 @@ fi
 if [ -z "$PASSKILL" ]; then
     if [[ "$(tty)" == "/dev/tty1" ]]; then
         PASSKILL="value"
+        # Boot time marker for bootbench.py, it reads the kernel log on the serial console. It is
+        # logged as critical, kernel.printk keeps the default level off the console
+        if grep -qw passkill.bootmark /proc/cmdline; then
+            echo "<2>PASSKILL-BOOT-MARK launch" | sudo tee /dev/kmsg >/dev/null 2>&1 || true
+        fi
         cd /passkill/
         sudo /usr/bin/env python3 /passkill/main.py
     fi
 fi
 """.strip())
-        except Exception as e:
-            traceback.print_exc()
-            print("[CHROOT X] Failed to register profile script.")
-            sys.exit(1)
+    except Exception as e:
+        traceback.print_exc()
+        print("[CHROOT X] Failed to register profile script.")
+        sys.exit(1)
 
 
-        print('[CHROOT] Setting up plymouth...')
-        try:
-            subprocess.run(['update-alternatives', '--install', '/usr/share/plymouth/themes/default.plymouth', 'default.plymouth', '/usr/share/plymouth/themes/passkill/passkill.plymouth', '10'], check=True)
-            subprocess.run(['update-alternatives', '--set', 'default.plymouth', '/usr/share/plymouth/themes/passkill/passkill.plymouth'], check=True)
-        except Exception as e:
-            traceback.print_exc()
-            print("[CHROOT X] Failed to set up plymouth.")
-            sys.exit(1)
+def setup_plymouth():
+    print('[CHROOT] Setting up plymouth...')
+    try:
+        subprocess.run(['update-alternatives', '--install', '/usr/share/plymouth/themes/default.plymouth', 'default.plymouth', '/usr/share/plymouth/themes/passkill/passkill.plymouth', '10'], check=True)
+        subprocess.run(['update-alternatives', '--set', 'default.plymouth', '/usr/share/plymouth/themes/passkill/passkill.plymouth'], check=True)
+    except Exception as e:
+        traceback.print_exc()
+        print("[CHROOT X] Failed to set up plymouth.")
+        sys.exit(1)
 
 
-        print('[CHROOT] Setting sidebar apps and theme...')
-        try:
-            gschema = configparser.ConfigParser()
-            gschema.read('/usr/share/glib-2.0/schemas/10_ubuntu-settings.gschema.override')
-
-            favoriteApps = "['firefox.desktop', 'org.gnome.Nautilus.desktop', 'org.gnome.Terminal.desktop', 'org.gnome.DiskUtility.desktop', 'gparted.desktop']"
-
-            gschema['org.gnome.shell']['favorite-apps'] = favoriteApps
-            gschema['org.gnome.desktop.interface']['gtk-theme'] = '"Yaru-dark"'
-            gschema['org.gnome.desktop.interface']['icon-theme'] = '"Yaru-dark"'
-            gschema['org.gnome.desktop.interface:GNOME-Greeter']['gtk-theme'] = '"Yaru-dark"'
-            gschema['org.gnome.desktop.interface:GNOME-Greeter']['icon-theme'] = '"Yaru-dark"'
-            gschema['org.gnome.shell:ubuntu']['favorite-apps'] = favoriteApps
-            gschema['org.gnome.desktop.interface:ubuntu']['gtk-theme'] = '"Yaru-dark"'
-            gschema['org.gnome.desktop.interface:ubuntu']['icon-theme'] = '"Yaru-dark"'
-
-            gschema.write(open('/usr/share/glib-2.0/schemas/10_ubuntu-settings.gschema.override', 'w'))
-
-            os.makedirs('/etc/dconf/profile', exist_ok=True)
-            os.makedirs('/etc/dconf/db/local.d', exist_ok=True)
-            
-            open('/etc/dconf/profile/user', 'w').write("""
+def set_sidebar_apps_and_theme():
+    print('[CHROOT] Setting sidebar apps and theme...')
+    try:
+        gschema = configparser.ConfigParser()
+        gschema.read('/usr/share/glib-2.0/schemas/10_ubuntu-settings.gschema.override')
+
+        favoriteApps = "['firefox.desktop', 'org.gnome.Nautilus.desktop', 'org.gnome.Terminal.desktop', 'org.gnome.DiskUtility.desktop', 'gparted.desktop']"
+
+        gschema['org.gnome.shell']['favorite-apps'] = favoriteApps
+        gschema['org.gnome.desktop.interface']['gtk-theme'] = '"Yaru-dark"'
+        gschema['org.gnome.desktop.interface']['icon-theme'] = '"Yaru-dark"'
+        gschema['org.gnome.desktop.interface:GNOME-Greeter']['gtk-theme'] = '"Yaru-dark"'
+        gschema['org.gnome.desktop.interface:GNOME-Greeter']['icon-theme'] = '"Yaru-dark"'
+        gschema['org.gnome.shell:ubuntu']['favorite-apps'] = favoriteApps
+        gschema['org.gnome.desktop.interface:ubuntu']['gtk-theme'] = '"Yaru-dark"'
+        gschema['org.gnome.desktop.interface:ubuntu']['icon-theme'] = '"Yaru-dark"'
+
+        gschema.write(open('/usr/share/glib-2.0/schemas/10_ubuntu-settings.gschema.override', 'w'))
+
+        os.makedirs('/etc/dconf/profile', exist_ok=True)
+        os.makedirs('/etc/dconf/db/local.d', exist_ok=True)
+
+        open('/etc/dconf/profile/user', 'w').write("""
 user-db:user
 system-db:local
 """.strip())
-            open('/etc/dconf/db/local.d/00-passkill','w').write("""
+        open('/etc/dconf/db/local.d/00-passkill','w').write("""
 [org/gnome/desktop/interface]
 gtk-theme='Yaru-dark'
 icon-theme='Yaru-dark'
@@ -413,15 +595,16 @@ color-scheme='prefer-dark'
 [org/gnome/shell]
 favorite-apps=['firefox.desktop','org.gnome.Nautilus.desktop','org.gnome.Terminal.desktop','org.gnome.DiskUtility.desktop','gparted.desktop']
 """.strip())
-        except Exception as e:
-            traceback.print_exc()
-            print("[CHROOT X] Failed to set sidebar apps and theme.")
-            sys.exit(1)
+    except Exception as e:
+        traceback.print_exc()
+        print("[CHROOT X] Failed to set sidebar apps and theme.")
+        sys.exit(1)
 
 
-        print('[CHROOT] Setting power settings...')
-        try:
-            open('/usr/share/glib-2.0/schemas/99_passkill-power-settings.gschema.override', 'w').write("""
+def set_power_settings():
+    print('[CHROOT] Setting power settings...')
+    try:
+        open('/usr/share/glib-2.0/schemas/99_passkill-power-settings.gschema.override', 'w').write("""
 [org.gnome.desktop.session]
 # Set idle-delay to 0 to disable screen blanking due to inactivity
 idle-delay=uint32 0
@@ -435,33 +618,36 @@ sleep-inactive-ac-type='nothing'
 sleep-inactive-battery-timeout=0
 sleep-inactive-ac-timeout=0
 """.strip())
-        except Exception as e:
-            traceback.print_exc()
-            print("[CHROOT X] Failed to set power settings.")
-            sys.exit(1)
+    except Exception as e:
+        traceback.print_exc()
+        print("[CHROOT X] Failed to set power settings.")
+        sys.exit(1)
 
 
-        print('[CHROOT] Recompiling GSettings schemas...')
-        try:
-            subprocess.run(['glib-compile-schemas', '/usr/share/glib-2.0/schemas'], check=True)
-        except Exception as e:
-            traceback.print_exc()
-            print("[CHROOT X] Failed to compile GSettings schemas.")
-            sys.exit(1)
+def compile_gsettings_schemas():
+    print('[CHROOT] Recompiling GSettings schemas...')
+    try:
+        subprocess.run(['glib-compile-schemas', '/usr/share/glib-2.0/schemas'], check=True)
+    except Exception as e:
+        traceback.print_exc()
+        print("[CHROOT X] Failed to compile GSettings schemas.")
+        sys.exit(1)
 
 
-        print('[CHROOT] Recompiling dconf...')
-        try:
-            subprocess.run(['dconf', 'update'], check=True)
-        except Exception as e:
-            traceback.print_exc()
-            print("[CHROOT X] Failed to compile dconf.")
-            sys.exit(1)
-
-        
-        print('[CHROOT] Configuring NetworkManager...')
-        try:
-            open('/etc/NetworkManager/NetworkManager.conf', 'w').write("""
+def compile_dconf():
+    print('[CHROOT] Recompiling dconf...')
+    try:
+        subprocess.run(['dconf', 'update'], check=True)
+    except Exception as e:
+        traceback.print_exc()
+        print("[CHROOT X] Failed to compile dconf.")
+        sys.exit(1)
+
+
+def configure_network_manager():
+    print('[CHROOT] Configuring NetworkManager...')
+    try:
+        open('/etc/NetworkManager/NetworkManager.conf', 'w').write("""
 [main]
 plugins=ifupdown,keyfile
 dns=systemd-resolved
@@ -469,81 +655,169 @@ dns=systemd-resolved
 [ifupdown]
 managed=false
 """.strip())
-            
-            open('/etc/NetworkManager/conf.d/10-globally-managed-devices.conf', 'w').write("")
-            subprocess.run(['dpkg-reconfigure', 'network-manager'], check=True)
-        except Exception as e:
-            traceback.print_exc()
-            print("[CHROOT X] Failed to configure NetworkManager.")
-            sys.exit(1)
 
+        open('/etc/NetworkManager/conf.d/10-globally-managed-devices.conf', 'w').write("")
+        subprocess.run(['dpkg-reconfigure', 'network-manager'], check=True)
+    except Exception as e:
+        traceback.print_exc()
+        print("[CHROOT X] Failed to configure NetworkManager.")
+        sys.exit(1)
 
-        print('[CHRROT] Setting environment variables...')
-        try:
-            environVars = {
-                "NEWT_COLORS_FILE": "/etc/newt/palette"
-            }
-            with open('/etc/environment', 'r') as environment:
-                data = environment.read()
-            if len(data) != 0 and not data.endswith('\n'):
-                with open('/etc/environment', 'a') as environment:
-                    environment.write('\n')
-            with open('/etc/environment', 'a') as environment:
-                for key, value in environVars.items():
-                    environment.write(f"{key}={value}\n")
-        except Exception as e:
-            traceback.print_exc()
-            print("[CHROOT X] Failed to set environment variables.")
-            sys.exit(1)
 
+def set_environment_variables():
+    print('[CHRROT] Setting environment variables...')
+    try:
+        environVars = {
+            "NEWT_COLORS_FILE": "/etc/newt/palette"
+        }
+        with open('/etc/environment', 'r') as environment:
+            data = environment.read()
+        if len(data) != 0 and not data.endswith('\n'):
+            with open('/etc/environment', 'a') as environment:
+                environment.write('\n')
+        with open('/etc/environment', 'a') as environment:
+            for key, value in environVars.items():
+                environment.write(f"{key}={value}\n")
+    except Exception as e:
+        traceback.print_exc()
+        print("[CHROOT X] Failed to set environment variables.")
+        sys.exit(1)
 
 
-        print('[CHROOT] Updating initramfs...')
-        try:
+def deferred_initramfs_kernels():
+    """Return the kernels update-initramfs was asked to create an initramfs for while it was diverted."""
+    kernels = []
+    if not os.path.exists(UPDATE_INITRAMFS_CALLS):
+        return kernels
+
+    for line in open(UPDATE_INITRAMFS_CALLS):
+        args = line.split()
+        if '-c' in args and '-k' in args[:-1]:
+            kernel = args[args.index('-k') + 1]
+            # Kernels that were removed again have no modules left
+            if kernel not in kernels and os.path.isdir(os.path.join('/lib/modules', kernel)):
+                kernels.append(kernel)
+    return kernels
+
+
+def configure_initramfs(confdir, profile):
+    """Write profile, {'modules', 'compress', 'level'} with any of them left out, into the initramfs-tools configuration in confdir."""
+    settings = {'MODULES': profile.get('modules'), 'COMPRESS': profile.get('compress'), 'COMPRESSLEVEL': profile.get('level')}
+    os.makedirs(os.path.join(confdir, 'conf.d'), exist_ok=True)
+    open(os.path.join(confdir, INITRAMFS_CONF), 'w').write("".join(f"{name}={value}\n" for name, value in settings.items() if value is not None))
+
+    modules = os.path.join(confdir, 'modules')
+    data = open(modules).read() if os.path.exists(modules) else ''
+    listed = data.split('\n')
+    with open(modules, 'a') as f:
+        if data and not data.endswith('\n'):
+            f.write('\n')
+        for module in INITRAMFS_REQUIRED_MODULES:
+            if module not in listed:
+                f.write(module + '\n')
+
+
+def missing_from_initramfs(listing, builtin):
+    """Return the required modules and files that are not in an initramfs.
+
+    listing holds the paths lsinitramfs printed, builtin the lines of the
+    modules.builtin of its kernel.
+    """
+    files = set(path.strip().lstrip('./') for path in listing)
+    modules = set(os.path.basename(path).split('.ko')[0].replace('-', '_') for path in list(files) + list(builtin) if '.ko' in path)
+    return [module for module in INITRAMFS_REQUIRED_MODULES if module.replace('-', '_') not in modules] + [file for file in INITRAMFS_REQUIRED_FILES if file not in files]
+
+
+def check_initramfs(initrd, kernel):
+    listing = subprocess.run(['lsinitramfs', initrd], check=True, stdout=subprocess.PIPE, text=True).stdout.splitlines()
+    builtin = open(os.path.join('/lib/modules', kernel, 'modules.builtin')).read().splitlines()
+    missing = missing_from_initramfs(listing, builtin)
+    if missing:
+        raise Exception(f"{initrd} is missing {', '.join(missing)}")
+    print(f'[CHROOT] {initrd} is {os.path.getsize(initrd) / 1048576:.1f} MiB and has every module the live boot needs')
+
+
+def update_initramfs():
+    print('[CHROOT] Updating initramfs...')
+    try:
+        kernels = []
+        if FAST_INSTALL:
+            kernels = deferred_initramfs_kernels()
+            os.remove(UPDATE_INITRAMFS)
+            subprocess.run(['dpkg-divert', '--local', '--rename', '--remove', UPDATE_INITRAMFS], check=True)
+            shutil.rmtree(os.path.dirname(UPDATE_INITRAMFS_CALLS))
+
+        configure_initramfs('/etc/initramfs-tools', INITRAMFS_PROFILE)
+        for kernel in kernels:
+            print(f'[CHROOT] Creating the deferred initramfs for {kernel}...')
+            subprocess.run(['update-initramfs', '-c', '-k', kernel], check=True)
+        if not kernels:
             subprocess.run(['update-initramfs', '-u'], check=True)
-        except Exception as e:
-            traceback.print_exc()
-            print("[CHROOT X] Failed to update initramfs.")
-            sys.exit(1)
-        
 
-        print('[CHROOT] Building image files...')
-        try:
-            os.makedirs('/image/casper', exist_ok=True)
-            os.makedirs('/image/isolinux', exist_ok=True)
-            os.makedirs('/image/install', exist_ok=True)
-
-            initrd_options = []
-            vmlinuz_options = []
-
-            for path in os.listdir('/boot'):
-                if os.path.isdir(os.path.join('/boot', path)) or os.path.islink(os.path.join('/boot', path)):
-                    continue
-                
-                if path.startswith('initrd.img'):
-                    initrd_options.append(os.path.join('/boot', path))
-                if path.startswith('vmlinuz'):
-                    vmlinuz_options.append(os.path.join('/boot', path))
-            
-            initrd_options.sort(reverse=True)
-            vmlinuz_options.sort(reverse=True)
-
-            if not initrd_options or not vmlinuz_options:
-                raise Exception("Could not find initrd.img or vmlinuz in /boot")
-
-            subprocess.run(['cp', vmlinuz_options[0], '/image/casper/vmlinuz'], check=True)
-            subprocess.run(['cp', initrd_options[0], '/image/casper/initrd'], check=True)
-
-            memtestUrl = 'https://memtest.org/download/v7.00/mt86plus_7.00.binaries.zip'
-            memtestZip = requests.get(memtestUrl)
-            open('/image/install/memtest86.zip', 'wb').write(memtestZip.content)
-            open('/image/install/memtest86+.bin', 'wb').write(subprocess.run(['unzip', '-p', '/image/install/memtest86.zip', 'memtest64.bin'], check=True, stdout=subprocess.PIPE).stdout)
-            open('/image/install/memtest86+.efi', 'wb').write(subprocess.run(['unzip', '-p', '/image/install/memtest86.zip', 'memtest64.efi'], check=True, stdout=subprocess.PIPE).stdout)
-            os.remove('/image/install/memtest86.zip')
-
-            open('/image/passkill', 'w').write("")
-
-            open('/image/isolinux/grub.cfg', 'w').write("""
+        for path in sorted(glob.glob('/boot/initrd.img-*')):
+            check_initramfs(path, os.path.basename(path)[len('initrd.img-'):])
+    except Exception as e:
+        traceback.print_exc()
+        print("[CHROOT X] Failed to update initramfs.")
+        sys.exit(1)
+
+
+def copy_kernel():
+    print('[CHROOT] Copying kernel...')
+    try:
+        os.makedirs('/image/casper', exist_ok=True)
+
+        initrd_options = []
+        vmlinuz_options = []
+
+        for path in os.listdir('/boot'):
+            if os.path.isdir(os.path.join('/boot', path)) or os.path.islink(os.path.join('/boot', path)):
+                continue
+
+            if path.startswith('initrd.img'):
+                initrd_options.append(os.path.join('/boot', path))
+            if path.startswith('vmlinuz'):
+                vmlinuz_options.append(os.path.join('/boot', path))
+
+        initrd_options.sort(reverse=True)
+        vmlinuz_options.sort(reverse=True)
+
+        if not initrd_options or not vmlinuz_options:
+            raise Exception("Could not find initrd.img or vmlinuz in /boot")
+
+        subprocess.run(['cp', vmlinuz_options[0], '/image/casper/vmlinuz'], check=True)
+        subprocess.run(['cp', initrd_options[0], '/image/casper/initrd'], check=True)
+    except Exception as e:
+        traceback.print_exc()
+        print("[CHROOT X] Failed to copy kernel.")
+        sys.exit(1)
+
+
+def build_image_files():
+    print('[CHROOT] Building image files...')
+    try:
+        os.makedirs('/image/isolinux', exist_ok=True)
+        os.makedirs('/image/install', exist_ok=True)
+
+        memtestZip = os.path.join(DOWNLOAD_DIR, 'memtest86.zip')
+        open('/image/install/memtest86+.bin', 'wb').write(subprocess.run(['unzip', '-p', memtestZip, 'memtest64.bin'], check=True, stdout=subprocess.PIPE).stdout)
+        open('/image/install/memtest86+.efi', 'wb').write(subprocess.run(['unzip', '-p', memtestZip, 'memtest64.efi'], check=True, stdout=subprocess.PIPE).stdout)
+
+        open('/image/passkill', 'w').write("")
+
+        # With a layered squashfs, entries that copy only the first layers to RAM
+        layer_entries = ""
+        if LAYERED_SQUASHFS:
+            for title, directory, _ in squashfs_ram_layers():
+                layer_entries += f"""
+menuentry "Launch PassKill to RAM ({title} only)" {{
+    set gfxpayload=keep
+    linux /casper/vmlinuz boot=casper live-media-path={directory} nopersistent quiet splash toram ---
+    initrd /casper/initrd
+}}
+"""
+
+        open('/image/isolinux/grub.cfg', 'w').write(("""
 search --set=root --file /passkill
 
 insmod all_video
@@ -567,7 +841,7 @@ menuentry "Launch PassKill to RAM" {
     linux /casper/vmlinuz boot=casper nopersistent quiet splash toram ---
     initrd /casper/initrd
 }
-
+""" + layer_entries + """
 menuentry "Launch PassKill (Safe Graphics)" {
     set gfxpayload=keep
     linux /casper/vmlinuz boot=casper nopersistent quiet splash nomodeset ---
@@ -598,9 +872,9 @@ fi
 menuentry 'Boot from next volume' {
     exit 1
 }
-""".strip())
-            
-            open('/image/README.diskdefines', 'w').write("""
+""").strip())
+
+        open('/image/README.diskdefines', 'w').write("""
     #define DISKNAME  PassKill
     #define TYPE  binary
     #define TYPEbinary  1
@@ -611,74 +885,182 @@ menuentry 'Boot from next volume' {
     #define TOTALNUM  0
     #define TOTALNUM0  1
     """.strip())
-        except Exception as e:
-            traceback.print_exc()
-            print("[CHROOT X] Failed to build image files.")
-            sys.exit(1)
+    except Exception as e:
+        traceback.print_exc()
+        print("[CHROOT X] Failed to build image files.")
+        sys.exit(1)
 
 
-        print('[CHROOT] Creating image...')
-        try:
-            subprocess.run(['cp', '/usr/lib/shim/shimx64.efi.signed', '/image/isolinux/bootx64.efi'], check=True)
-            subprocess.run(['cp', '/usr/lib/shim/mmx64.efi', '/image/isolinux/mmx64.efi'], check=True)
-            subprocess.run(['cp', '/usr/lib/grub/x86_64-efi-signed/grubx64.efi.signed', '/image/isolinux/grubx64.efi'], check=True)
-
-            open('/image/isolinux/efiboot.img', 'wb').write(b"\x00"*10485760)
-            subprocess.run(['mkfs.vfat', '-F', '16', '/image/isolinux/efiboot.img'], check=True)
-            environ = os.environ.copy()
-            environ['LC_CTYPE']='C'
-            subprocess.run(['mmd', '-i', 'efiboot.img', 'efi', 'efi/ubuntu', 'efi/boot'], check=True, env=environ, cwd='/image/isolinux/')
-            subprocess.run(['mcopy', '-i', 'efiboot.img', './bootx64.efi', '::efi/boot/bootx64.efi'], check=True, env=environ, cwd='/image/isolinux/')
-            subprocess.run(['mcopy', '-i', 'efiboot.img', './mmx64.efi', '::efi/boot/mmx64.efi'], check=True, env=environ, cwd='/image/isolinux/')
-            subprocess.run(['mcopy', '-i', 'efiboot.img', './grubx64.efi', '::efi/boot/grubx64.efi'], check=True, env=environ, cwd='/image/isolinux/')
-            subprocess.run(['mcopy', '-i', 'efiboot.img', './grub.cfg', '::efi/ubuntu/grub.cfg'], check=True, env=environ, cwd='/image/isolinux/')
-
-            subprocess.run([
-                "grub-mkstandalone",
-                    "--format=i386-pc",
-                    "--output=/image/isolinux/core.img",
-                    '--install-modules=linux16 linux normal iso9660 biosdisk memdisk search tar ls',
-                    '--modules=linux16 linux normal iso9660 biosdisk search',
-                    '--locales=',
-                    '--fonts=',
-                    'boot/grub/grub.cfg=/image/isolinux/grub.cfg',
-            ], check=True)
-
-            with open('/image/isolinux/bios.img', 'wb') as f:
-                f.write(open('/usr/lib/grub/i386-pc/cdboot.img', 'rb').read())
-                f.write(open('/image/isolinux/core.img', 'rb').read())
-            
-            subprocess.run(['/bin/bash', '-c', "(find /image -type f -print0 | xargs -0 md5sum | grep -v -e '/image/isolinux' > /image/md5sum.txt)"], check=True)
-        except Exception as e:
-            traceback.print_exc()
-            print("[CHROOT X] Failed to create image.")
-            sys.exit(1)
+def create_image():
+    print('[CHROOT] Creating image...')
+    try:
+        subprocess.run(['cp', '/usr/lib/shim/shimx64.efi.signed', '/image/isolinux/bootx64.efi'], check=True)
+        subprocess.run(['cp', '/usr/lib/shim/mmx64.efi', '/image/isolinux/mmx64.efi'], check=True)
+        subprocess.run(['cp', '/usr/lib/grub/x86_64-efi-signed/grubx64.efi.signed', '/image/isolinux/grubx64.efi'], check=True)
+
+        open('/image/isolinux/efiboot.img', 'wb').write(b"\x00"*10485760)
+        subprocess.run(['mkfs.vfat', '-F', '16', '/image/isolinux/efiboot.img'], check=True)
+        environ = os.environ.copy()
+        environ['LC_CTYPE']='C'
+        subprocess.run(['mmd', '-i', 'efiboot.img', 'efi', 'efi/ubuntu', 'efi/boot'], check=True, env=environ, cwd='/image/isolinux/')
+        subprocess.run(['mcopy', '-i', 'efiboot.img', './bootx64.efi', '::efi/boot/bootx64.efi'], check=True, env=environ, cwd='/image/isolinux/')
+        subprocess.run(['mcopy', '-i', 'efiboot.img', './mmx64.efi', '::efi/boot/mmx64.efi'], check=True, env=environ, cwd='/image/isolinux/')
+        subprocess.run(['mcopy', '-i', 'efiboot.img', './grubx64.efi', '::efi/boot/grubx64.efi'], check=True, env=environ, cwd='/image/isolinux/')
+        subprocess.run(['mcopy', '-i', 'efiboot.img', './grub.cfg', '::efi/ubuntu/grub.cfg'], check=True, env=environ, cwd='/image/isolinux/')
+
+        subprocess.run([
+            "grub-mkstandalone",
+                "--format=i386-pc",
+                "--output=/image/isolinux/core.img",
+                '--install-modules=linux16 linux normal iso9660 biosdisk memdisk search tar ls',
+                '--modules=linux16 linux normal iso9660 biosdisk search',
+                '--locales=',
+                '--fonts=',
+                'boot/grub/grub.cfg=/image/isolinux/grub.cfg',
+        ], check=True)
+
+        with open('/image/isolinux/bios.img', 'wb') as f:
+            f.write(open('/usr/lib/grub/i386-pc/cdboot.img', 'rb').read())
+            f.write(open('/image/isolinux/core.img', 'rb').read())
+
+        # md5sum.txt is written by build.py once filesystem.squashfs is in the image
+    except Exception as e:
+        traceback.print_exc()
+        print("[CHROOT X] Failed to create image.")
+        sys.exit(1)
+
 
+def disable_fast_install():
+    print('[CHROOT] Disabling fast install mode...')
+    for path in (FAST_INSTALL_DPKG, FAST_INSTALL_APT):
+        if os.path.exists(path):
+            os.remove(path)
+
+    subprocess.run(['debconf-set-selections'], input='man-db man-db/auto-update boolean true\n', text=True, check=False)
+    if shutil.which('mandb'):
+        # One index build instead of one per package that ships man pages
+        open(MAN_DB_AUTO_UPDATE, 'w').write("")
+        subprocess.run(['mandb', '--create', '--quiet'], check=False)
+
+
+def remove_divert():
+    print('[CHROOT] Removing divert...')
+    open('/etc/machine-id', 'w').write("")
+    if os.path.exists('/sbin/initctl'):
+        os.remove('/sbin/initctl')
+    subprocess.run(['dpkg-divert', '--rename', '--remove', '/sbin/initctl'], check=False)
+    if FAST_INSTALL:
+        disable_fast_install()
+    shutil.rmtree('/tmp', ignore_errors=True)
+    os.mkdir('/tmp', 0o1777)
+    if os.path.exists('/root/.bash_history'):
+        os.remove('/root/.bash_history')
+
+
+# The phases in build order. build.py runs each phase in its own overlay layer
+# so a failed build can be resumed from the last phase that finished.
+PHASES = [
+    ('block-unwanted-packages', block_unwanted_packages),
+    ('setup-mozilla-repo', setup_mozilla_repo),
+    ('update-package-list', update_package_list),
+    ('enable-fast-install', enable_fast_install),
+    ('install-system', install_system),
+    ('setup-machine-id-and-divert', setup_machine_id),
+    ('install-packages', install_packages),
+    ('unblock-unwanted-packages', unblock_unwanted_packages),
+    ('install-ntfs-3g-system-compression', install_ntfs_system_compression),
+    ('configure-casper', configure_casper),
+    ('pull-passkill', pull_passkill),
+    ('install-passkill-dependencies', install_passkill_dependencies),
+    ('disable-gdm', disable_gdm),
+    ('create-getty-preset', create_getty_preset),
+    ('unmask-getty', unmask_getty),
+    ('create-getty-restart-service', create_getty_restart_service),
+    ('setup-getty-autologin', setup_getty_autologin),
+    ('setup-exit-gnome-shortcut', setup_exit_gnome_shortcut),
+    ('register-profile-script', register_profile_script),
+    ('setup-plymouth', setup_plymouth),
+    ('set-sidebar-apps-and-theme', set_sidebar_apps_and_theme),
+    ('set-power-settings', set_power_settings),
+    ('compile-gsettings-schemas', compile_gsettings_schemas),
+    ('compile-dconf', compile_dconf),
+    ('configure-network-manager', configure_network_manager),
+    ('set-environment-variables', set_environment_variables),
+    ('build-image-files', build_image_files),
+    ('create-image', create_image),
+    ('update-initramfs', update_initramfs),
+    ('copy-kernel', copy_kernel),
+    ('remove-divert', remove_divert),
+]
+
+# Work build.py runs in throwaway roots, it never ends up in a layer.
+TASKS = {
+    'build-ntfs-3g-system-compression': build_ntfs_system_compression,
+}
+
+# What the phases need and touch, so build.py can run phases that do not
+# depend on each other at the same time, each in its own layer on top of the
+# layers of the phases it runs after.
+#   after      the phases it needs, every phase before it when left out
+#   inputs     paths outside the root it reads, like the downloads
+#   outputs    the paths in the root it writes, everything when left out,
+#              phases that can run at the same time must not share any
+#   resources  held while it runs, dpkg is the package database of the root,
+#              apt-lists and network are shared by every root
+# Phases that are not listed run after every phase before them and may write
+# anywhere, which is what every apt phase does.
+PHASE_GRAPH = {
+    'setup-mozilla-repo': {'inputs': [os.path.join(DOWNLOAD_DIR, 'mozillateam.asc')]},
+    'update-package-list': {'resources': ['dpkg', 'apt-lists', 'network']},
+    # Where ntfs-3g looks for plugins on Ubuntu
+    'install-ntfs-3g-system-compression': {'after': ['unblock-unwanted-packages'], 'inputs': [os.path.join(NTFS_PLUGIN_DIR, NTFS_PLUGIN)], 'outputs': ['/usr/lib/x86_64-linux-gnu/ntfs-3g']},
+    'configure-casper': {'after': ['unblock-unwanted-packages'], 'outputs': ['/etc/casper.conf', '/usr/sbin/casper-stop']},
+    'pull-passkill': {'after': ['unblock-unwanted-packages'], 'inputs': [os.path.join(DOWNLOAD_DIR, 'PassKill.git')], 'outputs': ['/passkill']},
+    'install-passkill-dependencies': {'after': ['unblock-unwanted-packages'], 'inputs': [os.path.join(DOWNLOAD_DIR, 'wheels')], 'outputs': ['/usr/local', '/root/.cache']},
+    'disable-gdm': {'after': ['unblock-unwanted-packages'], 'outputs': ['/etc/systemd/system']},
+    'create-getty-preset': {'after': ['unblock-unwanted-packages'], 'outputs': ['/etc/systemd/system-preset']},
+    'unmask-getty': {'after': ['disable-gdm'], 'outputs': ['/etc/systemd/system', '/lib/systemd/system/getty@tty1.service']},
+    'create-getty-restart-service': {'after': ['unmask-getty'], 'outputs': ['/etc/systemd/system']},
+    'setup-getty-autologin': {'after': ['create-getty-restart-service'], 'outputs': ['/etc/systemd/system/getty@.service.d']},
+    'setup-exit-gnome-shortcut': {'after': ['unblock-unwanted-packages'], 'outputs': ['/etc/skel/Desktop']},
+    'register-profile-script': {'after': ['unblock-unwanted-packages'], 'outputs': ['/etc/profile.d/passkill.sh']},
+    'setup-plymouth': {'after': ['unblock-unwanted-packages'], 'outputs': ['/etc/alternatives', '/var/lib/dpkg/alternatives', '/var/log/alternatives.log'], 'resources': ['dpkg']},
+    'set-sidebar-apps-and-theme': {'after': ['unblock-unwanted-packages'], 'outputs': ['/usr/share/glib-2.0/schemas/10_ubuntu-settings.gschema.override', '/etc/dconf']},
+    'set-power-settings': {'after': ['unblock-unwanted-packages'], 'outputs': ['/usr/share/glib-2.0/schemas/99_passkill-power-settings.gschema.override']},
+    'compile-gsettings-schemas': {'after': ['set-sidebar-apps-and-theme', 'set-power-settings'], 'outputs': ['/usr/share/glib-2.0/schemas/gschemas.compiled']},
+    'compile-dconf': {'after': ['set-sidebar-apps-and-theme'], 'outputs': ['/etc/dconf/db']},
+    # The postinst of network-manager enables its units
+    'configure-network-manager': {'after': ['setup-getty-autologin'], 'outputs': ['/etc/NetworkManager', '/etc/systemd/system', '/var/lib/systemd', '/var/lib/NetworkManager', '/var/cache/debconf'], 'resources': ['dpkg']},
+    'set-environment-variables': {'after': ['unblock-unwanted-packages'], 'outputs': ['/etc/environment']},
+    'build-image-files': {'after': ['unblock-unwanted-packages'], 'inputs': [os.path.join(DOWNLOAD_DIR, 'memtest86.zip')], 'outputs': ['/image/install', '/image/isolinux/grub.cfg', '/image/passkill', '/image/README.diskdefines']},
+    'create-image': {'after': ['build-image-files'], 'outputs': ['/image/isolinux']},
+    # casper and the plymouth theme end up in the initramfs, the phase also
+    # writes the initramfs profile and takes the update-initramfs diversion of
+    # fast install mode back
+    'update-initramfs': {'after': ['configure-casper', 'setup-plymouth'], 'outputs': ['/boot', '/etc/initramfs-tools/conf.d/passkill.conf', '/etc/initramfs-tools/modules', '/var/lib/initramfs-tools', '/var/lib/passkill', '/var/lib/dpkg/diversions', '/var/lib/dpkg/diversions-old', UPDATE_INITRAMFS, UPDATE_INITRAMFS + '.distrib']},
+    'copy-kernel': {'after': ['update-initramfs'], 'outputs': ['/image/casper']},
+}
+
+
+def main(phase):
+    print('[CHROOT] Setting up chroot...')
+    # /proc, /sys and /dev/pts are mounted by build.py's chroot session
+    try:
+        os.environ['HOME'] = '/root'
+        os.environ['LC_ALL'] = 'C'
+        os.environ['DEBIAN_FRONTEND'] = 'noninteractive'
+
+        dict(PHASES, **TASKS)[phase]()
 
     except Exception as e:
         traceback.print_exc()
-        print("[CHROOT X] Failed to set up machine-id and divert.")
+        print("[CHROOT X] Unknown failure.")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2 or sys.argv[1] not in dict(PHASES, **TASKS):
+        print(f"[CHROOT X] Usage: chroot.py <phase>, phases: {', '.join(name for name, _ in PHASES)}, tasks: {', '.join(TASKS)}")
         sys.exit(1)
-    
-    finally:
-        print('[CHROOT] Removing divert...')
-        open('/etc/machine-id', 'w').write("")
-        if os.path.exists('/sbin/initctl'):
-            os.remove('/sbin/initctl')
-        subprocess.run(['dpkg-divert', '--rename', '--remove', '/sbin/initctl'], check=False)
-        shutil.rmtree('/tmp', ignore_errors=True)
-        os.mkdir('/tmp', 0o1777)
-        if os.path.exists('/root/.bash_history'):
-            os.remove('/root/.bash_history')
-
-        
-except Exception as e:
-    traceback.print_exc()
-    print("[CHROOT X] Unknown failure.")
-    sys.exit(1)
-
-finally:
-    print("[CHROOT] Cleaning up...")
-    subprocess.run(['umount', '-l', '/proc'], check=False)
-    subprocess.run(['umount', '-l', '/sys'], check=False)
-    subprocess.run(['umount', '-l', '/dev/pts'], check=False)
\ No newline at end of file
+
+    main(sys.argv[1])
@@ -0,0 +1,178 @@
+try:
+    import sys
+    import os
+    import argparse
+    import ctypes
+    import re
+    import stat
+    import subprocess
+except ImportError as e:
+    print(f"[X] Failed to load required module, likely not installed: {e}")
+    try:
+        sys.exit(1)
+    except:
+        exit(1)
+
+
+# Root jails in a private mount namespace.
+#
+# Commands run through a ChrootSession are started by this script, which
+# unshares a new mount namespace, sets up /dev, /run, /proc, /sys, /dev/pts and
+# the bind mounts with direct syscalls, chroots and execs the command. The
+# mounts only exist in that namespace, so they are gone the moment the command
+# exits, whatever state it exits in, and nothing needs to be unmounted.
+
+CLONE_NEWNS = 0x00020000
+MS_NOSUID = 0x2
+MS_NODEV = 0x4
+MS_NOEXEC = 0x8
+MS_BIND = 0x1000
+MS_REC = 0x4000
+MS_PRIVATE = 0x40000
+
+# (name, mode, major, minor) of the device nodes in /dev
+DEVICES = [
+    ("null", 0o666, 1, 3),
+    ("zero", 0o666, 1, 5),
+    ("full", 0o666, 1, 7),
+    ("random", 0o666, 1, 8),
+    ("urandom", 0o666, 1, 9),
+    ("tty", 0o666, 5, 0),
+    ("console", 0o600, 5, 1),
+]
+DEV_LINKS = [
+    ("fd", "/proc/self/fd"),
+    ("stdin", "/proc/self/fd/0"),
+    ("stdout", "/proc/self/fd/1"),
+    ("stderr", "/proc/self/fd/2"),
+    # The pseudo terminals of the jail's own devpts instance
+    ("ptmx", "pts/ptmx"),
+]
+
+libc = ctypes.CDLL(None, use_errno=True)
+libc.mount.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_ulong, ctypes.c_char_p]
+libc.unshare.argtypes = [ctypes.c_int]
+
+
+def _encode(value):
+    return value.encode() if value is not None else None
+
+
+def mount(source, target, fstype=None, flags=0, data=None):
+    if libc.mount(_encode(source), _encode(target), _encode(fstype), flags, _encode(data)) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, f"mount {target}: {os.strerror(errno)}")
+
+
+def unshare(flags):
+    if libc.unshare(flags) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, f"unshare: {os.strerror(errno)}")
+
+
+def unescape_mount_point(field):
+    """Decode a mount point field of /proc/self/mountinfo, given as bytes."""
+    # Spaces and other special characters are octal escaped, anything else is the raw name
+    field = re.sub(rb"\\([0-7]{3})", lambda match: bytes([int(match.group(1), 8)]), field)
+    return field.decode("utf-8", "surrogateescape")
+
+
+def mounts_under(path):
+    """Return the mount points below path, path itself excluded, deepest first."""
+    path = os.path.realpath(path)
+    found = []
+    with open("/proc/self/mountinfo", "rb") as f:
+        for line in f:
+            point = unescape_mount_point(line.split()[4])
+            if point.startswith(path + "/"):
+                found.append(point)
+    return sorted(found, key=len, reverse=True)
+
+
+def setup(root, binds):
+    """Enter a private mount namespace and mount everything the jail needs below root."""
+    unshare(CLONE_NEWNS)
+    # Nothing mounted from here on may propagate back to the host
+    mount(None, "/", None, MS_REC | MS_PRIVATE)
+
+    for path in ("dev", "run", "proc", "sys"):
+        os.makedirs(os.path.join(root, path), exist_ok=True)
+
+    os.umask(0)
+    dev = os.path.join(root, "dev")
+    mount("tmpfs", dev, "tmpfs", MS_NOSUID, "mode=755")
+    for name, mode, major, minor in DEVICES:
+        os.mknod(os.path.join(dev, name), mode | stat.S_IFCHR, os.makedev(major, minor))
+    for name, target in DEV_LINKS:
+        os.symlink(target, os.path.join(dev, name))
+    os.mkdir(os.path.join(dev, "pts"), 0o755)
+    os.mkdir(os.path.join(dev, "shm"), 0o1777)
+
+    mount("tmpfs", os.path.join(root, "run"), "tmpfs", MS_NOSUID | MS_NODEV, "mode=755")
+    mount("proc", os.path.join(root, "proc"), "proc", MS_NOSUID | MS_NODEV | MS_NOEXEC)
+    mount("sysfs", os.path.join(root, "sys"), "sysfs", MS_NOSUID | MS_NODEV | MS_NOEXEC)
+    mount("devpts", os.path.join(dev, "pts"), "devpts", MS_NOSUID | MS_NOEXEC, "newinstance,ptmxmode=0666,mode=0620,gid=5")
+
+    for source, target in binds:
+        # Targets below /run end up on the tmpfs and never in the root
+        path = os.path.join(root, target.lstrip("/"))
+        os.makedirs(path, exist_ok=True)
+        mount(source, path, None, MS_BIND | MS_REC)
+    os.umask(0o022)
+
+
+class ChrootSession:
+    """Run commands in root with the mounts of a build chroot.
+
+    Every command gets its own mount namespace, binds is a list of
+    (host path, path in root) that are bind mounted into it.
+    """
+
+    def __init__(self, root, binds=()):
+        self.root = os.path.realpath(root)
+        self.binds = list(binds)
+
+    def __enter__(self):
+        if not os.path.isdir(self.root):
+            raise FileNotFoundError(self.root)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # The namespaces are gone with their processes, anything left was mounted from outside
+        leaked = mounts_under(self.root)
+        if leaked:
+            print(f"[X] Mounts left below {self.root}: {', '.join(leaked)}")
+        return False
+
+    def command(self, command):
+        args = [sys.executable, os.path.abspath(__file__), self.root]
+        for source, target in self.binds:
+            args += ["--bind", f"{source}:{target}"]
+        return args + ["--"] + list(command)
+
+    def run(self, command, **kwargs):
+        return subprocess.run(self.command(command), **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a command in a root jail with its own mount namespace.",
+                                     usage="%(prog)s [-h] [--bind HOST:TARGET] root -- command...")
+    parser.add_argument("root", help="Root directory of the jail.")
+    parser.add_argument("--bind", action="append", default=[], help="HOST:TARGET to bind mount, TARGET is inside the root.")
+
+    # Everything after -- belongs to the command, options included
+    argv = sys.argv[1:]
+    split = argv.index("--") if "--" in argv else len(argv)
+    args = parser.parse_args(argv[:split])
+    command = argv[split + 1:]
+    if not command:
+        parser.error("no command given")
+
+    setup(args.root, [bind.rsplit(":", 1) for bind in args.bind])
+    os.chroot(args.root)
+    os.chdir("/")
+    os.execvp(command[0], command)
+
+
+if __name__ == "__main__":
+    main()
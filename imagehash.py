@@ -0,0 +1,273 @@
+try:
+    import sys
+    import os
+    import argparse
+    import concurrent.futures
+    import fcntl
+    import hashlib
+    import multiprocessing
+    import queue
+    import shutil
+    import subprocess
+    import threading
+    import time
+except ImportError as e:
+    print(f"[X] Failed to load required module, likely not installed: {e}")
+    try:
+        sys.exit(1)
+    except:
+        exit(1)
+
+
+# Checksum lists of the ISO tree.
+#
+# Files are spread over a process pool, the biggest first so filesystem.squashfs
+# does not end up last, and every file is read once in large reads that feed
+# all requested digests. The lists use the md5sum format with ./ relative paths,
+# which is what casper's integrity check reads from md5sum.txt.
+#
+# The ISO itself is hashed while xorriso writes it to a pipe, so its checksum
+# files do not need a second read of the whole image.
+
+CHUNK_SIZE = 8 * 1024 * 1024
+# Paths left out of the lists, isolinux only holds the boot images xorriso embeds
+EXCLUDES = ("isolinux/",)
+LISTS = {"md5": "md5sum.txt", "sha256": "sha256sum.txt"}
+PIPE_SIZE = 1024 * 1024
+
+
+def hash_file(path, algorithms):
+    """Return {algorithm: hex digest} of path, reading it only once."""
+    digests = {algorithm: hashlib.new(algorithm) for algorithm in algorithms}
+    buffer = bytearray(CHUNK_SIZE)
+    view = memoryview(buffer)
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while True:
+            count = os.readv(fd, [buffer])
+            if not count:
+                break
+            for digest in digests.values():
+                digest.update(view[:count])
+    finally:
+        os.close(fd)
+
+    return {algorithm: digest.hexdigest() for algorithm, digest in digests.items()}
+
+
+def list_files(root, excludes=EXCLUDES):
+    """Return the paths of the regular files under root relative to it, sorted."""
+    paths = []
+    for dirpath, dirs, files in os.walk(root):
+        for file in files:
+            full = os.path.join(dirpath, file)
+            if not os.path.isfile(full) or os.path.islink(full):
+                continue
+            path = os.path.relpath(full, root)
+            if path in LISTS.values() or path.startswith(excludes):
+                continue
+            paths.append(path)
+    return sorted(paths)
+
+
+def hash_tree(root, algorithms=("md5",), workers=None, excludes=EXCLUDES):
+    """Return {path: {algorithm: hex digest}} for every file under root."""
+    paths = list_files(root, excludes)
+    # Longest first, so the biggest file starts right away and small files fill in around it
+    paths.sort(key=lambda path: os.path.getsize(os.path.join(root, path)), reverse=True)
+
+    results = {}
+    # No fork, the caller may be running other threads
+    context = multiprocessing.get_context("forkserver")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers or os.cpu_count(), mp_context=context) as pool:
+        futures = {pool.submit(hash_file, os.path.join(root, path), algorithms): path for path in paths}
+        for future in concurrent.futures.as_completed(futures):
+            results[futures[future]] = future.result()
+    return results
+
+
+def format_line(digest, path):
+    # Same escaping as coreutils md5sum for names with a backslash or newline
+    if "\\" in path or "\n" in path:
+        return "\\" + digest + "  ./" + path.replace("\\", "\\\\").replace("\n", "\\n") + "\n"
+    return digest + "  ./" + path + "\n"
+
+
+def write_lists(root, sha256=False, workers=None, excludes=EXCLUDES):
+    """Write md5sum.txt, and sha256sum.txt when sha256 is set, into root. Returns the hashed bytes."""
+    algorithms = ("md5", "sha256") if sha256 else ("md5",)
+    results = hash_tree(root, algorithms, workers, excludes)
+
+    for algorithm in algorithms:
+        path = os.path.join(root, LISTS[algorithm])
+        with open(path + ".tmp", "w") as f:
+            for file in sorted(results):
+                f.write(format_line(results[file][algorithm], file))
+        os.replace(path + ".tmp", path)
+
+    return sum(os.path.getsize(os.path.join(root, file)) for file in results)
+
+
+def write_lists_process(root, sha256=False, workers=None):
+    """Run write_lists in a separate Python process, returns the hashed bytes.
+
+    The pool workers import the main module of the process that starts them,
+    this keeps that from being a script without a __main__ guard like build.py.
+    """
+    args = [sys.executable, os.path.abspath(__file__), "write", root, "--workers", str(workers or os.cpu_count())]
+    if sha256:
+        args.append("--sha256")
+    subprocess.run(args, check=True, stdout=subprocess.DEVNULL)
+    return sum(os.path.getsize(os.path.join(root, path)) for path in list_files(root))
+
+
+def stream(source, path, algorithms):
+    """Copy the pipe source to path and hash it on the way, returns {algorithm: hex digest}.
+
+    Every digest is updated in its own thread, hashlib releases the GIL for
+    large updates, so the digests keep pace with the writes instead of adding
+    to them. path is removed again when the copy fails. Whether the writer of
+    the pipe succeeded is up to the caller, so path should be a temporary name
+    that is only moved into place after that.
+    """
+    fd = source.fileno()
+    try:
+        # Fewer, larger reads from the pipe
+        fcntl.fcntl(fd, fcntl.F_SETPIPE_SZ, PIPE_SIZE)
+    except (OSError, AttributeError):
+        pass
+
+    digests = {algorithm: hashlib.new(algorithm) for algorithm in algorithms}
+    queues = {algorithm: queue.Queue(16) for algorithm in algorithms}
+
+    def consume(digest, chunks):
+        while (chunk := chunks.get()) is not None:
+            digest.update(chunk)
+
+    threads = [threading.Thread(target=consume, args=(digests[algorithm], queues[algorithm]), daemon=True) for algorithm in algorithms]
+    for thread in threads:
+        thread.start()
+
+    try:
+        with open(path, "wb") as f:
+            while chunk := os.read(fd, CHUNK_SIZE):
+                for chunks in queues.values():
+                    chunks.put(chunk)
+                f.write(chunk)
+    except BaseException:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    finally:
+        for chunks in queues.values():
+            chunks.put(None)
+        for thread in threads:
+            thread.join()
+
+    return {algorithm: digest.hexdigest() for algorithm, digest in digests.items()}
+
+
+def write_checksum(path, digest, target):
+    """Write a checksum file for target in the format of md5sum and sha256sum."""
+    with open(path, "w") as f:
+        f.write(f"{digest}  {target}\n")
+
+
+def drop_caches():
+    os.sync()
+    with open("/proc/sys/vm/drop_caches", "w") as f:
+        f.write("3")
+
+
+def benchmark(root, workers, sha256, cold):
+    """Time the find | xargs md5sum pipeline against the process pool on root."""
+    results = {}
+    size = sum(os.path.getsize(os.path.join(root, path)) for path in list_files(root))
+
+    if cold:
+        drop_caches()
+    start = time.time()
+    subprocess.run(["/bin/bash", "-c", "find . -type f -print0 | xargs -0 md5sum > /dev/null"], check=True, cwd=root)
+    results["pipeline"] = time.time() - start
+
+    for count in sorted(set([1, workers])):
+        if cold:
+            drop_caches()
+        start = time.time()
+        hash_tree(root, ("md5", "sha256") if sha256 else ("md5",), count)
+        results[f"pool-{count}"] = time.time() - start
+
+    return size, results
+
+
+def benchmark_iso(iso, target, algorithms):
+    """Compare writing an ISO and hashing it afterwards with hashing it while it is written, cold cache."""
+    results = {}
+
+    drop_caches()
+    start = time.time()
+    with subprocess.Popen(["cat", iso], stdout=subprocess.PIPE) as process, open(target, "wb") as f:
+        shutil.copyfileobj(process.stdout, f, CHUNK_SIZE)
+    os.sync()
+    results["write"] = time.time() - start
+
+    drop_caches()
+    start = time.time()
+    hash_file(target, algorithms)
+    results["separate-hash"] = time.time() - start
+
+    drop_caches()
+    start = time.time()
+    with subprocess.Popen(["cat", iso], stdout=subprocess.PIPE) as process:
+        stream(process.stdout, target, algorithms)
+    os.sync()
+    results["streamed"] = time.time() - start
+
+    os.remove(target)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write the checksum lists of an ISO tree.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    write_parser = commands.add_parser("write", help="Write md5sum.txt into an ISO tree.")
+    write_parser.add_argument("root", help="ISO tree to hash.")
+    write_parser.add_argument("--sha256", action="store_true", help="Also write sha256sum.txt in the same pass.")
+    write_parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of hashing processes.")
+
+    bench_parser = commands.add_parser("bench", help="Compare the find | xargs md5sum pipeline with the process pool.")
+    bench_parser.add_argument("root", help="ISO tree to hash.")
+    bench_parser.add_argument("--sha256", action="store_true", help="Also compute SHA-256 in the pool runs.")
+    bench_parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of hashing processes.")
+    bench_parser.add_argument("--cold", action="store_true", help="Drop the page cache before every run, needs root.")
+
+    iso_parser = commands.add_parser("bench-iso", help="Time writing an ISO and hashing it after against hashing it while writing, needs root.")
+    iso_parser.add_argument("iso", help="Existing ISO to stand in for the xorriso output.")
+    iso_parser.add_argument("target", help="Where to write the copy, on the disk the build writes to.")
+    iso_parser.add_argument("--blake2", action="store_true", help="Also compute BLAKE2b.")
+
+    args = parser.parse_args()
+
+    if args.command == "bench-iso":
+        results = benchmark_iso(args.iso, args.target, ("md5", "sha256", "blake2b") if args.blake2 else ("md5", "sha256"))
+        two_pass = results["write"] + results["separate-hash"]
+        print(f"[*] Write then hash: {results['write']:.2f}s + {results['separate-hash']:.2f}s = {two_pass:.2f}s")
+        print(f"[*] Hash while writing: {results['streamed']:.2f}s")
+        print(f"[✓] Saved {two_pass - results['streamed']:.2f}s")
+    elif args.command == "write":
+        start = time.time()
+        size = write_lists(args.root, args.sha256, args.workers)
+        elapsed = max(time.time() - start, 0.001)
+        print(f"[✓] Hashed {size / 1048576:.1f} MiB in {elapsed:.2f}s ({size / 1048576 / elapsed:.1f} MiB/s)")
+    else:
+        size, results = benchmark(args.root, args.workers, args.sha256, args.cold)
+        print(f"[*] {size / 1048576:.1f} MiB")
+        for name, elapsed in results.items():
+            print(f"{name:<12} {elapsed:>8.2f}s {size / 1048576 / max(elapsed, 0.001):>9.1f} MiB/s {results['pipeline'] / max(elapsed, 0.001):>6.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+try:
+    import sys
+    import os
+    import argparse
+    import json
+    import shutil
+    import subprocess
+    import tempfile
+    import time
+    import chrootsession
+    import chroot
+except ImportError as e:
+    print(f"[X] Failed to load required module, likely not installed: {e}")
+    try:
+        sys.exit(1)
+    except:
+        exit(1)
+
+
+# Initramfs profile benchmark.
+#
+# Builds the initramfs of a root tree with mkinitramfs for every combination of
+# MODULES policy and compressor, checks that each one still has the modules and
+# casper scripts a live boot needs, and records its size, build time and how
+# long it takes to unpack. The candidate with the shortest estimated load and
+# unpack time is written as a profile that build.py uses when INITRAMFS_PROFILE
+# is set to it.
+
+DEFAULT_MODULES = ["most", "list"]
+DEFAULT_COMPRESSORS = ["zstd:1", "zstd:3", "zstd:9", "zstd:19", "lz4", "gzip", "xz"]
+
+
+def compressor_profile(spec):
+    """Turn a spec like zstd:19 or lz4 into the compress and level of a profile."""
+    name, _, level = spec.partition(":")
+    return name, int(level) if level else None
+
+
+def newest_kernel(source):
+    kernels = sorted(os.listdir(os.path.join(source, "lib", "modules")), reverse=True)
+    if not kernels:
+        raise FileNotFoundError(f"{source} has no kernel modules")
+    return kernels[0]
+
+
+def benchmark(session, source, work, kernel, profile, runs):
+    """Build and measure one candidate, work is a directory inside the root."""
+    confdir = os.path.join(work, "conf")
+    initrd = os.path.join(work, "initrd")
+    extract = os.path.join(work, "extract")
+    shutil.rmtree(os.path.join(source, confdir.lstrip("/")), ignore_errors=True)
+    shutil.copytree(os.path.join(source, "etc", "initramfs-tools"), os.path.join(source, confdir.lstrip("/")), symlinks=True)
+    chroot.configure_initramfs(os.path.join(source, confdir.lstrip("/")), profile)
+
+    result = dict(profile)
+    start = time.time()
+    session.run(["mkinitramfs", "-d", confdir, "-o", initrd, kernel], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    result["build_seconds"] = time.time() - start
+    result["size"] = os.path.getsize(os.path.join(source, initrd.lstrip("/")))
+
+    listing = session.run(["lsinitramfs", initrd], check=True, stdout=subprocess.PIPE, text=True).stdout.splitlines()
+    with open(os.path.join(source, "lib", "modules", kernel, "modules.builtin")) as f:
+        builtin = f.read().splitlines()
+    result["missing"] = chroot.missing_from_initramfs(listing, builtin)
+
+    # Best of several runs, the first one also pays for reading mkinitramfs' output back
+    seconds = []
+    for _ in range(runs):
+        shutil.rmtree(os.path.join(source, extract.lstrip("/")), ignore_errors=True)
+        start = time.time()
+        session.run(["unmkinitramfs", initrd, extract], check=True, stdout=subprocess.DEVNULL)
+        seconds.append(time.time() - start)
+    shutil.rmtree(os.path.join(source, extract.lstrip("/")), ignore_errors=True)
+    result["unpack_seconds"] = min(seconds)
+    return result
+
+
+def boot_seconds(result, media_speed):
+    """Estimated time to load the initramfs from media_speed bytes per second media and unpack it."""
+    return result["size"] / media_speed + result["unpack_seconds"]
+
+
+def recommend(results, objective, media_speed):
+    candidates = [result for result in results if not result["missing"]]
+    if not candidates:
+        return None
+    if objective == "size":
+        return min(candidates, key=lambda result: result["size"])
+    return min(candidates, key=lambda result: boot_seconds(result, media_speed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark initramfs MODULES policies and compressors on a root tree and recommend a profile.")
+    parser.add_argument("source", help="Root tree with the kernel and initramfs-tools installed, for example an extracted build root.")
+    parser.add_argument("--modules", default=",".join(DEFAULT_MODULES), help="Comma separated MODULES policies, like most,list.")
+    parser.add_argument("--compressors", default=",".join(DEFAULT_COMPRESSORS), help="Comma separated compressor specs, like zstd:19,lz4,xz.")
+    parser.add_argument("--kernel", default=None, help="Kernel version to build for, defaults to the newest one in the root.")
+    parser.add_argument("--runs", type=int, default=3, help="Number of unpack runs per candidate, the fastest counts.")
+    parser.add_argument("--media-speed", type=float, default=20.0, help="Read speed of the boot media in MiB/s, for the boot time estimate.")
+    parser.add_argument("--objective", choices=["boot", "size"], default="boot", help="What the recommendation optimises for.")
+    parser.add_argument("--output", default=os.path.join(os.getcwd(), ".initramfs-profile.json"), help="Where to write the recommended profile.")
+    args = parser.parse_args()
+
+    if os.geteuid() != 0:
+        print("[X] This script must be run as root.")
+        sys.exit(1)
+
+    kernel = args.kernel or newest_kernel(args.source)
+    media_speed = args.media_speed * 1048576
+    work = tempfile.mkdtemp(prefix="initramfsbench-", dir=os.path.join(args.source, "tmp"))
+    work_in_root = "/" + os.path.relpath(work, args.source)
+
+    results = []
+    try:
+        with chrootsession.ChrootSession(args.source) as session:
+            for modules in args.modules.split(","):
+                for compressor in args.compressors.split(","):
+                    compress, level = compressor_profile(compressor)
+                    profile = {"modules": modules, "compress": compress, "level": level}
+                    print(f"[*] Benchmarking MODULES={modules} {compressor} for {kernel}...")
+                    try:
+                        result = benchmark(session, args.source, work_in_root, kernel, profile, args.runs)
+                    except (OSError, subprocess.CalledProcessError) as e:
+                        print(f"[X] MODULES={modules} {compressor} failed: {e}")
+                        continue
+
+                    result["compressor"] = compressor
+                    results.append(result)
+                    print(f"    {result['size'] / 1048576:.1f} MiB in {result['build_seconds']:.1f}s, "
+                          f"unpacks in {result['unpack_seconds']:.2f}s, "
+                          f"boot estimate {boot_seconds(result, media_speed):.2f}s"
+                          + (f", [X] missing {', '.join(result['missing'])}" if result["missing"] else ""))
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    best = recommend(results, args.objective, media_speed)
+    if not best:
+        print("[X] No candidate could be benchmarked with every module the live boot needs.")
+        sys.exit(1)
+
+    with open(args.output, "w") as f:
+        json.dump({
+            "modules": best["modules"],
+            "compress": best["compress"],
+            "level": best["level"],
+            "kernel": kernel,
+            "objective": args.objective,
+            "media_speed": args.media_speed,
+            "created": time.time(),
+            "results": results,
+        }, f, indent=1)
+
+    print(f"[✓] Recommended: MODULES={best['modules']} {best['compressor']}")
+    print(f"[*] Wrote profile to {args.output}, to build with it add to config.py:")
+    print(f"INITRAMFS_PROFILE={json.dumps(os.path.abspath(args.output))}")
+    print("[*] Or set the settings themselves:")
+    print(f"INITRAMFS_MODULES={json.dumps(best['modules'])}")
+    print(f"INITRAMFS_COMPRESS={json.dumps(best['compress'])}")
+    print(f"INITRAMFS_COMPRESS_LEVEL={best['level']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+try:
+    import sys
+    import os
+    import hashlib
+    import inspect
+    import json
+    import shutil
+    import subprocess
+    import time
+except ImportError as e:
+    print(f"[X] Failed to load required module, likely not installed: {e}")
+    try:
+        sys.exit(1)
+    except:
+        exit(1)
+
+
+# Overlay layer store for the chroot build phases.
+#
+# Every phase writes into its own overlayfs upper directory on top of the
+# layers of the phases before it. A finished layer is kept under a key made
+# from the key of the layer below and the inputs of the phase, so a rerun can
+# stack the layers that are still valid and only execute the phases after
+# them.
+
+DATA_TYPES = (str, int, float, bool, list, tuple, dict, type(None))
+
+
+def _code_names(code):
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            names |= _code_names(const)
+    return names
+
+
+def _hash_function(digest, func, namespace, seen):
+    if func in seen:
+        return
+    seen.add(func)
+
+    digest.update(inspect.getsource(func).encode())
+    for name in sorted(_code_names(func.__code__)):
+        if name not in namespace:
+            continue
+        value = namespace[name]
+        if inspect.isfunction(value) and value.__module__ == func.__module__:
+            _hash_function(digest, value, namespace, seen)
+        elif isinstance(value, DATA_TYPES):
+            digest.update(name.encode())
+            digest.update(repr(value).encode())
+
+
+def _hash_path(digest, path):
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for file in sorted(files):
+                _hash_path(digest, os.path.join(root, file))
+        return
+
+    digest.update(path.encode())
+    with open(path, "rb") as f:
+        digest.update(hashlib.sha256(f.read()).digest())
+
+
+def phase_key(parent, name, func, namespace, paths=(), values=()):
+    """Return the layer key of a phase.
+
+    The key covers the key of the layer below, the source of the phase
+    function and of the module level functions it calls, the module level
+    data it references, the contents of any extra input paths and any extra
+    values, like the commit of a repository the phase clones.
+    """
+    digest = hashlib.sha256()
+    digest.update(parent.encode())
+    digest.update(name.encode())
+    _hash_function(digest, func, namespace, set())
+    for path in paths:
+        _hash_path(digest, path)
+    for value in values:
+        digest.update(repr(value).encode())
+    return digest.hexdigest()[:32]
+
+
+def layer_root(layer_dir, key):
+    return os.path.join(layer_dir, key, "root")
+
+
+def is_complete(layer_dir, key):
+    return os.path.exists(os.path.join(layer_dir, key, "complete"))
+
+
+def begin(layer_dir, key, scratch=None):
+    """Create an empty layer for key, dropping anything left by a failed run.
+
+    With scratch the writable directories are created below it instead, for
+    example on a tmpfs, and commit copies them into the layer.
+    """
+    path = os.path.join(layer_dir, key)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+
+    if scratch:
+        discard(scratch, key)
+        path = os.path.join(scratch, key)
+
+    os.makedirs(os.path.join(path, "root"))
+    os.makedirs(os.path.join(path, "work"))
+    return os.path.join(path, "root"), os.path.join(path, "work")
+
+
+def commit(layer_dir, key, name, scratch=None):
+    path = os.path.join(layer_dir, key)
+    if scratch:
+        # cp keeps the whiteouts and overlay xattrs of the upper directory
+        subprocess.run(["cp", "-a", os.path.join(scratch, key, "root"), os.path.join(path, "root")], check=True)
+        discard(scratch, key)
+    shutil.rmtree(os.path.join(path, "work"), ignore_errors=True)
+    with open(os.path.join(path, "complete"), "w") as f:
+        json.dump({"name": name, "time": time.time()}, f)
+
+
+def discard(layer_dir, key):
+    shutil.rmtree(os.path.join(layer_dir, key), ignore_errors=True)
+
+
+def prune(layer_dir, keep):
+    """Remove every layer that is not in keep, returns the removed keys."""
+    removed = []
+    if not os.path.isdir(layer_dir):
+        return removed
+
+    for key in sorted(os.listdir(layer_dir)):
+        if key not in keep:
+            shutil.rmtree(os.path.join(layer_dir, key))
+            removed.append(key)
+    return removed
+
+
+def mount(target, lowers, upper=None, work=None):
+    """Mount an overlay of lowers (bottom first) on target.
+
+    Without an upper directory the overlay is mounted read only.
+    """
+    options = "lowerdir=" + ":".join(reversed(lowers))
+    if upper:
+        options += f",upperdir={upper},workdir={work}"
+    else:
+        options = "ro," + options
+
+    subprocess.run(["mount", "-t", "overlay", "overlay", "-o", options, target], check=True)
+
+
+def umount(target):
+    subprocess.run(["umount", target], check=False)
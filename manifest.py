@@ -0,0 +1,95 @@
+try:
+    import sys
+    import os
+    import fnmatch
+    import json
+    import stat
+except ImportError as e:
+    print(f"[X] Failed to load required module, likely not installed: {e}")
+    try:
+        sys.exit(1)
+    except:
+        exit(1)
+
+
+# Content manifests of the root filesystem.
+#
+# A manifest maps every path that goes into filesystem.squashfs to its mode,
+# owner, size, mtime and a symlink target or device number. Files are not
+# hashed: mksquashfs stores the mtime, so a file rewritten with the same
+# content changes the image anyway. Comparing the manifest of the current tree
+# with the one saved next to the previous squashfs tells whether that squashfs
+# can be reused. The same walk adds up the disk usage that ends up in
+# casper/filesystem.size.
+
+
+def excluded(path, excludes):
+    return any(fnmatch.fnmatchcase(path, pattern) for pattern in excludes)
+
+
+def walk(root, excludes=()):
+    """Return the manifest of root, skipping paths that match excludes."""
+    entries = {}
+    inodes = set()
+
+    root_stat = os.lstat(root)
+    size = root_stat.st_blocks * 512
+    inodes.add((root_stat.st_dev, root_stat.st_ino))
+
+    stack = [""]
+    while stack:
+        rel = stack.pop()
+        with os.scandir(os.path.join(root, rel) if rel else root) as it:
+            for entry in it:
+                path = f"{rel}/{entry.name}" if rel else entry.name
+                if excluded(path, excludes):
+                    continue
+
+                st = entry.stat(follow_symlinks=False)
+                record = [st.st_mode, st.st_uid, st.st_gid, st.st_size, st.st_mtime_ns, None]
+
+                if stat.S_ISLNK(st.st_mode):
+                    record[5] = os.readlink(entry.path)
+                elif stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode):
+                    record[5] = st.st_rdev
+                elif stat.S_ISDIR(st.st_mode) and st.st_dev == root_stat.st_dev:
+                    # Like du -x, do not cross into other filesystems
+                    stack.append(path)
+
+                # Hard links only take up space once
+                if (st.st_dev, st.st_ino) not in inodes:
+                    inodes.add((st.st_dev, st.st_ino))
+                    size += st.st_blocks * 512
+
+                entries[path] = record
+
+    return {"size": size, "entries": entries}
+
+
+def diff(old, new):
+    """Return the (added, removed, changed) paths between two manifests."""
+    old_entries = old["entries"]
+    new_entries = new["entries"]
+
+    added = sorted(set(new_entries) - set(old_entries))
+    removed = sorted(set(old_entries) - set(new_entries))
+    changed = []
+    for path in set(new_entries) & set(old_entries):
+        a = old_entries[path]
+        b = new_entries[path]
+        if a != b:
+            changed.append(path)
+
+    return added, removed, sorted(changed)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save(path, data):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
@@ -0,0 +1,105 @@
+try:
+    import sys
+    import os
+    import re
+    import subprocess
+    import chrootsession
+except ImportError as e:
+    print(f"[X] Failed to load required module, likely not installed: {e}")
+    try:
+        sys.exit(1)
+    except:
+        exit(1)
+
+
+# Memory budget for building in RAM.
+#
+# In a RAM build the writable layer of the running phase and the image tree
+# live on a tmpfs, finished layers are copied to the layer cache on disk in one
+# pass. The peak footprint of the tmpfs is estimated from the previous build or
+# from apt's install size simulation, and the build only goes to RAM when that
+# estimate fits in the available memory.
+
+INSTALL_SIZE = re.compile(r"After this operation, ([\d.,]+) ([kMG]?B) of additional disk space will be used")
+UNITS = {"B": 1, "kB": 1000, "MB": 1000 ** 2, "GB": 1000 ** 3}
+
+# How much of the root filesystem size the squashfs takes when there is no previous build to go by
+SQUASHFS_RATIO = 0.45
+# Boot files, EFI images and the rest of the image tree next to the squashfs
+IMAGE_EXTRA = 256 * 1024 * 1024
+
+
+def meminfo():
+    """Return /proc/meminfo in bytes."""
+    info = {}
+    with open("/proc/meminfo") as f:
+        for line in f:
+            name, value = line.split(":", 1)
+            fields = value.split()
+            info[name] = int(fields[0]) * (1024 if fields[1:] == ["kB"] else 1)
+    return info
+
+
+def available():
+    return meminfo()["MemAvailable"]
+
+
+def parse_install_size(output):
+    match = INSTALL_SIZE.search(output)
+    if not match:
+        return None
+    return int(float(match[1].replace(",", "")) * UNITS[match[2]])
+
+
+def install_size(root, binds, packages):
+    """Ask apt how much installing packages adds to root, None when it cannot tell.
+
+    Packages apt does not know yet, like those from repositories that are added
+    by later phases, are left out.
+    """
+    environ = dict(os.environ, LC_ALL="C")
+    # Root is mounted read only, so no locking and no package cache files
+    options = ["-o", "Debug::NoLocking=1", "-o", "Dir::Cache::pkgcache=", "-o", "Dir::Cache::srcpkgcache="]
+
+    with chrootsession.ChrootSession(root, binds) as session:
+        known = session.run(["apt-cache"] + options + ["pkgnames"], capture_output=True, text=True, env=environ)
+        names = set(known.stdout.split())
+        wanted = [package for package in packages if package in names]
+        if not wanted:
+            return None
+
+        result = session.run(["apt-get", "install", "--assume-no"] + options + wanted, capture_output=True, text=True, env=environ)
+    return parse_install_size(result.stdout)
+
+
+def disk_usage(paths):
+    result = subprocess.run(["du", "-scxb"] + list(paths), check=True, stdout=subprocess.PIPE, text=True)
+    return int(result.stdout.splitlines()[-1].split()[0])
+
+
+def estimate(base_size, install=None, previous_root=None, previous_squashfs=None):
+    """Return the estimated peak size of the RAM directory, None when nothing is known.
+
+    The peak is either the writable layer of the biggest phase, which is the
+    package install, or the image tree with the squashfs in it.
+    """
+    if previous_root is None and install is None:
+        return None
+
+    root_size = previous_root if previous_root is not None else base_size + install
+    biggest_phase = install if install is not None else root_size - base_size
+    squashfs = previous_squashfs if previous_squashfs is not None else root_size * SQUASHFS_RATIO
+    return int(max(biggest_phase, squashfs + IMAGE_EXTRA))
+
+
+def mount(path, size):
+    os.makedirs(path, exist_ok=True)
+    subprocess.run(["mount", "-t", "tmpfs", "-o", f"size={size},mode=755", "tmpfs", path], check=True)
+
+
+def umount(path):
+    subprocess.run(["umount", path], check=False)
+    try:
+        os.rmdir(path)
+    except OSError:
+        pass
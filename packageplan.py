@@ -0,0 +1,140 @@
+try:
+    import sys
+    import os
+    import re
+    import glob
+    import hashlib
+    import json
+    import subprocess
+except ImportError as e:
+    print(f"[X] Failed to load required module: {e}")
+    try:
+        sys.exit(1)
+    except:
+        exit(1)
+
+
+# Package plans for apt-get.
+#
+# A plan gathers the packages a phase asks for, optionally every upgrade and
+# the autoremovals, and resolves them in a single apt-get simulation under the
+# pins in /etc/apt/preferences.d. The result, the exact versions to install in
+# apt's order and the packages to remove, is run as one apt-get transaction
+# and written to a lock file. Later builds replay the lock file without
+# resolving again for as long as the request and the pins are the same and
+# the package lists still have every locked version.
+# Runs inside the chroot.
+
+LOCK_DIR = '/run/package-locks'
+INST_LINE = re.compile(r"^Inst (?P<name>\S+) (?:\[(?P<old>[^\]]+)\] )?\((?P<version>\S+) ")
+# apt-get -s prints Purg instead of Remv for removals with --purge
+REMV_LINE = re.compile(r"^(?:Remv|Purg) (?P<name>\S+)")
+# Part of every request, plans of an older version are resolved again
+PLAN_VERSION = 2
+ENVIRON = dict(os.environ, LC_ALL='C', DEBIAN_FRONTEND='noninteractive')
+
+
+def preferences_digest():
+    """Hash of the apt pins every plan is resolved under."""
+    digest = hashlib.sha256()
+    for path in sorted(glob.glob('/etc/apt/preferences') + glob.glob('/etc/apt/preferences.d/*')):
+        digest.update(path.encode() + b'\0')
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def simulate(apt_args):
+    """Return (installs, removals) apt-get apt_args would do, installs as [name, version, upgrade] in apt's order."""
+    output = subprocess.run(['apt-get', '-s', '-y']+apt_args, check=True, stdout=subprocess.PIPE, text=True, env=ENVIRON).stdout
+
+    installs = []
+    removals = []
+    for line in output.splitlines():
+        if match := INST_LINE.match(line):
+            installs.append([match['name'], match['version'], match['old'] is not None])
+        elif match := REMV_LINE.match(line):
+            removals.append(match['name'])
+    return installs, removals
+
+
+def resolve(packages, upgrade=False, autoremove=False):
+    """Resolve packages, every upgrade when upgrade is set and the autoremovals when autoremove is set, in one go."""
+    requested = list(packages)
+    if upgrade:
+        # What dist-upgrade would touch, installed in the same transaction as the packages
+        installs, _ = simulate(['dist-upgrade'])
+        requested += [name for name, _, upgraded in installs if upgraded and name not in requested]
+
+    options = ['--auto-remove', '--purge'] if autoremove else []
+    installs, removals = simulate(['install']+options+requested)
+    return {
+        'install': [[name, version] for name, version, _ in installs],
+        'remove': removals,
+    }
+
+
+def load(name):
+    try:
+        with open(os.path.join(LOCK_DIR, name + '.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save(name, lock):
+    os.makedirs(LOCK_DIR, exist_ok=True)
+    path = os.path.join(LOCK_DIR, name + '.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(lock, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def plan(name, packages, upgrade=False, autoremove=False, relock=False):
+    """Return the plan of lock file name, resolving and writing it when the request or the pins changed or a locked version is gone."""
+    request = {
+        'packages': sorted(packages),
+        'upgrade': upgrade,
+        'autoremove': autoremove,
+        'preferences': preferences_digest(),
+        'version': PLAN_VERSION,
+    }
+
+    lock = load(name)
+    if lock and not relock and lock.get('request') == request and not available(lock):
+        print(f"[CHROOT] Package plan {name} locks versions the package lists no longer have, resolving it again...")
+    elif lock and not relock and lock.get('request') == request:
+        print(f"[CHROOT] Replaying package plan {name}: {len(lock['install'])} to install, {len(lock['remove'])} to remove")
+        return lock
+
+    lock = dict(resolve(packages, upgrade, autoremove), request=request)
+    save(name, lock)
+    print(f"[CHROOT] Resolved package plan {name}: {len(lock['install'])} to install, {len(lock['remove'])} to remove")
+    return lock
+
+
+def available(lock):
+    """Whether the package lists still have every version lock installs, by simulating it."""
+    return subprocess.run(['apt-get', '-s', '-y']+apt_args(lock), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=ENVIRON).returncode == 0
+
+
+def apt_args(lock):
+    """Return the apt-get arguments that carry out a plan exactly."""
+    pinned = [f"{name}={version}" for name, version in lock['install']]
+    removed = [f"{name}-" for name in lock['remove']]
+    return ['install', '--no-install-recommends', '--purge']+pinned+removed
+
+
+def execute(lock, packages, apt_options):
+    """Run a plan as one apt-get transaction.
+
+    Naming every package marks it as manually installed, so the ones that
+    were only pulled in get their automatic mark back, like apt would have
+    left them.
+    """
+    manual = set(subprocess.run(['apt-mark', 'showmanual'], check=True, stdout=subprocess.PIPE, text=True).stdout.split())
+    subprocess.run(['apt-get']+apt_args(lock)+apt_options, check=True)
+
+    automatic = [name for name, _ in lock['install'] if name not in packages and name.split(':')[0] not in manual]
+    if automatic:
+        subprocess.run(['apt-mark', 'auto']+automatic, check=True, stdout=subprocess.DEVNULL)
@@ -0,0 +1,353 @@
+try:
+    import sys
+    import os
+    import argparse
+    import json
+    import lzma
+    import random
+    import shutil
+    import stat
+    import subprocess
+    import tempfile
+    import zlib
+    from concurrent.futures import ThreadPoolExecutor
+    import bootsort
+    import chroot
+    import manifest
+    import squashlayers
+except ImportError as e:
+    print(f"[X] Failed to load required module, likely not installed: {e}")
+    try:
+        sys.exit(1)
+    except:
+        exit(1)
+
+
+# Per package size report of a root filesystem.
+#
+# Every regular file that goes into the squashfs is attributed to the installed
+# packages that own it, from their dpkg file lists, and from there to the
+# package groups of chroot.VARIANT_PACKAGE_GROUPS and to every package listed
+# in them, each with everything it depends on. A file owned by several
+# packages, or needed by several groups, is split evenly between them, so the
+# shares add up to the whole root. The compressed size of each package is
+# estimated by compressing samples of its files with the squashfs compressor,
+# in process or with one run of its command line tool per worker.
+
+# Files no package owns, and packages no group needs, like what debootstrap installs
+UNPACKAGED = "(unpackaged)"
+UNREQUESTED = "(unrequested)"
+SAMPLE_BYTES = 1024 * 1024
+SAMPLE_CHUNK = 128 * 1024
+# Levels mksquashfs uses when the options do not set one
+DEFAULT_LEVELS = {"gzip": 9, "zstd": 15}
+# Command line tools compress every file they are given next to it, with a suffix
+COMMANDS = {"zstd": (["zstd", "-q"], ".zst"), "lz4": (["lz4", "-q", "-m"], ".lz4"), "lzo": (["lzop", "-q"], ".lzo")}
+UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+FIELDS = ["installed", "compressed", "exclusive", "exclusive_compressed", "footprint", "footprint_compressed"]
+
+
+def regular_files(root, excludes=()):
+    """Return {path relative to root: bytes} of the regular files that go into the squashfs, hard links once."""
+    root_dev = os.lstat(root).st_dev
+    files = {}
+    inodes = set()
+    stack = [""]
+    while stack:
+        rel = stack.pop()
+        with os.scandir(os.path.join(root, rel) if rel else root) as it:
+            for entry in it:
+                path = f"{rel}/{entry.name}" if rel else entry.name
+                if manifest.excluded(path, excludes):
+                    continue
+                st = entry.stat(follow_symlinks=False)
+                if stat.S_ISDIR(st.st_mode) and st.st_dev == root_dev:
+                    stack.append(path)
+                elif stat.S_ISREG(st.st_mode) and (st.st_dev, st.st_ino) not in inodes:
+                    inodes.add((st.st_dev, st.st_ino))
+                    files[path] = st.st_size
+    return files
+
+
+def diversions(root):
+    """Return {path: (path it was moved to, package that moved it)} of the dpkg diversions of root."""
+    try:
+        with open(os.path.join(root, "var", "lib", "dpkg", "diversions"), errors="replace") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return {}
+    # The file is a list of triples: the path, where it went and the diverting package
+    return {lines[index]: (lines[index + 1], lines[index + 2]) for index in range(0, len(lines) - 2, 3)}
+
+
+def file_owners(root, installed):
+    """Return {path relative to root: [packages]} of the installed packages.
+
+    The file lists are read like in squashlayers.owned_paths, the files of a
+    package that another package diverted are where the diversion put them.
+    """
+    owners = {}
+    parents = {}
+    diverted = diversions(root)
+    lists = bootsort.package_lists(root)
+    for package in sorted(installed):
+        if package not in lists:
+            continue
+        with open(lists[package], errors="replace") as f:
+            for line in f:
+                line = line.rstrip("\n")
+                if line in ("", "/."):
+                    continue
+                if line in diverted and diverted[line][1] != package:
+                    line = diverted[line][0]
+                directory, name = os.path.split(line)
+                if directory not in parents:
+                    parents[directory] = bootsort.resolve(root, directory)
+                parent = parents[directory]
+                if parent is None:
+                    continue
+                path = f"{parent}/{name}" if parent else name
+                names = owners.setdefault(path, [])
+                if package not in names:
+                    names.append(package)
+    return owners
+
+
+def option(options, name, default=None):
+    return options[options.index(name) + 1] if name in options[:-1] else default
+
+
+def in_process(compress):
+    """Return a function compressing {name: data} in threads, returns {name: compressed bytes}."""
+    def run(samples, workers=None):
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return dict(zip(samples, pool.map(lambda data: len(compress(data)), samples.values())))
+    return run
+
+
+def with_command(command, suffix):
+    """Return a function compressing {name: data} with one run of command per worker, returns {name: compressed bytes}."""
+    def run(samples, workers=None):
+        workers = workers or os.cpu_count()
+        with tempfile.TemporaryDirectory(prefix="packagesizes-") as tmp:
+            paths = {}
+            for index, (name, data) in enumerate(samples.items()):
+                paths[name] = os.path.join(tmp, str(index))
+                with open(paths[name], "wb") as f:
+                    f.write(data)
+            batches = [list(paths.values())[index::workers] for index in range(workers)]
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(lambda batch: subprocess.run(command + batch, check=True, stdin=subprocess.DEVNULL), [batch for batch in batches if batch]))
+            return {name: os.path.getsize(path + suffix) for name, path in paths.items()}
+    return run
+
+
+def estimator(options):
+    """Return (name, function compressing {name: data}) for the compressor in mksquashfs options.
+
+    gzip and xz compress in process, the others run their command line tool,
+    with zlib standing in when it is not installed.
+    """
+    compressor = option(options, "-comp", "gzip")
+    level = option(options, "-Xcompression-level", DEFAULT_LEVELS.get(compressor))
+    if compressor == "gzip":
+        return f"gzip:{level}", in_process(lambda data: zlib.compress(data, int(level)))
+    if compressor in ("xz", "lzma"):
+        return compressor, in_process(lzma.compress)
+
+    command, suffix = COMMANDS.get(compressor, ([compressor], ""))
+    command = list(command)
+    if compressor == "zstd":
+        command += ["--ultra", f"-{level}"] if int(level) > 19 else [f"-{level}"]
+    elif compressor == "lz4" and "-Xhc" in options:
+        command.append("-9")
+    if not suffix or not shutil.which(command[0]):
+        return "zlib:6", in_process(lambda data: zlib.compress(data, 6))
+    name = compressor + (f":{level}" if level else "")
+    return name, with_command(command, suffix)
+
+
+def sample(root, paths, files, seed):
+    """Return up to SAMPLE_BYTES of chunks of paths at random offsets, the same ones for the same seed."""
+    rng = random.Random(seed)
+    order = sorted(paths)
+    rng.shuffle(order)
+    data = bytearray()
+    for path in order:
+        if len(data) >= SAMPLE_BYTES:
+            break
+        length = min(SAMPLE_CHUNK, files[path], SAMPLE_BYTES - len(data))
+        try:
+            with open(os.path.join(root, path), "rb") as f:
+                f.seek(rng.randrange(files[path] - length + 1))
+                data += f.read(length)
+        except OSError:
+            continue
+    return bytes(data)
+
+
+def compression_ratios(root, files_of, files, compress, workers=None):
+    """Return {package: compressed / installed bytes of a sample of its files}, at most 1 like in squashfs."""
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        samples = dict(zip(files_of, pool.map(lambda item: sample(root, item[1], files, item[0]), files_of.items())))
+    sizes = compress({package: data for package, data in samples.items() if data}, workers)
+    return {package: min(sizes[package] / len(data), 1.0) if data else 1.0 for package, data in samples.items()}
+
+
+def attribute(files, owners, ratios, needed_by):
+    """Return {name: sizes} for the names of needed_by, {package: names that need it}.
+
+    installed and compressed are the share of the files of the name, exclusive
+    what only it needs, the bytes leaving it out would save, and footprint
+    everything it needs, shared or not.
+    """
+    rows = {}
+    for path, size in files.items():
+        packages = owners[path]
+        compressed = size * sum(ratios[package] for package in packages) / len(packages)
+        names = set()
+        for package in packages:
+            names |= needed_by.get(package, {UNREQUESTED})
+        for name in names:
+            row = rows.setdefault(name, dict.fromkeys(FIELDS, 0))
+            row["installed"] += size / len(names)
+            row["compressed"] += compressed / len(names)
+            row["footprint"] += size
+            row["footprint_compressed"] += compressed
+            if len(names) == 1:
+                row["exclusive"] += size
+                row["exclusive_compressed"] += compressed
+    return {name: {field: round(value) for field, value in row.items()} for name, row in rows.items()}
+
+
+def analyze(root, groups, options, excludes=(), workers=None):
+    """Return the size report of root for groups, {group: [packages]}, estimated for the mksquashfs options."""
+    packages, provides = squashlayers.installed_packages(root)
+    files = regular_files(root, excludes)
+    owned = file_owners(root, packages)
+    owners = {path: owned.get(path) or [UNPACKAGED] for path in files}
+
+    files_of = {}
+    for path, names in owners.items():
+        for package in names:
+            files_of.setdefault(package, []).append(path)
+    name, compress = estimator(options)
+    ratios = compression_ratios(root, files_of, files, compress, workers)
+
+    top_level = list(dict.fromkeys(package for members in groups.values() for package in members))
+    group_needs = {UNPACKAGED: {UNPACKAGED}}
+    top_level_needs = {UNPACKAGED: {UNPACKAGED}}
+    for group, members in groups.items():
+        for package in squashlayers.closure(members, packages, provides):
+            group_needs.setdefault(package, set()).add(group)
+    for top in top_level:
+        for package in squashlayers.closure([top], packages, provides):
+            top_level_needs.setdefault(package, set()).add(top)
+
+    package_rows = attribute(files, owners, ratios, {package: {package} for package in files_of})
+    for package, row in package_rows.items():
+        row["files"] = len(files_of[package])
+        row["ratio"] = round(ratios[package], 4)
+        row["groups"] = sorted(group_needs.get(package, {UNREQUESTED}))
+
+    return {
+        "root": os.path.abspath(root),
+        "estimator": name,
+        "files": len(files),
+        "installed": sum(files.values()),
+        "compressed": sum(row["compressed"] for row in package_rows.values()),
+        "groups": attribute(files, owners, ratios, group_needs),
+        "top_level": attribute(files, owners, ratios, top_level_needs),
+        "packages": package_rows,
+        "missing": [package for package in top_level if package not in packages],
+    }
+
+
+def over_budget(report, budgets):
+    """Return [(group, estimated compressed share, budget)] of the groups of budgets over it."""
+    over = []
+    for group, budget in budgets.items():
+        size = report["groups"].get(group, {}).get("compressed", 0)
+        if size > budget:
+            over.append((group, size, budget))
+    return over
+
+
+def mib(size):
+    return f"{size / 1048576:>9.1f} MiB"
+
+
+def table(title, rows, budgets=None):
+    """Return the lines of a table of rows, largest compressed share first, with a budget column when budgets is given."""
+    lines = [f"{title:<32} {'installed':>13} {'compressed':>13} {'exclusive':>13} {'footprint':>13}" + (f" {'budget':>13}" if budgets is not None else "")]
+    for name, row in sorted(rows.items(), key=lambda item: -item[1]["compressed"]):
+        line = f"{name:<32} {mib(row['installed'])} {mib(row['compressed'])} {mib(row['exclusive'])} {mib(row['footprint'])}"
+        if budgets and name in budgets:
+            line += f" {mib(budgets[name])}" + (" OVER" if row["compressed"] > budgets[name] else "")
+        lines.append(line)
+    return lines
+
+
+def format_table(report, budgets=None):
+    """Return the report as text tables of the groups and the top-level packages."""
+    lines = [f"{report['files']} files, {mib(report['installed']).strip()} installed, about {mib(report['compressed']).strip()} compressed with {report['estimator']}",
+             "Shared files are split evenly, exclusive is what only it needs and footprint all it needs.",
+             ""]
+    lines += table("group", report["groups"], budgets or {})
+    lines += [""] + table("package", report["top_level"])
+    if report["missing"]:
+        lines += ["", f"Not installed: {', '.join(report['missing'])}"]
+    return "\n".join(lines) + "\n"
+
+
+def write(report, path, budgets=None):
+    """Write the report as JSON to path and as text tables next to it, returns the path of the tables."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(dict(report, budgets=budgets or {}), f, indent=1)
+    table = os.path.splitext(path)[0] + ".txt"
+    with open(table, "w") as f:
+        f.write(format_table(report, budgets))
+    return table
+
+
+def print_groups(report, budgets=None, prefix=""):
+    print(f"[*] {prefix}Package group sizes, about {mib(report['compressed']).strip()} compressed with {report['estimator']}:")
+    for line in table("group", report["groups"], budgets or {}):
+        print(f"    {line}")
+
+
+def parse_size(size):
+    """Return the bytes of a size like 800M or 2G."""
+    number, unit = (size[:-1], size[-1].upper()) if size[-1:].upper() in UNITS else (size, "")
+    return int(float(number) * UNITS[unit])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report how much of a root filesystem every package group and listed package is responsible for.")
+    parser.add_argument("root", help="Root to analyze, like an unsquashed filesystem.squashfs.")
+    parser.add_argument("--variant", default="full", choices=list(chroot.VARIANT_PACKAGE_GROUPS), help="Variant whose package groups to report.")
+    parser.add_argument("--options", default="-comp zstd -b 1M", help="mksquashfs options to estimate the compressed sizes for.")
+    parser.add_argument("--budget", action="append", default=[], help="Compressed budget of a group as <group>=<size>, like tools=800M, can be given more than once.")
+    parser.add_argument("--output", default=None, help="Where to write the JSON, the tables go next to it.")
+    args = parser.parse_args()
+
+    try:
+        budgets = {group: parse_size(size) for group, _, size in (budget.partition("=") for budget in args.budget)}
+    except (ValueError, KeyError):
+        print("[X] Budgets are <group>=<size>, like tools=800M")
+        sys.exit(1)
+
+    report = analyze(args.root, chroot.VARIANT_PACKAGE_GROUPS[args.variant], args.options.split(), workers=os.cpu_count())
+    print(format_table(report, budgets), end="")
+    if args.output:
+        write(report, args.output, budgets)
+        print(f"[✓] Wrote the size report to {args.output}")
+    over = over_budget(report, budgets)
+    for group, size, budget in over:
+        print(f"[X] The {group} packages are about {size / 1048576:.1f} MiB compressed, over their budget of {budget / 1048576:.1f} MiB")
+    sys.exit(1 if over else 0)
+
+
+if __name__ == "__main__":
+    main()
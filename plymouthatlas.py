@@ -0,0 +1,339 @@
+try:
+    import sys
+    import os
+    import argparse
+    import math
+    import re
+    import shutil
+    import struct
+    import tempfile
+    import time
+    import zlib
+except ImportError as e:
+    print(f"[X] Failed to load required module, likely not installed: {e}")
+    try:
+        sys.exit(1)
+    except:
+        exit(1)
+
+
+# Sprite atlas for the spinner of the plymouth theme.
+#
+# The theme animates a spinner of one PNG per frame, which plymouth would open
+# and decode one by one early in boot. The frames are packed into a single
+# atlas PNG on a grid, and the offset of every frame is written into a block of
+# passkill.script, which then crops the frames out of the one image. The atlas
+# is decoded again and compared with the frames pixel by pixel before the frame
+# files are removed from the theme. Only 8-bit PNGs are read, which is what the
+# theme uses, and the atlas is written as 8-bit RGBA without interlacing.
+
+FRAME_PATTERN = re.compile(r"^LOGINSPINNER-(\d+)\.PNG$")
+ATLAS = "SPINNER-ATLAS.PNG"
+SCRIPT = "passkill.script"
+BLOCK_BEGIN = "// BEGIN SPINNER ATLAS"
+BLOCK_END = "// END SPINNER ATLAS"
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# Channels of the 8-bit color types: gray, RGB, palette, gray and alpha, RGBA
+CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+# Adam7 passes as (x start, y start, x step, y step)
+ADAM7 = [(0, 0, 8, 8), (4, 0, 8, 8), (0, 4, 4, 8), (2, 0, 4, 4), (0, 2, 2, 4), (1, 0, 2, 2), (0, 1, 1, 2)]
+
+
+def read_chunks(path):
+    """Return [(type, data)] of the chunks of the PNG at path."""
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[:8] != PNG_SIGNATURE:
+        raise ValueError(f"{path} is not a PNG")
+
+    chunks = []
+    offset = 8
+    while offset < len(data):
+        length, kind = struct.unpack(">I4s", data[offset:offset + 8])
+        chunks.append((kind, data[offset + 8:offset + 8 + length]))
+        offset += 12 + length
+        if kind == b"IEND":
+            break
+    return chunks
+
+
+def widen(data):
+    """Return data as an int with every byte in its own 16-bit lane, for arithmetic on whole rows at once."""
+    wide = bytearray(2 * len(data))
+    wide[1::2] = data
+    return int.from_bytes(wide, "big")
+
+
+def difference(row, other):
+    """Return (row - other) mod 256 for every byte of two rows of the same length."""
+    bias = int.from_bytes(b"\x01\x00" * len(row), "big")
+    return (widen(row) + bias - widen(other)).to_bytes(2 * len(row), "big")[1::2]
+
+
+def paeth(a, b, c):
+    p = a + b - c
+    pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+    if pa <= pb and pa <= pc:
+        return a
+    return b if pb <= pc else c
+
+
+def unfilter(data, offset, width, height, bpp):
+    """Undo the scanline filters of a width by height block of data at offset, returns (rows, offset after the block)."""
+    stride = width * bpp
+    rows = []
+    previous = bytearray(stride)
+    for _ in range(height):
+        kind = data[offset]
+        row = bytearray(data[offset + 1:offset + 1 + stride])
+        offset += 1 + stride
+        if kind == 1:
+            for i in range(bpp, stride):
+                row[i] = (row[i] + row[i - bpp]) & 0xFF
+        elif kind == 2:
+            row = bytearray((widen(row) + widen(previous)).to_bytes(2 * stride, "big")[1::2])
+        elif kind == 3:
+            for i in range(stride):
+                row[i] = (row[i] + ((row[i - bpp] if i >= bpp else 0) + previous[i]) // 2) & 0xFF
+        elif kind == 4:
+            for i in range(stride):
+                row[i] = (row[i] + paeth(row[i - bpp] if i >= bpp else 0, previous[i], previous[i - bpp] if i >= bpp else 0)) & 0xFF
+        elif kind != 0:
+            raise ValueError(f"Unknown PNG filter {kind}")
+        rows.append(row)
+        previous = row
+    return rows, offset
+
+
+def to_rgba(pixel, color_type, palette, transparency):
+    if color_type == 6:
+        return bytes(pixel)
+    if color_type == 2:
+        alpha = 0 if transparency and bytes(pixel) == transparency else 255
+        return bytes(pixel) + bytes([alpha])
+    if color_type == 3:
+        index = pixel[0]
+        return palette[index * 3:index * 3 + 3] + bytes([transparency[index] if index < len(transparency) else 255])
+    if color_type == 4:
+        return bytes([pixel[0]] * 3 + [pixel[1]])
+    alpha = 0 if transparency and pixel[0] == transparency[0] else 255
+    return bytes([pixel[0]] * 3 + [alpha])
+
+
+def read_png(path):
+    """Return (width, height, RGBA rows) of an 8-bit PNG."""
+    chunks = read_chunks(path)
+    width, height, depth, color_type, _, _, interlace = struct.unpack(">IIBBBBB", chunks[0][1])
+    if depth != 8 or color_type not in CHANNELS:
+        raise ValueError(f"{path} is not an 8-bit PNG")
+
+    palette = b"".join(data for kind, data in chunks if kind == b"PLTE")
+    trns = b"".join(data for kind, data in chunks if kind == b"tRNS")
+    # Gray and RGB keep the transparent color as 16-bit samples, 8-bit images only use the low byte
+    transparency = trns[1::2] if color_type in (0, 2) else trns
+    data = zlib.decompress(b"".join(data for kind, data in chunks if kind == b"IDAT"))
+    bpp = CHANNELS[color_type]
+
+    pixels = [bytearray(width * 4) for _ in range(height)]
+    passes = ADAM7 if interlace else [(0, 0, 1, 1)]
+    offset = 0
+    for x0, y0, dx, dy in passes:
+        pass_width = (width - x0 + dx - 1) // dx
+        pass_height = (height - y0 + dy - 1) // dy
+        if not pass_width or not pass_height:
+            continue
+        rows, offset = unfilter(data, offset, pass_width, pass_height, bpp)
+        if dx == 1 and color_type in (2, 6) and not transparency:
+            # Whole rows of RGB or RGBA need no lookups, only the alpha filled in
+            for row_index, row in enumerate(rows):
+                target = pixels[y0 + row_index * dy]
+                if color_type == 6:
+                    target[:] = row
+                else:
+                    target[3::4] = b"\xff" * width
+                    for channel in range(3):
+                        target[channel::4] = row[channel::3]
+            continue
+        for row_index, row in enumerate(rows):
+            target = pixels[y0 + row_index * dy]
+            for column in range(pass_width):
+                x = x0 + column * dx
+                target[x * 4:x * 4 + 4] = to_rgba(row[column * bpp:column * bpp + bpp], color_type, palette, transparency)
+    return width, height, [bytes(row) for row in pixels]
+
+
+def filter_row(row, previous, bpp):
+    """Return the row with the None, Sub or Up filter, whichever compresses best on its own."""
+    candidates = [b"\x00" + row, b"\x01" + difference(row, bytes(bpp) + row[:-bpp]), b"\x02" + difference(row, previous)]
+    return min(candidates, key=lambda candidate: len(zlib.compress(candidate, 1)))
+
+
+def chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+
+def write_png(path, width, height, rows, channels=4):
+    """Write RGBA rows, or RGB rows with channels 3, as a non interlaced 8-bit PNG."""
+    previous = bytes(width * channels)
+    raw = bytearray()
+    for row in rows:
+        raw += filter_row(row, previous, channels)
+        previous = row
+
+    with open(path, "wb") as f:
+        f.write(PNG_SIGNATURE)
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6 if channels == 4 else 2, 0, 0, 0)))
+        f.write(chunk(b"IDAT", zlib.compress(bytes(raw), 9)))
+        f.write(chunk(b"IEND", b""))
+
+
+def find_frames(theme):
+    """Return [(index, path)] of the spinner frames of theme, by index."""
+    frames = []
+    for name in os.listdir(theme):
+        match = FRAME_PATTERN.match(name)
+        if match:
+            frames.append((int(match[1]), os.path.join(theme, name)))
+    return sorted(frames)
+
+
+def pack(frames):
+    """Lay frames out on a grid, returns (width, height, RGBA rows, {index: (x, y, width, height)})."""
+    images = {index: read_png(path) for index, path in frames}
+    cell_width = max(width for width, _, _ in images.values())
+    cell_height = max(height for _, height, _ in images.values())
+    columns = math.ceil(math.sqrt(len(images)))
+    grid_rows = math.ceil(len(images) / columns)
+
+    width, height = columns * cell_width, grid_rows * cell_height
+    pixels = [bytearray(width * 4) for _ in range(height)]
+    table = {}
+    for position, (index, (frame_width, frame_height, rows)) in enumerate(sorted(images.items())):
+        x = (position % columns) * cell_width
+        y = (position // columns) * cell_height
+        for row_index, row in enumerate(rows):
+            pixels[y + row_index][x * 4:(x + frame_width) * 4] = row
+        table[index] = (x, y, frame_width, frame_height)
+    return width, height, [bytes(row) for row in pixels], table
+
+
+def verify(atlas, table, frames):
+    """Raise ValueError unless every frame cropped from the atlas is the same as its own file, pixel by pixel."""
+    _, _, rows = read_png(atlas)
+    for index, path in frames:
+        x, y, width, height = table[index]
+        _, _, frame_rows = read_png(path)
+        cropped = [row[x * 4:(x + width) * 4] for row in rows[y:y + height]]
+        if cropped != frame_rows:
+            raise ValueError(f"Frame {index} of {atlas} differs from {os.path.basename(path)}")
+
+
+def script_block(table):
+    """Return the block of passkill.script with the offsets of every frame."""
+    lines = [BLOCK_BEGIN,
+             "// Written by plymouthatlas.py when the image is built, frame i of the spinner",
+             "// is cropped out of spinner_atlas.image at its x, y, width and height.",
+             f'spinner_atlas.image = "{ATLAS}";']
+    for index, (x, y, width, height) in sorted(table.items()):
+        lines.append(f"spinner_atlas.x[{index}] = {x}; spinner_atlas.y[{index}] = {y}; "
+                     f"spinner_atlas.width[{index}] = {width}; spinner_atlas.height[{index}] = {height};")
+    lines.append(BLOCK_END)
+    return "\n".join(lines)
+
+
+def replace_block(script, block):
+    start = script.index(BLOCK_BEGIN)
+    end = script.index(BLOCK_END, start) + len(BLOCK_END)
+    return script[:start] + block + script[end:]
+
+
+def load_seconds(paths, runs=5):
+    """Best time of runs to open, read and inflate the image data of paths, the part of loading them that does not depend on the decoder."""
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        for path in paths:
+            zlib.decompress(b"".join(data for kind, data in read_chunks(path) if kind == b"IDAT"))
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def build(theme):
+    """Pack the spinner of the theme directory into an atlas, point its script at it and remove the frame files.
+
+    Returns a report of the frames, the theme bytes plymouth copies into the
+    initramfs and the load times before and after, or None when the theme has
+    no frames.
+    """
+    frames = find_frames(theme)
+    if not frames:
+        return None
+
+    theme_bytes = sum(os.path.getsize(os.path.join(theme, name)) for name in os.listdir(theme))
+    frame_bytes = sum(os.path.getsize(path) for _, path in frames)
+    frames_load = load_seconds([path for _, path in frames])
+
+    width, height, rows, table = pack(frames)
+    atlas = os.path.join(theme, ATLAS)
+    write_png(atlas, width, height, rows)
+    verify(atlas, table, frames)
+
+    script_path = os.path.join(theme, SCRIPT)
+    with open(script_path) as f:
+        script = f.read()
+    with open(script_path, "w") as f:
+        f.write(replace_block(script, script_block(table)))
+
+    atlas_load = load_seconds([atlas])
+    for _, path in frames:
+        os.remove(path)
+
+    return {
+        "frames": len(frames),
+        "atlas_size": [width, height],
+        "frame_bytes": frame_bytes,
+        "atlas_bytes": os.path.getsize(atlas),
+        "theme_bytes": theme_bytes,
+        "theme_bytes_after": sum(os.path.getsize(os.path.join(theme, name)) for name in os.listdir(theme)),
+        "frames_load_seconds": frames_load,
+        "atlas_load_seconds": atlas_load,
+    }
+
+
+def print_report(report, prefix=""):
+    print(f"[*] {prefix}Packed {report['frames']} spinner frames into a {report['atlas_size'][0]}x{report['atlas_size'][1]} atlas, every frame matches")
+    print(f"    theme in the initramfs {report['theme_bytes']:>10} -> {report['theme_bytes_after']:>10} bytes ({report['theme_bytes_after'] - report['theme_bytes']:+})")
+    print(f"    spinner assets         {report['frame_bytes']:>10} -> {report['atlas_bytes']:>10} bytes, "
+          f"{report['frames']} files -> 1 file")
+    print(f"    asset load time        {report['frames_load_seconds'] * 1000:>9.2f}ms -> {report['atlas_load_seconds'] * 1000:>9.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack the spinner frames of the plymouth theme into an atlas and report what it saves, without touching the theme.")
+    parser.add_argument("theme", nargs="?", default=os.path.join(os.getcwd(), "plymouth"), help="Theme directory, defaults to plymouth.")
+    parser.add_argument("--output", default=None, help="Directory to keep the packed theme in, a temporary one by default.")
+    args = parser.parse_args()
+
+    output = args.output or tempfile.mkdtemp(prefix="plymouthatlas-")
+    try:
+        shutil.copytree(args.theme, output, dirs_exist_ok=True)
+        try:
+            report = build(output)
+        except ValueError as e:
+            print(f"[X] {e}")
+            sys.exit(1)
+        if not report:
+            print(f"[X] {args.theme} has no spinner frames")
+            sys.exit(1)
+        print_report(report)
+        if args.output:
+            print(f"[✓] Wrote the packed theme to {output}")
+    finally:
+        if not args.output:
+            shutil.rmtree(output, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+try:
+    import sys
+    import os
+    import argparse
+    import shutil
+    import tempfile
+    import plymouthatlas
+except ImportError as e:
+    print(f"[X] Failed to load required module, likely not installed: {e}")
+    try:
+        sys.exit(1)
+    except:
+        exit(1)
+
+
+# Pre-scaled backgrounds for the plymouth theme.
+#
+# passkill.script stretches BACKGROUND.PNG over the whole screen, so plymouth
+# scales it on every boot before the first frame is drawn. The background is
+# scaled here for the common screen sizes instead, with the same bilinear
+# sampling plymouth uses, and written as losslessly compressed PNGs next to it.
+# Their sizes are written into a block of passkill.script, which loads the one
+# that matches the screen and only scales BACKGROUND.PNG when none does. Every
+# variant is decoded again and compared with the scaled pixels before the
+# script is pointed at it.
+
+BACKGROUND = "BACKGROUND.PNG"
+BLOCK_BEGIN = "// BEGIN BACKGROUND SIZES"
+BLOCK_END = "// END BACKGROUND SIZES"
+
+
+def parse_size(size):
+    """Return (width, height) of a "<width>x<height>" size."""
+    width, _, height = size.lower().partition("x")
+    if not width.isdigit() or not height.isdigit() or not int(width) or not int(height):
+        raise ValueError(f"{size} is not a <width>x<height> size")
+    return int(width), int(height)
+
+
+def variant_name(width, height):
+    return f"BACKGROUND-{width}x{height}.PNG"
+
+
+def opaque(rows):
+    return all(row[3::4] == b"\xff" * (len(row) // 4) for row in rows)
+
+
+def samples(size, new_size):
+    """Return [(index, next index, weight of next out of 256)] for every pixel of new_size on a line of size.
+
+    The first and last pixels of both lines line up, like in the scaling of
+    plymouth, and the weight is rounded down.
+    """
+    scale = (size - 1) / max(new_size - 1, 1)
+    points = []
+    for position in range(new_size):
+        source = position * scale
+        index = min(int(source), size - 1)
+        points.append((index, min(index + 1, size - 1), int((source - index) * 256)))
+    return points
+
+
+def scale(width, height, rows, channels, new_width, new_height):
+    """Return the rows of a bilinear scaling of a width by height image with channels bytes per pixel."""
+    first = []
+    second = []
+    weights = []
+    for index, next_index, weight in samples(width, new_width):
+        for channel in range(channels):
+            first.append(index * channels + channel)
+            second.append(next_index * channels + channel)
+            weights.append(weight)
+
+    # Every source row across first, then the scaled rows down as lanes of whole rows
+    across = []
+    for row in rows:
+        across.append(bytes((row[a] * (256 - weight) + row[b] * weight) >> 8 for a, b, weight in zip(first, second, weights)))
+    wide = [plymouthatlas.widen(row) for row in across]
+
+    length = 2 * new_width * channels
+    scaled = []
+    for index, next_index, weight in samples(height, new_height):
+        if not weight:
+            scaled.append(across[index])
+        else:
+            scaled.append((wide[index] * (256 - weight) + wide[next_index] * weight).to_bytes(length, "big")[0::2])
+    return scaled
+
+
+def verify(path, width, height, rows, channels):
+    """Raise ValueError unless the PNG at path decodes to exactly rows."""
+    read_width, read_height, read_rows = plymouthatlas.read_png(path)
+    if channels == 3:
+        read_rows = [bytes(byte for index, byte in enumerate(row) if index % 4 != 3) for row in read_rows]
+    if (read_width, read_height) != (width, height) or read_rows != rows:
+        raise ValueError(f"{os.path.basename(path)} does not decode to the scaled background")
+
+
+def script_block(sizes):
+    """Return the block of passkill.script with the file of every scaled size."""
+    lines = [BLOCK_BEGIN,
+             "// Written by plymouthbackground.py when the image is built."]
+    for width, height in sizes:
+        lines.append(f'background_sizes["{width}x{height}"] = "{variant_name(width, height)}";')
+    lines.append(BLOCK_END)
+    return "\n".join(lines)
+
+
+def replace_block(script, block):
+    start = script.index(BLOCK_BEGIN)
+    end = script.index(BLOCK_END, start) + len(BLOCK_END)
+    return script[:start] + block + script[end:]
+
+
+def build(theme, sizes, media_speed=None):
+    """Write a scaled background for every size into the theme directory and point its script at them.
+
+    Returns a report of the bytes every size adds to the theme plymouth copies
+    into the initramfs, the time to read and inflate it and the pixels plymouth
+    no longer has to scale on a screen of that size, or None when the theme has
+    no background or no sizes are given. media_speed is the MiB/s the initramfs
+    is read at, to turn the added bytes into time.
+    """
+    source = os.path.join(theme, BACKGROUND)
+    if not sizes or not os.path.exists(source):
+        return None
+
+    width, height, rows = plymouthatlas.read_png(source)
+    channels = 3 if opaque(rows) else 4
+    if channels == 3:
+        rows = [bytes(byte for index, byte in enumerate(row) if index % 4 != 3) for row in rows]
+
+    variants = []
+    for size in dict.fromkeys(parse_size(size) for size in sizes):
+        new_width, new_height = size
+        scaled = scale(width, height, rows, channels, new_width, new_height)
+        path = os.path.join(theme, variant_name(new_width, new_height))
+        plymouthatlas.write_png(path, new_width, new_height, scaled, channels)
+        verify(path, new_width, new_height, scaled, channels)
+
+        size_bytes = os.path.getsize(path)
+        variants.append({
+            "size": [new_width, new_height],
+            "file": os.path.basename(path),
+            "bytes": size_bytes,
+            "read_seconds": size_bytes / (media_speed * 1048576) if media_speed else None,
+            "load_seconds": plymouthatlas.load_seconds([path]),
+            "scaled_pixels": new_width * new_height,
+        })
+
+    script_path = os.path.join(theme, plymouthatlas.SCRIPT)
+    with open(script_path) as f:
+        script = f.read()
+    with open(script_path, "w") as f:
+        f.write(replace_block(script, script_block([tuple(variant["size"]) for variant in variants])))
+
+    return {
+        "source_size": [width, height],
+        "channels": channels,
+        "variants": variants,
+        "added_bytes": sum(variant["bytes"] for variant in variants),
+    }
+
+
+def print_report(report, prefix=""):
+    print(f"[*] {prefix}Scaled the {report['source_size'][0]}x{report['source_size'][1]} background to {len(report['variants'])} sizes, every one decodes losslessly")
+    for variant in report["variants"]:
+        width, height = variant["size"]
+        read = f"{variant['read_seconds'] * 1000:>7.2f}ms to read, " if variant["read_seconds"] is not None else ""
+        print(f"    {width:>5}x{height:<5} +{variant['bytes']:>9} bytes, {read}{variant['load_seconds'] * 1000:>7.2f}ms to inflate, "
+              f"saves scaling {variant['scaled_pixels'] / 1000000:.2f} megapixels at boot")
+    print(f"    added to the initramfs {report['added_bytes']:>10} bytes")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scale the background of the plymouth theme to the given sizes and report what it adds, without touching the theme.")
+    parser.add_argument("sizes", nargs="*", default=["1366x768", "1920x1080", "2560x1440", "3840x2160"], help="Sizes as <width>x<height>, defaults to the common screen sizes.")
+    parser.add_argument("--theme", default=os.path.join(os.getcwd(), "plymouth"), help="Theme directory, defaults to plymouth.")
+    parser.add_argument("--media-speed", type=float, default=20, help="MiB/s the initramfs is read at from the boot media.")
+    parser.add_argument("--output", default=None, help="Directory to keep the theme with the scaled backgrounds in, a temporary one by default.")
+    args = parser.parse_args()
+
+    output = args.output or tempfile.mkdtemp(prefix="plymouthbackground-")
+    try:
+        shutil.copytree(args.theme, output, dirs_exist_ok=True)
+        try:
+            report = build(output, args.sizes, args.media_speed)
+        except ValueError as e:
+            print(f"[X] {e}")
+            sys.exit(1)
+        if not report:
+            print(f"[X] {args.theme} has no {BACKGROUND}")
+            sys.exit(1)
+        print_report(report)
+        if args.output:
+            print(f"[✓] Wrote the theme with the scaled backgrounds to {output}")
+    finally:
+        if not args.output:
+            shutil.rmtree(output, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
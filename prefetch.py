@@ -0,0 +1,147 @@
+try:
+    import sys
+    import os
+    import re
+    import argparse
+    import hashlib
+    import subprocess
+    import threading
+    import time
+    import concurrent.futures
+    import requests
+except ImportError as e:
+    print(f"[X] Failed to load required module: {e}")
+    try:
+        sys.exit(1)
+    except:
+        exit(1)
+
+
+# Parallel package prefetch for apt-get.
+#
+# apt works out what an apt-get command would download with --print-uris, the
+# files are then fetched concurrently into the archives directory and checked
+# against the hashes apt printed, so the apt-get run itself finds everything
+# local. Runs inside the chroot.
+
+ARCHIVES = '/var/cache/apt/archives'
+CHUNK_SIZE = 1024 * 1024
+URI_LINE = re.compile(r"^'(?P<uri>[^']+)' (?P<filename>\S+) (?P<size>\d+) (?P<hash>\S*)$")
+HASH_NAMES = {'md5sum': 'md5', 'sha1': 'sha1', 'sha256': 'sha256', 'sha512': 'sha512'}
+
+local = threading.local()
+
+
+def print_uris(apt_args):
+    """Return (uri, filename, size, hash) for every file apt-get apt_args would download."""
+    output = subprocess.run(['apt-get', '--print-uris', '-qq', '-y']+apt_args, check=True, stdout=subprocess.PIPE, text=True).stdout
+
+    entries = []
+    for line in output.splitlines():
+        match = URI_LINE.match(line.strip())
+        if match and match['filename'].endswith('.deb'):
+            entries.append((match['uri'], match['filename'], int(match['size']), match['hash']))
+    return entries
+
+
+def verify(path, size, expected):
+    if os.path.getsize(path) != size:
+        return False
+    if ':' not in expected:
+        return True
+
+    name, value = expected.split(':', 1)
+    digest = hashlib.new(HASH_NAMES.get(name.lower(), name.lower()))
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest() == value
+
+
+def session():
+    # One keep-alive session per worker thread
+    if not hasattr(local, 'session'):
+        local.session = requests.Session()
+    return local.session
+
+
+def download(entry, archives):
+    uri, filename, size, expected = entry
+    path = os.path.join(archives, filename)
+    partial = os.path.join(archives, 'partial', filename)
+
+    start = time.time()
+    if os.path.exists(path) and verify(path, size, expected):
+        return 0, 0
+
+    try:
+        with session().get(uri, stream=True, timeout=60) as response:
+            response.raise_for_status()
+            with open(partial, 'wb') as f:
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    f.write(chunk)
+
+        if not verify(partial, size, expected):
+            raise Exception(f"Hash mismatch for {filename}")
+    except BaseException:
+        # Nothing half written is left for apt to pick up
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+
+    os.rename(partial, path)
+    return size, time.time() - start
+
+
+def prefetch(apt_args, archives=ARCHIVES, workers=8):
+    """Download everything apt-get apt_args needs with a pool of workers.
+
+    Returns a dict with the number of files and bytes fetched, the wall time
+    and the summed per-file download time, which is what fetching the files
+    one after another would have taken.
+    """
+    entries = print_uris(apt_args)
+    os.makedirs(os.path.join(archives, 'partial'), exist_ok=True)
+
+    stats = {'files': 0, 'bytes': 0, 'wall': 0.0, 'serial': 0.0, 'failed': 0}
+    start = time.time()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(download, entry, archives): entry for entry in entries}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                size, elapsed = future.result()
+            except Exception as e:
+                # apt fetches whatever is still missing itself
+                print(f"[PREFETCH] {futures[future][1]}: {e}")
+                stats['failed'] += 1
+                continue
+
+            if size:
+                stats['files'] += 1
+                stats['bytes'] += size
+                stats['serial'] += elapsed
+
+    stats['wall'] = time.time() - start
+    return stats
+
+
+def report(stats):
+    wall = max(stats['wall'], 0.001)
+    print(f"[PREFETCH] {stats['files']} files, {stats['bytes'] / 1048576:.1f} MiB in {stats['wall']:.2f}s "
+          f"({stats['files'] / wall:.1f} files/s, {stats['bytes'] / 1048576 / wall:.1f} MiB/s), "
+          f"serial path {stats['serial']:.2f}s, {stats['failed']} failed")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prefetch the packages an apt-get command would download.")
+    parser.add_argument('--workers', type=int, default=8, help="Number of concurrent downloads, 1 measures the serial path.")
+    parser.add_argument('--archives', default=ARCHIVES, help="Directory to download packages to.")
+    parser.add_argument('apt_args', nargs=argparse.REMAINDER, help="Arguments for apt-get, for example: install htop")
+    args = parser.parse_args()
+
+    report(prefetch(args.apt_args, args.archives, args.workers))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+try:
+    import sys
+    import os
+    import argparse
+    import json
+    import random
+    import shutil
+    import subprocess
+    import tempfile
+    import time
+    import manifest
+    import squashlayers
+except ImportError as e:
+    print(f"[X] Failed to load required module, likely not installed: {e}")
+    try:
+        sys.exit(1)
+    except:
+        exit(1)
+
+
+# mksquashfs compression benchmark.
+#
+# Builds the squashfs of a root tree for every combination of compressor, block
+# size and processor count, and records build time, peak RSS, output size and
+# unsquashfs throughput for a full sequential extract and for reading a random
+# sample of files. The sample is read from the image mounted like casper does
+# when running as root, and with a single unsquashfs extract of just those
+# files otherwise. The recommended combination is written as a profile that
+# build.py uses when SQUASHFS_PROFILE is set to it.
+
+DEFAULT_COMPRESSORS = ["zstd:3", "zstd:15", "zstd:19", "xz", "lz4", "lz4:hc", "gzip:9"]
+DEFAULT_BLOCK_SIZES = ["128K", "256K", "1M"]
+CHUNK_SIZE = 1024 * 1024
+
+
+def compressor_options(spec):
+    """Turn a spec like zstd:19 or lz4:hc into mksquashfs options."""
+    name, _, level = spec.partition(":")
+    options = ["-comp", name]
+    if level == "hc":
+        options.append("-Xhc")
+    elif level:
+        options += ["-Xcompression-level", level]
+    return options
+
+
+def run_measured(command):
+    """Run command, returns (seconds, peak RSS in bytes)."""
+    start = time.time()
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.time() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
+    return elapsed, usage.ru_maxrss * 1024
+
+
+def drop_caches():
+    try:
+        os.sync()
+        with open("/proc/sys/vm/drop_caches", "w") as f:
+            f.write("3")
+    except OSError:
+        pass
+
+
+def sample_files(source, excludes, count, seed):
+    files = []
+    data = manifest.walk(source, excludes)
+    for path, record in data["entries"].items():
+        # unsquashfs reads its extract list line by line
+        if (record[0] & 0o170000) == 0o100000 and record[3] > 0 and "\n" not in path:
+            files.append((path, record[3]))
+
+    rng = random.Random(seed)
+    rng.shuffle(files)
+    return files[:count], data["size"], sum(size for _, size in files)
+
+
+def benchmark(source, image, options, excludes, sample, total_bytes, work, cold):
+    result = {"options": options}
+
+    command = ["mksquashfs", source, image, "-noappend", "-no-progress", "-quiet", "-wildcards"] + options
+    command += [arg for pattern in excludes for arg in ("-e", pattern)]
+    result["build_seconds"], result["peak_rss"] = run_measured(command)
+    result["size"] = os.path.getsize(image)
+
+    if cold:
+        drop_caches()
+    extract = os.path.join(work, "extract")
+    seconds, _ = run_measured(["unsquashfs", "-f", "-no-progress", "-d", extract, image])
+    shutil.rmtree(extract, ignore_errors=True)
+    result["sequential_seconds"] = seconds
+    result["sequential_throughput"] = total_bytes / seconds
+
+    if cold:
+        drop_caches()
+    result["random_method"], seconds = random_read(image, sample, work)
+    read = sum(size for _, size in sample)
+    result["random_seconds"] = seconds
+    result["random_throughput"] = read / seconds if seconds else 0.0
+
+    return result
+
+
+def mount(image, target):
+    """Mount image read only on target, returns whether it worked."""
+    if os.geteuid() != 0:
+        return False
+    os.makedirs(target, exist_ok=True)
+    if subprocess.run(["mount", "-t", "squashfs", "-o", "loop,ro", image, target], stderr=subprocess.DEVNULL).returncode != 0:
+        os.rmdir(target)
+        return False
+    return True
+
+
+def random_read(image, sample, work):
+    """Read the sample from image in its random order, returns (method, seconds)."""
+    target = os.path.join(work, "mount")
+    if mount(image, target):
+        try:
+            start = time.time()
+            for path, _ in sample:
+                with open(os.path.join(target, path), "rb") as f:
+                    while f.read(CHUNK_SIZE):
+                        pass
+            return "mount", time.time() - start
+        finally:
+            subprocess.run(["umount", target], check=True)
+            os.rmdir(target)
+
+    # One process for the whole sample, so its startup is not counted per file
+    extract_list = os.path.join(work, "extract.list")
+    # Extract list entries are wildcards like mksquashfs excludes
+    squashlayers.write_excludes(extract_list, [path for path, _ in sample])
+    extract = os.path.join(work, "sample")
+    try:
+        seconds, _ = run_measured(["unsquashfs", "-f", "-no-progress", "-d", extract, "-ef", extract_list, image])
+    finally:
+        shutil.rmtree(extract, ignore_errors=True)
+        os.remove(extract_list)
+    return "unsquashfs", seconds
+
+
+def recommend(results, objective, tolerance):
+    """Pick the best result for objective among the ones close to the smallest output."""
+    smallest = min(result["size"] for result in results)
+    if objective == "size":
+        return min(results, key=lambda result: result["size"])
+
+    candidates = [result for result in results if result["size"] <= smallest * (1 + tolerance)]
+    if objective == "build":
+        return min(candidates, key=lambda result: result["build_seconds"])
+    return max(candidates, key=lambda result: result["random_throughput"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark mksquashfs options on a root tree and recommend a profile.")
+    parser.add_argument("source", help="Root tree to compress, for example a mounted build root.")
+    parser.add_argument("--compressors", default=",".join(DEFAULT_COMPRESSORS), help="Comma separated compressor specs, like zstd:19,xz,lz4:hc.")
+    parser.add_argument("--block-sizes", default=",".join(DEFAULT_BLOCK_SIZES), help="Comma separated block sizes.")
+    parser.add_argument("--processors", default=str(os.cpu_count()), help="Comma separated -processors values.")
+    parser.add_argument("--exclude", action="append", default=[], help="mksquashfs wildcard to exclude, can be given more than once.")
+    parser.add_argument("--sample", type=int, default=200, help="Number of files read in the random read test.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the random read sample.")
+    parser.add_argument("--objective", choices=["boot", "size", "build"], default="boot", help="What the recommendation optimises for.")
+    parser.add_argument("--tolerance", type=float, default=0.05, help="How much larger than the smallest image a recommendation may be.")
+    parser.add_argument("--cold", action="store_true", help="Drop the page cache before every read test, needs root.")
+    parser.add_argument("--work", default=None, help="Directory for the test images, defaults to a temporary directory.")
+    parser.add_argument("--output", default=os.path.join(os.getcwd(), ".squashfs-profile.json"), help="Where to write the recommended profile.")
+    args = parser.parse_args()
+
+    for dep in ["mksquashfs", "unsquashfs"]:
+        if not shutil.which(dep):
+            print(f"[X] {dep} is not installed. Please install it to continue.")
+            sys.exit(1)
+
+    work = args.work or tempfile.mkdtemp(prefix="squashbench-")
+    os.makedirs(work, exist_ok=True)
+    image = os.path.join(work, "bench.squashfs")
+
+    print("[*] Sampling files...")
+    sample, disk_usage, total_bytes = sample_files(args.source, args.exclude, args.sample, args.seed)
+
+    results = []
+    try:
+        for compressor in args.compressors.split(","):
+            for block_size in args.block_sizes.split(","):
+                for processors in args.processors.split(","):
+                    options = compressor_options(compressor) + ["-b", block_size, "-processors", processors]
+                    print(f"[*] Benchmarking {' '.join(options)}...")
+                    try:
+                        result = benchmark(args.source, image, options, args.exclude, sample, total_bytes, work, args.cold)
+                    except subprocess.CalledProcessError as e:
+                        print(f"[X] {' '.join(options)} failed: {e}")
+                        continue
+
+                    result["compressor"] = compressor
+                    result["block_size"] = block_size
+                    result["processors"] = int(processors)
+                    results.append(result)
+                    print(f"    {result['size'] / 1048576:.1f} MiB in {result['build_seconds']:.1f}s, "
+                          f"peak RSS {result['peak_rss'] / 1048576:.0f} MiB, "
+                          f"sequential {result['sequential_throughput'] / 1048576:.1f} MiB/s, "
+                          f"random {result['random_throughput'] / 1048576:.1f} MiB/s")
+    finally:
+        if os.path.exists(image):
+            os.remove(image)
+        if not args.work:
+            shutil.rmtree(work, ignore_errors=True)
+
+    if not results:
+        print("[X] No combination could be benchmarked.")
+        sys.exit(1)
+
+    best = recommend(results, args.objective, args.tolerance)
+
+    with open(args.output, "w") as f:
+        json.dump({
+            "options": best["options"],
+            "objective": args.objective,
+            "tolerance": args.tolerance,
+            "source_bytes": disk_usage,
+            "created": time.time(),
+            "results": results,
+        }, f, indent=1)
+
+    print(f"[✓] Recommended: {' '.join(best['options'])}")
+    print(f"[*] Wrote profile to {args.output}, to build with it add to config.py:")
+    print(f"SQUASHFS_PROFILE={json.dumps(os.path.abspath(args.output))}")
+    print("[*] Or set the options themselves:")
+    print(f"SQUASHFS_OPTIONS={json.dumps(best['options'])}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+try:
+    import sys
+    import os
+    import stat
+    import bootsort
+    import manifest
+except ImportError as e:
+    print(f"[X] Failed to load required module, likely not installed: {e}")
+    try:
+        sys.exit(1)
+    except:
+        exit(1)
+
+
+# Layered squashfs images.
+#
+# Splits a root filesystem into the layers of chroot.SQUASHFS_LAYERS. Every
+# installed package belongs to the first layer whose packages depend on or
+# recommend it, directly or not. The essential and required packages, which
+# nothing names as a dependency, start the first layer, and packages no layer
+# reaches belong to the first layer as well, so every layer boots. A file
+# goes into the first layer of the packages that own it, and files no package
+# owns, like the configuration the build writes and PassKill itself, go into
+# the first layer. No file is in two layers, so casper can stack them in any
+# order. Each layer is made by running mksquashfs on the whole root with the
+# paths of the other layers excluded.
+
+STATUS = os.path.join("var", "lib", "dpkg", "status")
+DEPENDS = ("Pre-Depends", "Depends")
+# Layers follow Recommends too, apt installs them along with a package
+LAYER_DEPENDS = DEPENDS + ("Recommends",)
+# Characters mksquashfs -wildcards reads as patterns in exclude files
+WILDCARD_CHARACTERS = "\\*?[]!@+()"
+
+
+def status(root):
+    """Return the fields of every installed package in the dpkg status of root."""
+    installed = []
+    with open(os.path.join(root, STATUS), errors="replace") as f:
+        for paragraph in f.read().split("\n\n"):
+            fields = {}
+            key = None
+            for line in paragraph.splitlines():
+                if line.startswith((" ", "\t")) and key:
+                    fields[key] += " " + line.strip()
+                elif ":" in line:
+                    key, _, value = line.partition(":")
+                    fields[key] = value.strip()
+            if "Package" in fields and fields.get("Status", "").endswith(" installed"):
+                installed.append(fields)
+    return installed
+
+
+def installed_packages(root, depends=DEPENDS):
+    """Return {package: [[alternative, ...] of each dependency]} and {virtual package: [providers]} of the installed packages.
+
+    depends are the status fields that count as dependencies.
+    """
+    packages = {}
+    provides = {}
+    for fields in status(root):
+        dependencies = []
+        for field in depends:
+            for dependency in filter(None, (item.strip() for item in fields.get(field, "").split(","))):
+                dependencies.append([alternative.split()[0].split(":")[0] for alternative in dependency.split("|") if alternative.strip()])
+        packages[fields["Package"]] = dependencies
+        for virtual in filter(None, (item.strip() for item in fields.get("Provides", "").split(","))):
+            provides.setdefault(virtual.split()[0], []).append(fields["Package"])
+    return packages, provides
+
+
+def base_packages(root):
+    """Return the installed packages that are essential or of required priority, the ones every system has."""
+    return [fields["Package"] for fields in status(root)
+            if fields.get("Essential", "").lower() == "yes" or fields.get("Priority", "").lower() == "required"]
+
+
+def closure(roots, packages, provides):
+    """Return the installed packages of roots and everything they depend on, the first installed alternative of each dependency counts."""
+    seen = set()
+    stack = [package for package in roots if package in packages]
+    while stack:
+        package = stack.pop()
+        if package in seen:
+            continue
+        seen.add(package)
+        for alternatives in packages[package]:
+            for alternative in alternatives:
+                found = [alternative] if alternative in packages else [provider for provider in provides.get(alternative, []) if provider in packages]
+                if found:
+                    stack += found
+                    break
+    return seen
+
+
+def package_layers(root, layers):
+    """Return {package: index of its layer in layers} for every installed package."""
+    packages, provides = installed_packages(root, LAYER_DEPENDS)
+    base = base_packages(root)
+    assigned = {}
+    for index, (_, spec) in enumerate(layers):
+        for package in closure(list(spec["packages"]) + (base if index == 0 else []), packages, provides):
+            assigned.setdefault(package, index)
+    # Whatever no layer asks for may still be needed to boot
+    for package in packages:
+        assigned.setdefault(package, 0)
+    return assigned
+
+
+def owned_paths(root, assigned):
+    """Return {path relative to root: index of its layer} for the paths packages own.
+
+    Paths in the file lists are resolved through the symlinked directories of
+    the root, like /lib to usr/lib, but a symlink that is itself listed stays
+    the symlink.
+    """
+    owned = {}
+    parents = {}
+    for package, list_path in bootsort.package_lists(root).items():
+        layer = assigned.get(package)
+        if layer is None:
+            continue
+        with open(list_path, errors="replace") as f:
+            for line in f:
+                line = line.rstrip("\n")
+                if line in ("", "/."):
+                    continue
+                directory, name = os.path.split(line)
+                if directory not in parents:
+                    parents[directory] = bootsort.resolve(root, directory)
+                parent = parents[directory]
+                if parent is None:
+                    continue
+                path = f"{parent}/{name}" if parent else name
+                if owned.get(path, layer) >= layer:
+                    owned[path] = layer
+    return owned
+
+
+def split(root, layers, excludes=()):
+    """Return ({layer name: [paths to exclude to make it]}, {layer name: bytes}) for root.
+
+    The excluded paths are the topmost ones without anything of the layer
+    below them, so whole directories of other layers are a single entry. A
+    layer with nothing in it gets None instead of its excludes.
+    """
+    owned = owned_paths(root, package_layers(root, layers))
+    root_dev = os.lstat(root).st_dev
+
+    # Bit i of present[path] is set when path or anything below it is in layer i
+    present = {"": 0}
+    sizes = [0] * len(layers)
+    inodes = set()
+    stack = [""]
+    while stack:
+        rel = stack.pop()
+        with os.scandir(os.path.join(root, rel) if rel else root) as it:
+            for entry in it:
+                path = f"{rel}/{entry.name}" if rel else entry.name
+                if manifest.excluded(path, excludes):
+                    continue
+                st = entry.stat(follow_symlinks=False)
+                layer = owned.get(path, 0)
+                present[path] = 1 << layer
+                if stat.S_ISDIR(st.st_mode) and st.st_dev == root_dev:
+                    stack.append(path)
+                if (st.st_dev, st.st_ino) not in inodes:
+                    inodes.add((st.st_dev, st.st_ino))
+                    sizes[layer] += st.st_blocks * 512
+
+    # A child sorts after its parent, so in reverse order every subtree is done before its directory
+    paths = sorted(present, reverse=True)
+    for path in paths:
+        if path:
+            present[os.path.dirname(path)] |= present[path]
+
+    split_excludes = {}
+    for index, (name, _) in enumerate(layers):
+        bit = 1 << index
+        if not present[""] & bit:
+            split_excludes[name] = None
+            continue
+        split_excludes[name] = [path for path in reversed(paths) if path and not present[path] & bit and present[os.path.dirname(path)] & bit]
+    return split_excludes, {name: sizes[index] for index, (name, _) in enumerate(layers)}
+
+
+def write_excludes(path, paths):
+    """Write paths as a mksquashfs exclude file for -wildcards, paths with a newline cannot be excluded and are left out."""
+    with open(path, "w") as f:
+        for excluded in paths:
+            if "\n" in excluded:
+                continue
+            f.write("".join("\\" + c if c in WILDCARD_CHARACTERS else c for c in excluded) + "\n")
@@ -0,0 +1,206 @@
+try:
+    import sys
+    import os
+    import collections
+    import concurrent.futures
+    import time
+except ImportError as e:
+    print(f"[X] Failed to load required module, likely not installed: {e}")
+    try:
+        sys.exit(1)
+    except:
+        exit(1)
+
+
+# Build step graph and scheduler.
+#
+# Every step declares the steps it runs after, the paths it reads and writes
+# and the resources it holds while it runs. A step also runs after every step
+# that writes one of its inputs. The scheduler starts each step on a worker
+# pool as soon as the steps it depends on are done and its resources are free,
+# and records when each one ran so the critical path of the build can be
+# reported.
+#
+# Two steps that can run at the same time must not write the same path, which
+# the graph checks before anything runs.
+
+
+class Step:
+    def __init__(self, name, func, after=(), inputs=(), outputs=(), resources=()):
+        self.name = name
+        self.func = func
+        self.after = list(after)
+        self.inputs = [os.path.normpath(path) for path in inputs]
+        self.outputs = [os.path.normpath(path) for path in outputs]
+        self.resources = list(resources)
+
+
+def overlaps(a, b):
+    """Whether path a is b, or one of them is below the other."""
+    return a == b or a.startswith(b.rstrip("/") + "/") or b.startswith(a.rstrip("/") + "/")
+
+
+class Graph:
+    def __init__(self):
+        self.steps = {}
+
+    def add(self, step):
+        if step.name in self.steps:
+            raise ValueError(f"Step {step.name} is defined twice")
+        self.steps[step.name] = step
+        return step
+
+    def dependencies(self, name):
+        """Return the names of the steps name runs after, declared or through its inputs."""
+        step = self.steps[name]
+        found = set()
+        for dependency in step.after:
+            if dependency not in self.steps:
+                raise ValueError(f"Step {name} runs after {dependency}, which does not exist")
+            found.add(dependency)
+        for other in self.steps.values():
+            if other is step:
+                continue
+            if any(overlaps(path, output) for path in step.inputs for output in other.outputs):
+                found.add(other.name)
+        return found
+
+    def order(self):
+        """Return the step names with every step after its dependencies, otherwise in the order they were added."""
+        dependencies = {name: self.dependencies(name) for name in self.steps}
+        order = []
+        done = set()
+        while len(order) < len(self.steps):
+            ready = [name for name in self.steps if name not in done and dependencies[name] <= done]
+            if not ready:
+                raise ValueError(f"Steps depend on each other in a cycle: {', '.join(name for name in self.steps if name not in done)}")
+            order += ready
+            done.update(ready)
+        return order
+
+    def ancestors(self):
+        """Return {name: set of every step it runs after, directly or not}."""
+        found = {}
+        for name in self.order():
+            dependencies = self.dependencies(name)
+            found[name] = set(dependencies).union(*(found[dependency] for dependency in dependencies))
+        return found
+
+    def validate(self):
+        """Raise ValueError when the graph has a cycle, an unknown step or two unordered steps writing the same path."""
+        ancestors = self.ancestors()
+        names = list(self.steps)
+        for index, first in enumerate(names):
+            for second in names[index + 1:]:
+                if first in ancestors[second] or second in ancestors[first]:
+                    continue
+                for a in self.steps[first].outputs:
+                    for b in self.steps[second].outputs:
+                        if overlaps(a, b):
+                            raise ValueError(f"Steps {first} and {second} can run at the same time and both write {min(a, b, key=len)}")
+
+
+class Scheduler:
+    """Run the steps of a graph on a worker pool.
+
+    limits maps a resource to how many steps may hold it at once, resources
+    without a limit are not limited. A resource named kind:instance is limited
+    per instance by the limit of kind, for example one dpkg:root per root.
+    """
+
+    def __init__(self, graph, workers=None, limits=None):
+        self.graph = graph
+        self.workers = workers or os.cpu_count()
+        self.limits = dict(limits or {})
+        self.timings = {}
+
+    def limit(self, resource):
+        if resource in self.limits:
+            return self.limits[resource]
+        return self.limits.get(resource.split(":", 1)[0])
+
+    def _available(self, step, held):
+        for resource in step.resources:
+            limit = self.limit(resource)
+            if limit is not None and held[resource] >= limit:
+                return False
+        return True
+
+    def _run_step(self, step):
+        start = time.time()
+        step.func()
+        return start, time.time()
+
+    def run(self):
+        """Run every step, returns {name: (start, end)}.
+
+        When a step fails no more steps are started, the running ones are
+        waited for and the error of the first failed step is raised.
+        """
+        self.graph.validate()
+        pending = self.graph.order()
+        dependencies = {name: self.graph.dependencies(name) for name in pending}
+        held = collections.Counter()
+        running = {}
+        error = None
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while pending or running:
+                if error is None:
+                    for name in list(pending):
+                        if len(running) >= self.workers:
+                            break
+                        step = self.graph.steps[name]
+                        if not dependencies[name] <= set(self.timings) or not self._available(step, held):
+                            continue
+                        pending.remove(name)
+                        held.update(step.resources)
+                        running[pool.submit(self._run_step, step)] = name
+
+                if not running:
+                    if error is None:
+                        raise ValueError(f"Steps can never start with the resource limits: {', '.join(pending)}")
+                    break
+
+                finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    held.subtract(self.graph.steps[name].resources)
+                    try:
+                        self.timings[name] = future.result()
+                    except BaseException as e:
+                        if error is None:
+                            error = e
+                            if running:
+                                print(f"[X] Step {name} failed, waiting for {len(running)} running steps to finish...")
+
+        if error is not None:
+            raise error
+        return self.timings
+
+    def critical_path(self):
+        """Return (names, seconds) of the chain of dependent steps that took the longest.
+
+        Only steps that ran count, so after a failure this is the critical path
+        of the part of the build that finished.
+        """
+        total = {}
+        previous = {}
+        for name in self.graph.order():
+            if name not in self.timings:
+                continue
+            start, end = self.timings[name]
+            before = max((dependency for dependency in self.graph.dependencies(name) if dependency in total), key=total.get, default=None)
+            total[name] = end - start + (total[before] if before else 0)
+            previous[name] = before
+
+        if not total:
+            return [], 0.0
+
+        name = max(total, key=total.get)
+        seconds = total[name]
+        path = []
+        while name:
+            path.append(name)
+            name = previous[name]
+        return path[::-1], seconds
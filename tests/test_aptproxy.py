@@ -0,0 +1,131 @@
+import functools
+import http.client
+import http.server
+import os
+import threading
+import urllib.request
+
+import pytest
+
+import aptproxy
+
+
+class Mirror(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, directory, handler=http.server.SimpleHTTPRequestHandler):
+        super().__init__(("127.0.0.1", 0), functools.partial(handler, directory=directory))
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/"
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class DroppingHandler(QuietHandler):
+    """Announces the whole file but hangs up after the first bytes."""
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "4096")
+        self.end_headers()
+        self.wfile.write(b"x" * 16)
+        self.wfile.flush()
+        self.close_connection = True
+
+
+@pytest.fixture
+def mirror_dir(tmp_path):
+    root = tmp_path / "mirror"
+    (root / "pool").mkdir(parents=True)
+    (root / "pool" / "hello_1.0_amd64.deb").write_bytes(b"deb" * 1000)
+    (root / "dists").mkdir()
+    (root / "dists" / "Release").write_bytes(b"Origin: test\n")
+    return root
+
+
+def start_proxy(tmp_path, upstream, max_size=1 << 30):
+    return aptproxy.AptProxy(("127.0.0.1", 0), str(tmp_path / "store"), max_size, upstream=upstream).start()
+
+
+def get(proxy, path):
+    with urllib.request.urlopen(proxy.url + path, timeout=10) as response:
+        return response.read()
+
+
+def test_round_trip_serves_package_from_store(tmp_path, mirror_dir):
+    mirror = Mirror(str(mirror_dir), QuietHandler)
+    proxy = start_proxy(tmp_path, mirror.url)
+    try:
+        assert get(proxy, "pool/hello_1.0_amd64.deb") == b"deb" * 1000
+        mirror.stop()
+        # Immutable files are served from the store without asking the upstream
+        assert get(proxy, "pool/hello_1.0_amd64.deb") == b"deb" * 1000
+    finally:
+        proxy.stop()
+
+
+def test_index_falls_back_to_stale_copy(tmp_path, mirror_dir):
+    mirror = Mirror(str(mirror_dir), QuietHandler)
+    proxy = start_proxy(tmp_path, mirror.url)
+    try:
+        assert get(proxy, "dists/Release") == b"Origin: test\n"
+        mirror.stop()
+        assert get(proxy, "dists/Release") == b"Origin: test\n"
+    finally:
+        proxy.stop()
+
+
+def test_refreshed_index_keeps_store_size(tmp_path, mirror_dir):
+    mirror = Mirror(str(mirror_dir), QuietHandler)
+    proxy = start_proxy(tmp_path, mirror.url)
+    try:
+        get(proxy, "pool/hello_1.0_amd64.deb")
+        get(proxy, "dists/Release")
+        release = mirror_dir / "dists" / "Release"
+        release.write_bytes(b"Origin: test\nSuite: newer\n")
+        os.utime(release, (0, os.stat(release).st_mtime + 60))
+        assert get(proxy, "dists/Release") == b"Origin: test\nSuite: newer\n"
+
+        store = proxy.store
+        # The handler commits the file after the client has the last byte
+        with store.key_lock(store.path(mirror.url + "dists/Release")):
+            assert store.size == sum(size for _, size, _ in store.entries())
+    finally:
+        proxy.stop()
+        mirror.stop()
+
+
+def test_dropped_upstream_does_not_send_second_response(tmp_path, mirror_dir):
+    mirror = Mirror(str(mirror_dir), DroppingHandler)
+    proxy = start_proxy(tmp_path, mirror.url)
+    try:
+        # A stale copy is in the store, but the response has already started
+        stale = tmp_path / "store" / f"127.0.0.1_{mirror.server_address[1]}" / "dists" / "Release"
+        stale.parent.mkdir(parents=True)
+        stale.write_bytes(b"stale")
+
+        conn = http.client.HTTPConnection("127.0.0.1", proxy.server_address[1], timeout=10)
+        conn.request("GET", "/dists/Release")
+        response = conn.getresponse()
+        assert response.status == 200
+        with pytest.raises(http.client.IncompleteRead) as e:
+            response.read()
+        assert e.value.partial == b"x" * 16
+        conn.close()
+
+        assert stale.read_bytes() == b"stale"
+    finally:
+        proxy.stop()
+        mirror.stop()
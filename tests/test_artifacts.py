@@ -0,0 +1,79 @@
+import shutil
+import subprocess
+
+import pytest
+
+import artifacts
+
+
+pytestmark = pytest.mark.skipif(not shutil.which("gpg"), reason="gpg is not installed")
+
+
+@pytest.fixture(scope="module")
+def key(tmp_path_factory):
+    """Return (path of an exported OpenPGP key, its fingerprint)."""
+    home = tmp_path_factory.mktemp("gnupg")
+    gpg = ["gpg", "--homedir", str(home), "--batch", "--quiet"]
+    subprocess.run(gpg + ["--passphrase", "", "--quick-gen-key", "Test <test@example.invalid>", "ed25519", "sign", "never"], check=True)
+    listing = subprocess.run(gpg + ["--with-colons", "--list-keys"], check=True, stdout=subprocess.PIPE, text=True).stdout
+    fingerprint = next(line.split(":")[9] for line in listing.splitlines() if line.startswith("fpr:"))
+    path = home / "key.asc"
+    subprocess.run(gpg + ["--armor", "--output", str(path), "--export", fingerprint], check=True)
+    return path, fingerprint
+
+
+def test_key_fingerprints(key):
+    path, fingerprint = key
+    assert artifacts.key_fingerprints(str(path)) == [fingerprint]
+
+
+def test_fetch_key_by_fingerprint(tmp_path, key):
+    path, fingerprint = key
+    store = tmp_path / "store"
+    store.mkdir()
+    digest = artifacts.fetch_file(str(store), "test.asc", path.as_uri(), fingerprint=fingerprint.lower())
+    assert digest == artifacts.sha256_file(path)
+    # Keys are checked by fingerprint, never pinned to a hash
+    assert "test.asc" not in artifacts.load_pins(str(store))
+    assert artifacts.fetch_file(str(store), "test.asc", path.as_uri(), offline=True, fingerprint=fingerprint) == digest
+
+
+def test_fetch_key_rejects_other_key(tmp_path, key):
+    path, _ = key
+    store = tmp_path / "store"
+    store.mkdir()
+    with pytest.raises(ValueError):
+        artifacts.fetch_file(str(store), "test.asc", path.as_uri(), fingerprint="0" * 40)
+    assert not (store / "test.asc").exists()
+
+
+def git(*args, cwd=None):
+    return subprocess.run(["git", "-c", "user.name=Test", "-c", "user.email=test@example.invalid"] + list(args),
+                          cwd=cwd, check=True, stdout=subprocess.PIPE, text=True).stdout.strip()
+
+
+@pytest.mark.skipif(not shutil.which("git"), reason="git is not installed")
+def test_reference_follows_remote_head_without_fetching(tmp_path):
+    upstream = tmp_path / "upstream"
+    upstream.mkdir()
+    git("init", "-q", cwd=upstream)
+    git("commit", "-q", "--allow-empty", "-m", "one", cwd=upstream)
+    store = tmp_path / "store"
+    store.mkdir()
+    entry = {"kind": "git", "url": str(upstream)}
+
+    first = artifacts.fetch(str(store), "repo.git", entry)
+    assert artifacts.reference(str(store), "repo.git", entry) == first
+
+    git("commit", "-q", "--allow-empty", "-m", "two", cwd=upstream)
+    second = git("rev-parse", "HEAD", cwd=upstream)
+    assert artifacts.reference(str(store), "repo.git", entry) == second
+    # Offline goes by the mirror, which has not been fetched yet
+    assert artifacts.reference(str(store), "repo.git", entry, offline=True) == first
+    with pytest.raises(FileNotFoundError):
+        artifacts.reference(str(store), "other.git", entry, offline=True)
+
+
+def test_reference_of_file_is_its_entry(tmp_path):
+    entry = {"kind": "file", "url": "https://example.invalid/key.asc", "fingerprint": "AB" * 20}
+    assert artifacts.reference(str(tmp_path), "key.asc", entry) == {"url": entry["url"], "fingerprint": entry["fingerprint"]}
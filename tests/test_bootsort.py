@@ -0,0 +1,64 @@
+import os
+
+import pytest
+
+import bootsort
+
+
+def write(path, data=b"x"):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+@pytest.fixture
+def root(tmp_path):
+    root = tmp_path / "root"
+    # Merged /usr like Ubuntu, /lib is a symlink to usr/lib
+    write(str(root / "usr" / "lib" / "systemd" / "systemd"))
+    write(str(root / "usr" / "bin" / "python3.10"))
+    write(str(root / "usr" / "bin" / "vim"))
+    os.symlink("python3.10", root / "usr" / "bin" / "python3")
+    os.symlink("usr/lib", root / "lib")
+    write(str(root / "etc" / "hostname"))
+    write(str(root / "etc" / "with space"))
+    info = root / "var" / "lib" / "dpkg" / "info"
+    write(str(info / "systemd.list"), b"/.\n/lib/systemd\n/lib/systemd/systemd\n")
+    write(str(info / "python3.10:amd64.list"), b"/usr/bin/python3.10\n")
+    write(str(info / "vim.list"), b"/usr/bin/vim\n")
+    return str(root)
+
+
+def test_resolve_follows_symlinked_directories(root):
+    assert bootsort.resolve(root, "/lib/systemd/systemd") == "usr/lib/systemd/systemd"
+    assert bootsort.resolve(root, "/usr/bin/python3") == "usr/bin/python3.10"
+    # .. after a symlink goes up from where the symlink points, like the kernel does
+    assert bootsort.resolve(root, "/lib/../bin/vim") == "usr/bin/vim"
+    assert bootsort.resolve(root, "/missing/file") is None
+
+
+def test_resolve_stops_symlink_loops(tmp_path):
+    os.symlink("loop", tmp_path / "loop")
+    assert bootsort.resolve(str(tmp_path), "/loop/file") is None
+
+
+def test_package_lists_drop_architecture(root):
+    assert set(bootsort.package_lists(root)) == {"systemd", "python3.10", "vim"}
+
+
+def test_generate_orders_boot_files_first(root, tmp_path):
+    access_list = tmp_path / "access.list"
+    access_list.write_text("# recorded\n/usr/bin/vim\n/etc/hostname 5\n")
+    output = str(tmp_path / "out" / "boot.sort")
+
+    count, digest = bootsort.generate(root, output, str(access_list), excludes=["etc/hostname"])
+    with open(output) as f:
+        lines = [line.split() for line in f]
+
+    assert lines[0] == ["usr/bin/vim", str(bootsort.ACCESS_PRIORITY)]
+    assert ["usr/lib/systemd/systemd", "30000"] in lines
+    assert ["usr/bin/python3.10", "20000"] in lines
+    # Excluded paths, directories and names mksquashfs cannot read back are left out
+    assert not any(line[0] in ("etc/hostname", "usr/lib/systemd") or len(line) != 2 for line in lines)
+    assert count == len(lines)
+    assert bootsort.generate(root, output, str(access_list), excludes=["etc/hostname"]) == (count, digest)
@@ -0,0 +1,79 @@
+import subprocess
+import sys
+import threading
+
+import buildtrace
+
+
+def busy(trace, name, started=None, release=None):
+    with trace.span(name):
+        if started:
+            started.set()
+        if release:
+            release.wait(10)
+        subprocess.run([sys.executable, "-c", "sum(range(200000))"], check=True)
+
+
+def spans(trace):
+    return {event["name"]: event["args"] for event in trace.events}
+
+
+def test_sequential_spans_count_child_cpu():
+    trace = buildtrace.Trace()
+    busy(trace, "first")
+    busy(trace, "second")
+    for args in spans(trace).values():
+        assert args["child_cpu"] is not None and args["child_cpu"] > 0
+        assert args["status"] == 0
+
+
+def test_nested_span_on_same_thread_keeps_child_cpu():
+    trace = buildtrace.Trace()
+    with trace.span("outer"):
+        busy(trace, "inner")
+    args = spans(trace)
+    assert args["outer"]["child_cpu"] is not None
+    assert args["inner"]["child_cpu"] is not None
+
+
+def test_overlapping_spans_drop_child_cpu():
+    trace = buildtrace.Trace()
+    started = threading.Event()
+    release = threading.Event()
+    thread = threading.Thread(target=busy, args=(trace, "background", started, release))
+    thread.start()
+    started.wait(10)
+    try:
+        with trace.span("foreground"):
+            release.set()
+            subprocess.run([sys.executable, "-c", "pass"], check=True)
+    finally:
+        thread.join()
+
+    args = spans(trace)
+    assert args["background"]["child_cpu"] is None
+    assert args["foreground"]["child_cpu"] is None
+
+
+def test_compare_flags_regressions_over_threshold(tmp_path):
+    old = buildtrace.Trace()
+    old.events = [
+        {"name": "install-packages", "cat": "phase", "ph": "X", "ts": 0, "dur": 100000000, "args": {"wall": 100.0, "cached": False}},
+        {"name": "mksquashfs", "cat": "step", "ph": "X", "ts": 0, "dur": 50000000, "args": {"wall": 50.0}},
+        {"name": "tiny", "cat": "step", "ph": "X", "ts": 0, "dur": 100000, "args": {"wall": 0.1}},
+    ]
+    new = buildtrace.Trace()
+    new.events = [
+        {"name": "install-packages", "cat": "phase", "ph": "X", "ts": 0, "dur": 1000000, "args": {"wall": 1.0, "cached": True}},
+        {"name": "mksquashfs", "cat": "step", "ph": "X", "ts": 0, "dur": 60000000, "args": {"wall": 60.0}},
+        {"name": "tiny", "cat": "step", "ph": "X", "ts": 0, "dur": 500000, "args": {"wall": 0.5}},
+        {"name": "new-step", "cat": "step", "ph": "X", "ts": 0, "dur": 500000, "args": {"wall": 0.5}},
+    ]
+    old.write(str(tmp_path / "old.json"))
+    new.write(str(tmp_path / "new.json"))
+
+    rows = buildtrace.compare(buildtrace.load(str(tmp_path / "old.json")), buildtrace.load(str(tmp_path / "new.json")), threshold=10)
+    regressed = {name: flag for _, name, _, _, _, flag in rows}
+    # Below min_seconds and a phase that was reused from a layer do not count
+    assert regressed == {"mksquashfs": True, "tiny": False, "install-packages": False}
+    assert rows[0][1] == "mksquashfs"
@@ -0,0 +1,13 @@
+import os
+
+import chrootsession
+
+
+def test_unescape_mount_point_keeps_utf8_names():
+    field = "/srv/chroot/home/jürgen\\040files".encode()
+    assert chrootsession.unescape_mount_point(field) == "/srv/chroot/home/jürgen files"
+
+
+def test_unescape_mount_point_matches_the_path_of_any_bytes():
+    field = b"/srv/chroot/mnt/\xff\\011tab\\134"
+    assert chrootsession.unescape_mount_point(field) == os.fsdecode(b"/srv/chroot/mnt/\xff\ttab\\")
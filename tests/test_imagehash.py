@@ -0,0 +1,100 @@
+import hashlib
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+
+import imagehash
+
+
+WRITER = "import sys; [sys.stdout.buffer.write(bytes([i % 256]) * 65536) for i in range(200)]"
+
+
+def test_stream_copies_and_hashes(tmp_path):
+    path = str(tmp_path / "image.iso")
+    process = subprocess.Popen([sys.executable, "-c", WRITER], stdout=subprocess.PIPE)
+    digests = imagehash.stream(process.stdout, path, ("md5", "sha256"))
+    assert process.wait() == 0
+
+    with open(path, "rb") as f:
+        data = f.read()
+    assert len(data) == 200 * 65536
+    assert digests == {"md5": hashlib.md5(data).hexdigest(), "sha256": hashlib.sha256(data).hexdigest()}
+
+
+def test_stream_removes_partial_file_on_failure(tmp_path, monkeypatch):
+    path = str(tmp_path / "image.iso")
+    read = os.read
+    reads = []
+
+    def failing_read(fd, size):
+        if reads:
+            raise OSError("pipe broke")
+        reads.append(size)
+        return read(fd, size)
+
+    threads = threading.active_count()
+    process = subprocess.Popen([sys.executable, "-c", WRITER], stdout=subprocess.PIPE)
+    monkeypatch.setattr(imagehash.os, "read", failing_read)
+    try:
+        with pytest.raises(OSError, match="pipe broke"):
+            imagehash.stream(process.stdout, path, ("md5", "sha256"))
+    finally:
+        monkeypatch.undo()
+        process.stdout.close()
+        process.wait()
+
+    assert not os.path.exists(path)
+    # The hashing threads were told to stop
+    assert threading.active_count() == threads
+
+
+def test_stream_stops_threads_when_destination_fails(tmp_path):
+    threads = threading.active_count()
+    process = subprocess.Popen([sys.executable, "-c", WRITER], stdout=subprocess.PIPE)
+    try:
+        with pytest.raises(OSError):
+            imagehash.stream(process.stdout, str(tmp_path / "missing" / "image.iso"), ("md5",))
+    finally:
+        process.stdout.close()
+        process.wait()
+    assert threading.active_count() == threads
+
+
+def test_write_lists_matches_md5sum(tmp_path):
+    root = tmp_path / "image"
+    (root / "casper").mkdir(parents=True)
+    (root / "isolinux").mkdir()
+    (root / "casper" / "filesystem.squashfs").write_bytes(b"squashfs" * 100000)
+    (root / "casper" / "odd\\name").write_bytes(b"odd")
+    (root / "isolinux" / "isolinux.bin").write_bytes(b"boot")
+    (root / "README.diskdefines").write_text("#define DISKNAME PassKill\n")
+
+    hashed = imagehash.write_lists(str(root), sha256=True, workers=2)
+    assert hashed == 800000 + 3 + len("#define DISKNAME PassKill\n")
+
+    with open(root / "md5sum.txt") as f:
+        md5 = f.read()
+    assert "isolinux" not in md5
+    assert md5.count("\n") == 3
+    # md5sum -c reads back the escaped names
+    result = subprocess.run(["md5sum", "-c", "--quiet", "md5sum.txt"], cwd=root)
+    assert result.returncode == 0
+    result = subprocess.run(["sha256sum", "-c", "--quiet", "sha256sum.txt"], cwd=root)
+    assert result.returncode == 0
+
+
+def test_write_lists_process_writes_the_same_lists(tmp_path):
+    root = tmp_path / "image"
+    (root / "casper").mkdir(parents=True)
+    (root / "casper" / "filesystem.squashfs").write_bytes(b"squashfs" * 1000)
+    (root / "README.diskdefines").write_text("#define DISKNAME PassKill\n")
+
+    hashed = imagehash.write_lists_process(str(root), sha256=True, workers=2)
+    assert hashed == 8000 + len("#define DISKNAME PassKill\n")
+    lists = {name: (root / name).read_text() for name in imagehash.LISTS.values()}
+
+    assert imagehash.write_lists(str(root), sha256=True, workers=2) == hashed
+    assert {name: (root / name).read_text() for name in imagehash.LISTS.values()} == lists
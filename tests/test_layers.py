@@ -0,0 +1,73 @@
+import os
+
+import layers
+
+
+PACKAGES = ["vim"]
+
+
+def helper():
+    return PACKAGES
+
+
+def phase():
+    helper()
+
+
+def other_phase():
+    helper()
+
+
+def key(namespace=None, **kwargs):
+    return layers.phase_key("parent", "phase", phase, namespace or globals(), **kwargs)
+
+
+def test_phase_key_covers_data_the_phase_reaches():
+    assert key() == key()
+    assert key(dict(globals(), PACKAGES=["vim", "git"])) != key()
+    assert layers.phase_key("parent", "phase", other_phase, globals()) != key()
+    assert layers.phase_key("other", "phase", phase, globals()) != key()
+
+
+def test_phase_key_covers_paths_and_values(tmp_path):
+    inputs = tmp_path / "inputs"
+    inputs.mkdir()
+    (inputs / "a").write_text("one")
+    before = key(paths=[str(inputs)])
+    (inputs / "a").write_text("two")
+    assert key(paths=[str(inputs)]) != before
+
+    assert key(values=[("repo.git", "abc")]) == key(values=[("repo.git", "abc")])
+    assert key(values=[("repo.git", "abc")]) != key(values=[("repo.git", "def")])
+
+
+def test_layer_lifecycle(tmp_path):
+    layer_dir = str(tmp_path / "layers")
+    root, work = layers.begin(layer_dir, "k1")
+    with open(os.path.join(root, "file"), "w") as f:
+        f.write("data")
+    assert not layers.is_complete(layer_dir, "k1")
+    layers.commit(layer_dir, "k1", "phase")
+    assert layers.is_complete(layer_dir, "k1")
+    assert not os.path.exists(work)
+
+    # A failed run leaves an incomplete layer that the next begin drops
+    layers.begin(layer_dir, "k2")
+    root, _ = layers.begin(layer_dir, "k2")
+    assert os.listdir(root) == []
+
+    assert layers.prune(layer_dir, {"k1"}) == ["k2"]
+    assert os.listdir(layer_dir) == ["k1"]
+
+
+def test_commit_copies_scratch_layer(tmp_path):
+    layer_dir = str(tmp_path / "layers")
+    scratch = str(tmp_path / "scratch")
+    root, _ = layers.begin(layer_dir, "k", scratch)
+    assert root.startswith(scratch)
+    with open(os.path.join(root, "file"), "w") as f:
+        f.write("data")
+    layers.commit(layer_dir, "k", "phase", scratch)
+    with open(os.path.join(layers.layer_root(layer_dir, "k"), "file")) as f:
+        assert f.read() == "data"
+    assert not os.path.exists(os.path.join(scratch, "k"))
@@ -0,0 +1,60 @@
+import os
+
+import manifest
+
+
+def make_tree(root):
+    os.makedirs(os.path.join(root, "etc", "apt"))
+    os.makedirs(os.path.join(root, "var", "cache"))
+    with open(os.path.join(root, "etc", "hostname"), "w") as f:
+        f.write("passkill\n")
+    with open(os.path.join(root, "var", "cache", "junk"), "w") as f:
+        f.write("junk\n")
+    os.symlink("hostname", os.path.join(root, "etc", "name"))
+
+
+def test_unchanged_tree_after_save_and_load(tmp_path):
+    root = str(tmp_path / "root")
+    make_tree(root)
+    path = str(tmp_path / "manifest.json")
+    manifest.save(path, manifest.walk(root))
+    assert manifest.diff(manifest.load(path), manifest.walk(root)) == ([], [], [])
+
+
+def test_diff_reports_added_removed_and_changed(tmp_path):
+    root = str(tmp_path / "root")
+    make_tree(root)
+    old = manifest.walk(root)
+
+    os.remove(os.path.join(root, "etc", "name"))
+    os.symlink("other", os.path.join(root, "etc", "name"))
+    os.mkdir(os.path.join(root, "opt"))
+    with open(os.path.join(root, "opt", "tool"), "w") as f:
+        f.write("tool\n")
+    os.remove(os.path.join(root, "var", "cache", "junk"))
+    with open(os.path.join(root, "etc", "hostname"), "w") as f:
+        f.write("passkill-2\n")
+
+    added, removed, changed = manifest.diff(old, manifest.walk(root))
+    assert added == ["opt", "opt/tool"]
+    assert removed == ["var/cache/junk"]
+    assert "etc/hostname" in changed
+    assert "etc/name" in changed
+
+
+def test_mtime_alone_is_a_change(tmp_path):
+    root = str(tmp_path / "root")
+    make_tree(root)
+    old = manifest.walk(root)
+    hostname = os.path.join(root, "etc", "hostname")
+    st = os.stat(hostname)
+    os.utime(hostname, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+    assert manifest.diff(old, manifest.walk(root))[2] == ["etc/hostname"]
+
+
+def test_excludes_are_not_walked(tmp_path):
+    root = str(tmp_path / "root")
+    make_tree(root)
+    entries = manifest.walk(root, ["var/cache/*"])["entries"]
+    assert "var/cache" in entries
+    assert "var/cache/junk" not in entries
@@ -0,0 +1,17 @@
+import membudget
+
+
+def test_parse_install_size():
+    assert membudget.parse_install_size("After this operation, 1,234 kB of additional disk space will be used.\n") == 1234000
+    assert membudget.parse_install_size("After this operation, 2.5 GB of additional disk space will be used.") == 2500000000
+    assert membudget.parse_install_size("0 upgraded, 0 newly installed.") is None
+
+
+def test_estimate_takes_the_bigger_peak():
+    gib = 1024 ** 3
+    assert membudget.estimate(gib) is None
+    # A fresh build goes by the install size and the usual squashfs ratio
+    root = gib + 3 * gib
+    assert membudget.estimate(gib, install=3 * gib) == int(max(3 * gib, root * membudget.SQUASHFS_RATIO + membudget.IMAGE_EXTRA))
+    # A previous build is trusted over the estimates
+    assert membudget.estimate(gib, install=3 * gib, previous_root=2 * gib, previous_squashfs=5 * gib) == 5 * gib + membudget.IMAGE_EXTRA
@@ -0,0 +1,88 @@
+import subprocess
+
+import pytest
+
+import packageplan
+
+
+SIMULATION = """NOTE: This is only a simulation!
+Reading package lists...
+Building dependency tree...
+The following packages will be REMOVED:
+  snapd* libfoo1*
+Remv libfoo1 [1.0-1]
+Purg snapd [2.63+22.04]
+Inst libc6 [2.35-0ubuntu3.6] (2.35-0ubuntu3.8 Ubuntu:22.04/jammy-updates [amd64])
+Inst firefox (1:131.0+build1-0ubuntu0.22.04.1~mt1 LP-PPA-mozillateam:22.04/jammy [amd64])
+Inst libgtk-3-0:amd64 (3.24.33-1ubuntu2 Ubuntu:22.04/jammy [amd64]) []
+Conf libc6 (2.35-0ubuntu3.8 Ubuntu:22.04/jammy-updates [amd64])
+Conf firefox (1:131.0+build1-0ubuntu0.22.04.1~mt1 LP-PPA-mozillateam:22.04/jammy [amd64])
+"""
+
+UPGRADE = """Inst libc6 [2.35-0ubuntu3.6] (2.35-0ubuntu3.8 Ubuntu:22.04/jammy-updates [amd64])
+Inst base-files [12ubuntu4.6] (12ubuntu4.7 Ubuntu:22.04/jammy-updates [amd64])
+"""
+
+
+@pytest.fixture
+def apt(monkeypatch):
+    """Record the apt-get runs and answer them with canned simulations."""
+    calls = []
+
+    def run(command, **kwargs):
+        calls.append(command)
+        output = UPGRADE if "dist-upgrade" in command else SIMULATION
+        return subprocess.CompletedProcess(command, 0, stdout=output)
+
+    monkeypatch.setattr(packageplan.subprocess, "run", run)
+    return calls
+
+
+def test_simulate_parses_installs_and_removals(apt):
+    installs, removals = packageplan.simulate(["install", "firefox"])
+    assert installs == [
+        ["libc6", "2.35-0ubuntu3.8", True],
+        ["firefox", "1:131.0+build1-0ubuntu0.22.04.1~mt1", False],
+        ["libgtk-3-0:amd64", "3.24.33-1ubuntu2", False],
+    ]
+    assert removals == ["libfoo1", "snapd"]
+    assert apt == [["apt-get", "-s", "-y", "install", "firefox"]]
+
+
+def test_resolve_adds_upgrades_and_purges_autoremovals(apt):
+    lock = packageplan.resolve(["firefox"], upgrade=True, autoremove=True)
+    assert apt[1] == ["apt-get", "-s", "-y", "install", "--auto-remove", "--purge", "firefox", "libc6", "base-files"]
+    assert lock["remove"] == ["libfoo1", "snapd"]
+    assert ["firefox", "1:131.0+build1-0ubuntu0.22.04.1~mt1"] in lock["install"]
+
+
+def test_apt_args_pin_every_version():
+    lock = {"install": [["firefox", "1:131.0"], ["libc6", "2.35"]], "remove": ["snapd"]}
+    assert packageplan.apt_args(lock) == ["install", "--no-install-recommends", "--purge", "firefox=1:131.0", "libc6=2.35", "snapd-"]
+
+
+def test_plan_replays_lock_until_request_changes(apt, monkeypatch, tmp_path):
+    monkeypatch.setattr(packageplan, "LOCK_DIR", str(tmp_path))
+    monkeypatch.setattr(packageplan, "preferences_digest", lambda: "pins")
+
+    first = packageplan.plan("install-packages", ["firefox"], autoremove=True)
+    resolved = len(apt)
+    # Only the availability check of the locked versions runs on a replay
+    assert packageplan.plan("install-packages", ["firefox"], autoremove=True) == first
+    assert len(apt) == resolved + 1
+    assert apt[-1][:4] == ["apt-get", "-s", "-y", "install"]
+
+    packageplan.plan("install-packages", ["firefox", "vim"], autoremove=True)
+    assert packageplan.load("install-packages")["request"]["packages"] == ["firefox", "vim"]
+
+
+def test_plan_resolves_again_when_versions_are_gone(apt, monkeypatch, tmp_path):
+    monkeypatch.setattr(packageplan, "LOCK_DIR", str(tmp_path))
+    monkeypatch.setattr(packageplan, "preferences_digest", lambda: "pins")
+    packageplan.plan("install-packages", ["firefox"])
+
+    stale = packageplan.load("install-packages")
+    stale["install"] = [["firefox", "0.1"]]
+    packageplan.save("install-packages", stale)
+    monkeypatch.setattr(packageplan, "available", lambda lock: False)
+    assert packageplan.plan("install-packages", ["firefox"])["install"] != [["firefox", "0.1"]]
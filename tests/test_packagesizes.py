@@ -0,0 +1,77 @@
+import os
+import random
+
+import pytest
+
+import packagesizes
+
+
+STATUS = """Package: base
+Status: install ok installed
+
+Package: tool
+Status: install ok installed
+Depends: libshared
+
+Package: libshared
+Status: install ok installed
+
+Package: diverter
+Status: install ok installed
+"""
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+@pytest.fixture
+def root(tmp_path):
+    rng = random.Random(0)
+    root = tmp_path / "root"
+    dpkg = root / "var" / "lib" / "dpkg"
+    write(str(dpkg / "status"), STATUS.encode())
+    write(str(dpkg / "info" / "base.list"), b"/.\n/etc\n/etc/base.conf\n/usr/bin/true\n")
+    write(str(dpkg / "info" / "tool:amd64.list"), b"/.\n/usr/bin/tool\n")
+    write(str(dpkg / "info" / "libshared.list"), b"/usr/lib/libshared.so\n")
+    write(str(dpkg / "info" / "diverter.list"), b"/usr/bin/true\n")
+    # diverter replaced /usr/bin/true of base, which moved to true.real
+    write(str(dpkg / "diversions"), b"/usr/bin/true\n/usr/bin/true.real\ndiverter\n")
+
+    write(str(root / "etc" / "base.conf"), b"a = 1\n" * 1000)
+    write(str(root / "usr" / "bin" / "tool"), bytes(rng.randrange(256) for _ in range(20000)))
+    write(str(root / "usr" / "bin" / "true"), b"\0" * 3000)
+    write(str(root / "usr" / "bin" / "true.real"), b"\0" * 5000)
+    write(str(root / "usr" / "lib" / "libshared.so"), b"lib" * 4000)
+    write(str(root / "opt" / "loose"), b"x" * 100)
+    return str(root)
+
+
+def test_file_owners_follow_diversions(root):
+    owners = packagesizes.file_owners(root, ["base", "tool", "libshared", "diverter"])
+    assert owners["usr/bin/true"] == ["diverter"]
+    assert owners["usr/bin/true.real"] == ["base"]
+    assert owners["usr/bin/tool"] == ["tool"]
+    assert owners["etc/base.conf"] == ["base"]
+
+
+@pytest.mark.parametrize("options", [["-comp", "gzip"], ["-comp", "zstd", "-Xcompression-level", "3"]])
+def test_analyze_shares_add_up(root, options):
+    groups = {"tools": ["tool"], "system": ["base", "diverter"]}
+    report = packagesizes.analyze(root, groups, options, excludes=["var"], workers=2)
+
+    assert report["installed"] == 6000 + 20000 + 3000 + 5000 + 12000 + 100
+    assert sum(row["installed"] for row in report["groups"].values()) == pytest.approx(report["installed"], abs=len(report["groups"]))
+    assert report["groups"]["tools"]["exclusive"] == 20000 + 12000
+    assert report["groups"]["(unpackaged)"]["installed"] == 100
+    # Random bytes do not compress, repeated text does
+    assert report["packages"]["tool"]["ratio"] == 1.0
+    assert report["packages"]["base"]["ratio"] < 0.5
+
+
+def test_over_budget(root):
+    report = packagesizes.analyze(root, {"tools": ["tool"]}, ["-comp", "gzip"])
+    assert packagesizes.over_budget(report, {"tools": packagesizes.parse_size("1K")}) == [("tools", report["groups"]["tools"]["compressed"], 1024)]
+    assert packagesizes.over_budget(report, {"tools": packagesizes.parse_size("1M")}) == []
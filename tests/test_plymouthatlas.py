@@ -0,0 +1,82 @@
+import os
+import shutil
+import struct
+import zlib
+
+import pytest
+
+import plymouthatlas
+
+
+THEME = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "plymouth")
+
+
+def frame_rows(width, height, seed):
+    return [bytes((x * 7 + y * 13 + seed * 31 + channel * 53) % 256 for x in range(width) for channel in range(4)) for y in range(height)]
+
+
+def write_palette_png(path, width, height, indices, palette, alpha):
+    raw = b"".join(b"\x00" + bytes(indices[y * width:(y + 1) * width]) for y in range(height))
+    with open(path, "wb") as f:
+        f.write(plymouthatlas.PNG_SIGNATURE)
+        f.write(plymouthatlas.chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 3, 0, 0, 0)))
+        f.write(plymouthatlas.chunk(b"PLTE", b"".join(palette)))
+        f.write(plymouthatlas.chunk(b"tRNS", bytes(alpha)))
+        f.write(plymouthatlas.chunk(b"IDAT", zlib.compress(raw)))
+        f.write(plymouthatlas.chunk(b"IEND", b""))
+
+
+@pytest.mark.parametrize("channels", [3, 4])
+def test_png_round_trip(tmp_path, channels):
+    rows = [row if channels == 4 else bytes(byte for index, byte in enumerate(row) if index % 4 != 3) for row in frame_rows(9, 5, 1)]
+    path = str(tmp_path / "image.png")
+    plymouthatlas.write_png(path, 9, 5, rows, channels)
+    width, height, read = plymouthatlas.read_png(path)
+    assert (width, height) == (9, 5)
+    if channels == 3:
+        read = [bytes(byte for index, byte in enumerate(row) if index % 4 != 3) for row in read]
+    assert read == rows
+
+
+def test_read_palette_with_transparency(tmp_path):
+    path = str(tmp_path / "palette.png")
+    write_palette_png(path, 2, 2, [0, 1, 1, 2], [b"\x10\x20\x30", b"\x40\x50\x60", b"\x70\x80\x90"], [0, 128])
+    _, _, rows = plymouthatlas.read_png(path)
+    assert rows == [b"\x10\x20\x30\x00\x40\x50\x60\x80", b"\x40\x50\x60\x80\x70\x80\x90\xff"]
+
+
+def test_pack_and_verify_round_trip(tmp_path):
+    frames = []
+    for index, (width, height) in enumerate([(6, 4), (5, 6), (6, 6), (3, 2), (6, 5)]):
+        path = str(tmp_path / f"LOGINSPINNER-{index * 10}.PNG")
+        plymouthatlas.write_png(path, width, height, frame_rows(width, height, index))
+        frames.append((index * 10, path))
+
+    width, height, rows, table = plymouthatlas.pack(frames)
+    atlas = str(tmp_path / plymouthatlas.ATLAS)
+    plymouthatlas.write_png(atlas, width, height, rows)
+    plymouthatlas.verify(atlas, table, frames)
+    assert table[30] == (0, 6, 3, 2)
+
+    # A frame that no longer matches the atlas is caught
+    plymouthatlas.write_png(frames[1][1], 5, 6, frame_rows(5, 6, 99))
+    with pytest.raises(ValueError, match="Frame 10"):
+        plymouthatlas.verify(atlas, table, frames)
+
+
+def test_build_theme(tmp_path):
+    theme = str(tmp_path / "theme")
+    shutil.copytree(THEME, theme)
+    frames = plymouthatlas.find_frames(theme)
+
+    report = plymouthatlas.build(theme)
+    assert report["frames"] == len(frames)
+    assert plymouthatlas.find_frames(theme) == []
+    with open(os.path.join(theme, plymouthatlas.SCRIPT)) as f:
+        script = f.read()
+    assert f'spinner_atlas.image = "{plymouthatlas.ATLAS}";' in script
+    assert script.count(plymouthatlas.BLOCK_BEGIN) == 1
+    for index, _ in frames:
+        assert f"spinner_atlas.x[{index}] = " in script
+
+    assert plymouthatlas.build(theme) is None
@@ -0,0 +1,62 @@
+import os
+import shutil
+
+import pytest
+
+import plymouthatlas
+import plymouthbackground
+
+
+THEME = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "plymouth")
+
+
+def test_parse_size():
+    assert plymouthbackground.parse_size("1920x1080") == (1920, 1080)
+    assert plymouthbackground.parse_size("1366X768") == (1366, 768)
+    for size in ["1920", "0x10", "axb", "-1x5"]:
+        with pytest.raises(ValueError):
+            plymouthbackground.parse_size(size)
+
+
+def test_samples_line_up_ends():
+    points = plymouthbackground.samples(5, 9)
+    assert points[0] == (0, 1, 0)
+    assert points[-1] == (4, 4, 0)
+    assert points[1] == (0, 1, 128)
+
+
+def test_scale_keeps_flat_color_and_corners():
+    rows = [bytes([10, 20, 30]) * 4, bytes([10, 20, 30]) * 4, bytes([90, 80, 70]) * 4]
+    scaled = plymouthbackground.scale(4, 3, rows, 3, 7, 5)
+    assert len(scaled) == 5 and all(len(row) == 7 * 3 for row in scaled)
+    assert scaled[0] == bytes([10, 20, 30]) * 7
+    assert scaled[-1] == bytes([90, 80, 70]) * 7
+    # Halfway between the last two rows
+    assert scaled[3][:3] == bytes([50, 50, 50])
+
+
+def test_build_theme(tmp_path):
+    theme = str(tmp_path / "theme")
+    shutil.copytree(THEME, theme)
+
+    report = plymouthbackground.build(theme, ["64x36", "32x18", "64x36"], media_speed=20)
+    assert [variant["size"] for variant in report["variants"]] == [[64, 36], [32, 18]]
+    for variant in report["variants"]:
+        width, height, _ = plymouthatlas.read_png(os.path.join(theme, variant["file"]))
+        assert [width, height] == variant["size"]
+
+    with open(os.path.join(theme, plymouthatlas.SCRIPT)) as f:
+        script = f.read()
+    assert 'background_sizes["64x36"] = "BACKGROUND-64x36.PNG";' in script
+    assert script.count(plymouthbackground.BLOCK_BEGIN) == 1
+
+    assert plymouthbackground.build(theme, []) is None
+
+
+def test_script_only_decodes_full_background_without_a_match():
+    with open(os.path.join(THEME, plymouthatlas.SCRIPT)) as f:
+        script = f.read()
+    fallback = script.index("if (!background.image) {")
+    assert script.count('Image("BACKGROUND.PNG")') == 1
+    assert script.index('Image("BACKGROUND.PNG")') > fallback
+    assert script.index("Image(background_sizes[background_size])") < fallback
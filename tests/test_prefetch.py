@@ -0,0 +1,65 @@
+import hashlib
+import os
+
+import pytest
+
+pytest.importorskip("requests")
+
+import prefetch
+
+
+class Response:
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, size):
+        for chunk in self.chunks:
+            if isinstance(chunk, BaseException):
+                raise chunk
+            yield chunk
+
+
+class Session:
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def get(self, uri, **kwargs):
+        return Response(self.chunks)
+
+
+def entry(data):
+    return ("http://mirror/pool/a.deb", "a.deb", len(data), "SHA256:" + hashlib.sha256(data).hexdigest())
+
+
+@pytest.mark.parametrize("chunks, error", [
+    ([b"half", ConnectionError("reset")], ConnectionError),
+    ([b"half", KeyboardInterrupt()], KeyboardInterrupt),
+    ([b"wrong data"], Exception),
+])
+def test_failed_download_leaves_no_partial_file(tmp_path, monkeypatch, chunks, error):
+    (tmp_path / "partial").mkdir()
+    monkeypatch.setattr(prefetch, "session", lambda: Session(chunks))
+
+    with pytest.raises(error):
+        prefetch.download(entry(b"right data"), str(tmp_path))
+    assert os.listdir(tmp_path / "partial") == []
+    assert not (tmp_path / "a.deb").exists()
+
+
+def test_download_moves_verified_file_into_place(tmp_path, monkeypatch):
+    (tmp_path / "partial").mkdir()
+    monkeypatch.setattr(prefetch, "session", lambda: Session([b"right ", b"data"]))
+
+    size, elapsed = prefetch.download(entry(b"right data"), str(tmp_path))
+    assert size == len(b"right data")
+    assert (tmp_path / "a.deb").read_bytes() == b"right data"
+    assert os.listdir(tmp_path / "partial") == []
@@ -0,0 +1,127 @@
+import os
+
+import pytest
+
+import squashlayers
+
+
+STATUS = """Package: libc6
+Status: install ok installed
+
+Package: systemd
+Status: install ok installed
+Depends: libc6
+
+Package: gnome-shell
+Status: install ok installed
+Depends: libc6, default-gl | libgl1
+
+Package: mesa
+Status: install ok installed
+Provides: libgl1
+
+Package: gparted
+Status: install ok installed
+Depends: libc6
+Recommends: gparted-help
+
+Package: gparted-help
+Status: install ok installed
+
+Package: bash
+Status: install ok installed
+Essential: yes
+Depends: libtinfo6
+
+Package: libtinfo6
+Status: install ok installed
+Priority: optional
+
+Package: login
+Status: install ok installed
+Priority: required
+
+Package: stray
+Status: install ok installed
+
+Package: removed
+Status: deinstall ok config-files
+"""
+
+LAYERS = [("core", {"packages": ["systemd"]}), ("desktop", {"packages": ["gnome-shell"]}), ("tools", {"packages": ["gparted"]})]
+
+
+def write(path, data=b"x"):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+@pytest.fixture
+def root(tmp_path):
+    root = tmp_path / "root"
+    write(str(root / squashlayers.STATUS), STATUS.encode())
+    info = root / "var" / "lib" / "dpkg" / "info"
+    lists = {
+        "libc6": ["/usr/lib/libc.so.6"],
+        "systemd": ["/usr/lib/systemd", "/usr/lib/systemd/systemd"],
+        "gnome-shell": ["/usr/share/gnome-shell", "/usr/share/gnome-shell/theme.css", "/usr/bin/gnome-shell"],
+        "mesa": ["/usr/lib/libGL.so.1"],
+        "gparted": ["/usr/sbin/gparted", "/usr/share/gparted", "/usr/share/gparted/icon.png"],
+    }
+    for package, paths in lists.items():
+        write(str(info / f"{package}.list"), "".join(path + "\n" for path in ["/."] + paths).encode())
+        for path in paths:
+            if "." in os.path.basename(path) or path.startswith(("/usr/bin", "/usr/sbin")) or path.endswith("systemd/systemd"):
+                write(str(root) + path, b"x" * 5000)
+    write(str(root / "etc" / "hostname"))
+    return str(root)
+
+
+def test_closure_follows_dependencies_and_providers(root):
+    packages, provides = squashlayers.installed_packages(root)
+    assert "removed" not in packages
+    assert provides == {"libgl1": ["mesa"]}
+    assert squashlayers.closure(["gnome-shell"], packages, provides) == {"gnome-shell", "libc6", "mesa"}
+
+
+def test_package_layers_assign_lowest_layer(root):
+    assigned = squashlayers.package_layers(root, LAYERS)
+    assert assigned == {"libc6": 0, "systemd": 0, "gnome-shell": 1, "mesa": 1, "gparted": 2, "gparted-help": 2,
+                        "bash": 0, "libtinfo6": 0, "login": 0, "stray": 0}
+
+
+def test_essential_package_nothing_depends_on_is_core(root):
+    # Even when a later layer is the only one to name it
+    assigned = squashlayers.package_layers(root, [("core", {"packages": []}), ("tools", {"packages": ["bash", "login"]})])
+    assert assigned["bash"] == 0
+    assert assigned["libtinfo6"] == 0
+    assert assigned["login"] == 0
+
+
+def test_split_excludes_topmost_paths_of_other_layers(root):
+    excludes, sizes = squashlayers.split(root, LAYERS, excludes=["var"])
+
+    # The core layer leaves out whole directories of the layers above it
+    assert excludes["core"] == ["usr/bin/gnome-shell", "usr/lib/libGL.so.1", "usr/sbin/gparted", "usr/share/gnome-shell", "usr/share/gparted"]
+    assert "etc" not in excludes["core"]
+    assert "usr/lib/systemd" not in excludes["core"]
+
+    assert excludes["desktop"] == sorted(excludes["desktop"])
+    assert "usr/share/gparted" in excludes["desktop"]
+    assert "usr/share/gnome-shell" not in excludes["desktop"]
+    assert "etc" in excludes["tools"]
+    assert all(size > 0 for size in sizes.values())
+
+
+def test_empty_layer_gets_no_excludes(root):
+    excludes, sizes = squashlayers.split(root, LAYERS + [("extra", {"packages": ["missing"]})], excludes=["var"])
+    assert excludes["extra"] is None
+    assert sizes["extra"] == 0
+
+
+def test_write_excludes_escapes_wildcards(tmp_path):
+    path = str(tmp_path / "excludes")
+    squashlayers.write_excludes(path, ["usr/share/a*b", "usr/bad\nname", "usr/(x)"])
+    with open(path) as f:
+        assert f.read() == "usr/share/a\\*b\nusr/\\(x\\)\n"
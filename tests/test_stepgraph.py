@@ -0,0 +1,119 @@
+import threading
+import time
+
+import pytest
+
+import stepgraph
+
+
+def noop():
+    pass
+
+
+def graph_of(*steps):
+    graph = stepgraph.Graph()
+    for step in steps:
+        graph.add(step)
+    return graph
+
+
+def test_inputs_order_steps_after_writers():
+    graph = graph_of(stepgraph.Step("use", noop, inputs=["/root/etc/apt"]),
+                     stepgraph.Step("write", noop, outputs=["/root/etc"]))
+    assert graph.dependencies("use") == {"write"}
+    assert graph.order() == ["write", "use"]
+
+
+def test_validate_rejects_unordered_writers_of_a_path():
+    graph = graph_of(stepgraph.Step("a", noop, outputs=["/root/etc"]),
+                     stepgraph.Step("b", noop, outputs=["/root/etc/hosts"]))
+    with pytest.raises(ValueError, match="can run at the same time"):
+        graph.validate()
+
+    graph.steps["b"].after.append("a")
+    graph.validate()
+
+
+def test_validate_rejects_cycles_and_unknown_steps():
+    with pytest.raises(ValueError, match="cycle"):
+        graph_of(stepgraph.Step("a", noop, after=["b"]), stepgraph.Step("b", noop, after=["a"])).validate()
+    with pytest.raises(ValueError, match="does not exist"):
+        graph_of(stepgraph.Step("a", noop, after=["missing"])).validate()
+    with pytest.raises(ValueError, match="twice"):
+        graph_of(stepgraph.Step("a", noop), stepgraph.Step("a", noop))
+
+
+def test_scheduler_runs_independent_steps_together_within_limits():
+    lock = threading.Lock()
+    running = {"steps": 0, "peak": 0, "network": 0, "network_peak": 0}
+
+    def step(network=False):
+        with lock:
+            running["steps"] += 1
+            running["peak"] = max(running["peak"], running["steps"])
+            if network:
+                running["network"] += 1
+                running["network_peak"] = max(running["network_peak"], running["network"])
+        time.sleep(0.05)
+        with lock:
+            running["steps"] -= 1
+            if network:
+                running["network"] -= 1
+
+    graph = graph_of(*[stepgraph.Step(f"fetch-{index}", lambda: step(True), resources=["network"]) for index in range(3)],
+                     *[stepgraph.Step(f"work-{index}", step) for index in range(3)],
+                     stepgraph.Step("last", noop, after=[f"work-{index}" for index in range(3)] + ["fetch-0"]))
+    scheduler = stepgraph.Scheduler(graph, workers=4, limits={"network": 1})
+    timings = scheduler.run()
+
+    assert set(timings) == set(graph.steps)
+    assert running["network_peak"] == 1
+    assert running["peak"] > 1
+    assert all(timings["last"][0] >= timings[f"work-{index}"][1] for index in range(3))
+
+
+def test_scheduler_limits_resources_per_instance():
+    lock = threading.Lock()
+    running = {"a": 0, "peak": 0}
+
+    def step():
+        with lock:
+            running["a"] += 1
+            running["peak"] = max(running["peak"], running["a"])
+        time.sleep(0.05)
+        with lock:
+            running["a"] -= 1
+
+    graph = graph_of(stepgraph.Step("one", step, resources=["dpkg:a"]),
+                     stepgraph.Step("two", step, resources=["dpkg:a"]),
+                     stepgraph.Step("other", noop, resources=["dpkg:b"]))
+    stepgraph.Scheduler(graph, workers=3, limits={"dpkg": 1}).run()
+    assert running["peak"] == 1
+
+
+def test_scheduler_stops_after_a_failure():
+    ran = []
+
+    def fail():
+        raise RuntimeError("broken")
+
+    graph = graph_of(stepgraph.Step("fail", fail),
+                     stepgraph.Step("after", lambda: ran.append("after"), after=["fail"]))
+    scheduler = stepgraph.Scheduler(graph, workers=2)
+    with pytest.raises(RuntimeError, match="broken"):
+        scheduler.run()
+    assert ran == []
+    assert scheduler.critical_path() == ([], 0.0)
+
+
+def test_scheduler_reports_impossible_limits():
+    graph = graph_of(stepgraph.Step("a", noop, resources=["network"]))
+    with pytest.raises(ValueError, match="never start"):
+        stepgraph.Scheduler(graph, limits={"network": 0}).run()
+
+
+def test_critical_path_follows_longest_chain():
+    graph = graph_of(stepgraph.Step("a", noop), stepgraph.Step("b", noop, after=["a"]), stepgraph.Step("c", noop))
+    scheduler = stepgraph.Scheduler(graph)
+    scheduler.timings = {"a": (0.0, 2.0), "b": (2.0, 3.0), "c": (0.0, 2.5)}
+    assert scheduler.critical_path() == (["a", "b"], 3.0)